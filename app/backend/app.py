@@ -1,22 +1,25 @@
+import asyncio
 import dataclasses
-import io
 import json
 import logging
 import mimetypes
 import os
+import tempfile
 from pathlib import Path
-from typing import AsyncGenerator, cast
+from typing import Any, AsyncGenerator, Optional, cast
 
-from azure.core.exceptions import ResourceNotFoundError
+import aiohttp
+import httpx
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
 from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
 from azure.keyvault.secrets.aio import SecretClient
 from azure.monitor.opentelemetry import configure_azure_monitor
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.aio import SearchIndexClient
-from azure.storage.blob.aio import BlobServiceClient
-from azure.storage.blob import generate_blob_sas, BlobSasPermissions 
+from azure.storage.blob.aio import BlobClient, BlobServiceClient, StorageStreamDownloader
 
-from openai import APIError, AsyncAzureOpenAI, AsyncOpenAI
+from openai import DEFAULT_TIMEOUT, APIError, AsyncAzureOpenAI, AsyncOpenAI
 from opentelemetry.instrumentation.aiohttp_client import AioHttpClientInstrumentor
 from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
 from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
@@ -28,25 +31,37 @@ from quart import (
     jsonify,
     make_response,
     request,
-    send_file,
     send_from_directory,
 )
 from quart_cors import cors
+from werkzeug.datastructures import ContentRange
+from werkzeug.http import unquote_etag
 
 from werkzeug.utils import secure_filename  
-import subprocess
 
 from approaches.approach import Approach
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.chatreadretrievereadvision import ChatReadRetrieveReadVisionApproach
+from approaches.RubricEvaluationApproach import RubricEvaluationApproach
 from approaches.retrievethenread import RetrieveThenReadApproach
 from approaches.retrievethenreadvision import RetrieveThenReadVisionApproach
+from core.answercache import AnswerCache
 from core.authentication import AuthenticationHelper
+from core.contentcache import ContentCache
+from core.embeddingcache import EmbeddingCache
+from core.imagecache import ImageCache
+from core.ingestion import IngestionQueue
+from core.modelhelper import token_count_cache
+from core.rubriccache import RubricCache, SQLiteRubricCacheStore
+from core.rubricjobs import RubricJob, RubricJobRunner
+from core.rubricstore import DEFAULT_RUBRIC_FILE, RubricStore
+from core.searchcache import SearchCache
+from core.semanticcache import SemanticAnswerCache
+from core.tablerenderer import table_render_cache
 
 import aiofiles  
 
-from datetime import datetime, timedelta
-from azure.core.exceptions import ResourceExistsError
+from datetime import datetime
 
 CONFIG_OPENAI_TOKEN = "openai_token"
 CONFIG_CREDENTIAL = "azure_credential"
@@ -54,11 +69,24 @@ CONFIG_ASK_APPROACH = "ask_approach"
 CONFIG_ASK_VISION_APPROACH = "ask_vision_approach"
 CONFIG_CHAT_VISION_APPROACH = "chat_vision_approach"
 CONFIG_CHAT_APPROACH = "chat_approach"
+CONFIG_RUBRIC_APPROACH = "rubric_evaluation_approach"
 CONFIG_BLOB_CONTAINER_CLIENT = "blob_container_client"
 CONFIG_AUTH_CLIENT = "auth_client"
 CONFIG_GPT4V_DEPLOYED = "gpt4v_deployed"
 CONFIG_SEARCH_CLIENT = "search_client"
 CONFIG_OPENAI_CLIENT = "openai_client"
+CONFIG_CONTENT_CACHE = "content_cache"
+CONFIG_EMBEDDING_CACHE = "embedding_cache"
+CONFIG_SEARCH_CACHE = "search_cache"
+CONFIG_ANSWER_CACHE = "answer_cache"
+CONFIG_SEMANTIC_CACHE = "semantic_cache"
+CONFIG_IMAGE_CACHE = "image_cache"
+CONFIG_VISION_SESSION = "vision_session"
+CONFIG_INGESTION_QUEUE = "ingestion_queue"
+CONFIG_RUBRIC_STORE = "rubric_store"
+CONFIG_RUBRIC_CACHE = "rubric_cache"
+CONFIG_RUBRIC_JOB_RUNNER = "rubric_job_runner"
+CONTENT_CHUNK_SIZE = 4 * 1024 * 1024
 ERROR_MESSAGE = """The app encountered an error processing your request.
 If you are an administrator of the app, view the full error in the logs. See aka.ms/appservice-logs for more information.
 Error type: {error_type}
@@ -92,31 +120,108 @@ async def assets(path):
     return await send_from_directory(Path(__file__).resolve().parent / "static" / "assets", path)
 
 
+def is_content_not_modified(etag: Optional[str], last_modified: Optional[datetime]) -> bool:
+    # If-None-Match takes precedence over If-Modified-Since, see RFC 9110 section 13.1.3
+    if request.if_none_match:
+        return etag is not None and request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def get_content_range(size: int, etag: Optional[str], last_modified: Optional[datetime]) -> Optional[tuple[int, int]]:
+    # Returns the (start, stop) bytes requested by the Range header, or None to send the whole file
+    if request.range is None or size == 0:
+        return None
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and (last_modified is None or if_range.date != last_modified.replace(microsecond=0)):
+        return None
+    return request.range.range_for_length(size) or (-1, -1)
+
+
+async def stream_blob_chunks(blob: StorageStreamDownloader) -> AsyncGenerator[bytes, None]:
+    async for chunk in blob.chunks():
+        yield chunk
+
+
 # Serve content files from blob storage from within the app to keep the example self-contained.
 # *** NOTE *** this assumes that the content files are public, or at least that all users of the app
-# can access all the files. This is also slow and memory hungry.
+# can access all the files. The blob is streamed chunk by chunk, honouring Range and conditional requests,
+# so that large PDFs are not buffered in memory.
 @bp.route("/content/<path>")
 async def content_file(path: str):
     # Remove page number from path, filename-1.txt -> filename.txt
     if path.find("#page=") > 0:
         path_parts = path.rsplit("#page=", 1)
         path = path_parts[0]
-    logging.info("Opening file %s at page %s", path)
+    logging.info("Opening file %s", path)
     blob_container_client = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT]
+    blob_client = blob_container_client.get_blob_client(path)
+    for _ in range(2):
+        try:
+            return await make_content_response(blob_client, path)
+        except ResourceModifiedError:
+            # The blob was overwritten between reading its properties and downloading it, start over with the new version
+            logging.warning("File %s changed while it was being served", path)
+    abort(503)
+
+
+async def make_content_response(blob_client: BlobClient, path: str):
     try:
-        blob = await blob_container_client.get_blob_client(path).download_blob()
+        properties = await blob_client.get_blob_properties()
     except ResourceNotFoundError:
         logging.exception("Path not found: %s", path)
         abort(404)
-    if not blob.properties or not blob.properties.has_key("content_settings"):
+    if not properties or not properties.content_settings:
         abort(404)
-    mime_type = blob.properties["content_settings"]["content_type"]
-    if mime_type == "application/octet-stream":
+    mime_type = properties.content_settings.content_type
+    if not mime_type or mime_type == "application/octet-stream":
         mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    await blob.readinto(blob_file)
-    blob_file.seek(0)
-    return await send_file(blob_file, mimetype=mime_type, as_attachment=False, attachment_filename=path)
+    etag = unquote_etag(properties.etag)[0] if properties.etag else None
+    last_modified = properties.last_modified
+    size = properties.size or 0
+
+    if is_content_not_modified(etag, last_modified):
+        response = await make_response("", 304)
+    else:
+        byte_range = get_content_range(size, etag, last_modified)
+        if byte_range == (-1, -1):
+            response = await make_response("", 416)
+            response.content_range = ContentRange("bytes", None, None, size)
+            return response
+        start, stop = byte_range or (0, size)
+        body: AsyncGenerator[bytes, None]
+        content_cache: Optional[ContentCache] = current_app.config.get(CONFIG_CONTENT_CACHE)
+        cached = await content_cache.get(blob_client, path, properties.etag, size) if content_cache else None
+        if cached:
+            body = cached.iter_bytes(start, stop)
+        else:
+            try:
+                # Pin the download to the version whose properties were just read, so headers and body agree
+                blob = await blob_client.download_blob(
+                    offset=start,
+                    length=stop - start,
+                    etag=properties.etag,
+                    match_condition=MatchConditions.IfNotModified,
+                )
+            except ResourceNotFoundError:
+                logging.exception("Path not found: %s", path)
+                abort(404)
+            body = stream_blob_chunks(blob)
+        response = await make_response(body, 206 if byte_range else 200)
+        response.timeout = None  # type: ignore
+        response.mimetype = mime_type
+        response.content_length = stop - start
+        if byte_range:
+            response.content_range = ContentRange("bytes", start, stop, size)
+    response.accept_ranges = "bytes"
+    if etag:
+        response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
 
 
 def error_dict(error: Exception) -> dict:
@@ -215,173 +320,185 @@ def auth_setup():
 def config():
     return jsonify({"showGPT4VOptions": current_app.config[CONFIG_GPT4V_DEPLOYED]})
 
-@bp.route('/upload_pdf', methods=['POST'])
-async def upload_file_pdf():
-    
-    AZURE_FORMRECOGNIZER_SERVICE=os.environ["AZURE_FORMRECOGNIZER_SERVICE"]
-    AZURE_STORAGE_ACCOUNT = os.environ["AZURE_STORAGE_ACCOUNT"]
-    AZURE_STORAGE_CONTAINER = os.environ["AZURE_STORAGE_CONTAINER"]
-    AZURE_SEARCH_SERVICE = os.environ["AZURE_SEARCH_SERVICE"]
-    AZURE_SEARCH_INDEX = os.environ["AZURE_SEARCH_INDEX"]
+
+def get_cache_stats() -> dict[str, Any]:
+    content_cache: Optional[ContentCache] = current_app.config.get(CONFIG_CONTENT_CACHE)
+    embedding_cache: Optional[EmbeddingCache] = current_app.config.get(CONFIG_EMBEDDING_CACHE)
+    search_cache: Optional[SearchCache] = current_app.config.get(CONFIG_SEARCH_CACHE)
+    answer_cache: Optional[AnswerCache] = current_app.config.get(CONFIG_ANSWER_CACHE)
+    semantic_cache: Optional[SemanticAnswerCache] = current_app.config.get(CONFIG_SEMANTIC_CACHE)
+    image_cache: Optional[ImageCache] = current_app.config.get(CONFIG_IMAGE_CACHE)
+    auth_helper: Optional[AuthenticationHelper] = current_app.config.get(CONFIG_AUTH_CLIENT)
+    rubric_store: Optional[RubricStore] = current_app.config.get(CONFIG_RUBRIC_STORE)
+    rubric_cache: Optional[RubricCache] = current_app.config.get(CONFIG_RUBRIC_CACHE)
+    return {
+        "pid": os.getpid(),
+        "content": content_cache.get_stats() if content_cache else None,
+        "embeddings": embedding_cache.get_stats() if embedding_cache else None,
+        "search": search_cache.get_stats() if search_cache else None,
+        "answers": answer_cache.get_stats() if answer_cache else None,
+        "semantic_answers": semantic_cache.get_stats() if semantic_cache else None,
+        "images": image_cache.get_stats() if image_cache else None,
+        "auth_claims": auth_helper.get_stats() if auth_helper and auth_helper.use_authentication else None,
+        "rubrics": rubric_store.get_stats() if rubric_store else None,
+        "rubric_evaluations": rubric_cache.get_stats() if rubric_cache else None,
+        "token_counts": token_count_cache.stats.to_dict(),
+        "table_renders": table_render_cache.stats.to_dict(),
+    }
+
+
+async def invalidate_index_caches(filename: str):
+    # Called once a document was added to the search index, so that answers reflect the change.
+    # Only the caches of this worker are cleared, the other workers pick up the change when their entries expire,
+    # except for the rubric cache, which is shared by the workers of the host.
+    search_cache: Optional[SearchCache] = current_app.config.get(CONFIG_SEARCH_CACHE)
+    if search_cache:
+        search_cache.invalidate()
+    answer_cache: Optional[AnswerCache] = current_app.config.get(CONFIG_ANSWER_CACHE)
+    if answer_cache:
+        answer_cache.invalidate()
+    semantic_cache: Optional[SemanticAnswerCache] = current_app.config.get(CONFIG_SEMANTIC_CACHE)
+    if semantic_cache:
+        semantic_cache.invalidate()
+    rubric_cache: Optional[RubricCache] = current_app.config.get(CONFIG_RUBRIC_CACHE)
+    if rubric_cache:
+        await rubric_cache.invalidate_files([filename])
+
+
+# Counters for the caches of the worker that handles the request, used to size the caches for the number of workers.
+# They describe the app internals, so they are only served when authentication is disabled (e.g. when running locally),
+# deployed apps log them when each worker shuts down instead.
+@bp.route("/cache_stats", methods=["GET"])
+def cache_stats():
+    auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
+    if auth_helper.use_authentication:
+        abort(404)
+    return jsonify(get_cache_stats())
+
+def get_prepdocs_args() -> list[str]:
+    # scripts/prepdocs.py runs with the virtual environment of the scripts, which sits next to the app in the repository
+    base_dir = Path(__file__).resolve().parent.parent.parent
     OPENAI_HOST = os.getenv("OPENAI_HOST", "azure")
-    AZURE_OPENAI_SERVICE = os.getenv("AZURE_OPENAI_SERVICE")
-    AZURE_OPENAI_EMB_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMB_DEPLOYMENT") if OPENAI_HOST == "azure" else None
-    OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-    OPENAI_ORGANIZATION = os.getenv("OPENAI_ORGANIZATION")
-    
-    # Set up Azure Blob Storage client  
-    connection_string = os.environ["AZURE_STORAGE_CONNECTION_STRING"]  
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)   
-    container_name = os.getenv("AZURE_STORAGE_CONTAINER")  # Use the 'content' container for PDF files  
-  
+    args = [
+        str(base_dir / "scripts" / ".venv" / "bin" / "python3"),
+        str(base_dir / "scripts" / "prepdocs.py"),
+        "--verbose",
+        "--storageaccount",
+        os.environ["AZURE_STORAGE_ACCOUNT"],
+        "--container",
+        os.environ["AZURE_STORAGE_CONTAINER"],
+        "--searchservice",
+        os.environ["AZURE_SEARCH_SERVICE"],
+        "--index",
+        os.environ["AZURE_SEARCH_INDEX"],
+        "--openaihost",
+        OPENAI_HOST,
+        "--openaimodelname",
+        os.getenv("AZURE_OPENAI_EMB_MODEL_NAME", "text-embedding-ada-002"),
+    ]
+    optional_args = {
+        "--formrecognizerservice": os.getenv("AZURE_FORMRECOGNIZER_SERVICE"),
+        "--openaiservice": os.getenv("AZURE_OPENAI_SERVICE") if OPENAI_HOST == "azure" else None,
+        "--openaideployment": os.getenv("AZURE_OPENAI_EMB_DEPLOYMENT") if OPENAI_HOST == "azure" else None,
+        "--openaikey": os.getenv("OPENAI_API_KEY"),
+        "--openaiorg": os.getenv("OPENAI_ORGANIZATION"),
+    }
+    for name, value in optional_args.items():
+        if value:
+            args.extend([name, value])
+    return args
+
+
+# Uploads are ingested in the background by the ingestion queue, the response carries the id of the job,
+# whose progress is reported by /ingest_jobs/<job_id>
+@bp.route("/upload_pdf", methods=["POST"])
+async def upload_file_pdf():
+    ingestion_queue: IngestionQueue = current_app.config[CONFIG_INGESTION_QUEUE]
+
     # Check if a file was sent
     files = await request.files
-    if 'file' not in files:
-        return 'No file part', 400
-    file = files['file']
+    if "file" not in files:
+        return "No file part", 400
+    file = files["file"]
 
     # If the user does not select a file, the browser might
     # submit an empty part without a filename.
-    if file.filename == '':
-        return 'No selected file', 400
-  
-    # Define the path in the blob storage where the file will be saved.  
-    blob_file_name = secure_filename(file.filename)  
-  
-    # Save the file to Azure Blob Storage  
-    blob_client = blob_service_client.get_blob_client(container_name, blob_file_name)  
-    file_data = file.read()  
-    await blob_client.upload_blob(file_data)  
-  
-    # Construct the path to the 'prepdocs.py' script which is also at the same level as 'app'  
-    script_dir = os.path.dirname(os.path.realpath(__file__))  
-    base_dir = os.path.join(script_dir, '..', '..')  # Move up two levels to the parent directory of 'app'  
-    script_path = os.path.join(base_dir, 'scripts', 'prepdocs.py')  
-    venv_python_path = os.path.join(base_dir, 'scripts', '.venv', 'bin', 'python3')  
-    
-    subprocess_args = [venv_python_path, script_path, '--uploaded_file', blob_client.url,  # Pass the URL of the blob  
-                    '--formrecognizerservice', AZURE_FORMRECOGNIZER_SERVICE,
-                    '--storageaccount', AZURE_STORAGE_ACCOUNT,
-                    '--container', AZURE_STORAGE_CONTAINER,
-                    '--searchservice', AZURE_SEARCH_SERVICE,
-                    '--index', AZURE_SEARCH_INDEX,
-                    '--openaiservice', AZURE_OPENAI_SERVICE,
-                    '--openaideployment', AZURE_OPENAI_EMB_DEPLOYMENT]
-
-    if OPENAI_API_KEY:
-        subprocess_args.extend(['--openaimodelname', OPENAI_API_KEY,
-                                '--openaikey', OPENAI_API_KEY])
-
-    if OPENAI_ORGANIZATION:  
-        subprocess_args.extend(['--openaiorg', OPENAI_ORGANIZATION])  
-
-    subprocess.run(subprocess_args)
-    
-    return 'File uploaded and processed successfully'
-
-
-@bp.route('/upload_rubric', methods=['POST'])
-async def upload_rubric():
-    
-    # Set up Azure Blob Storage client
-    connection_string = os.environ["AZURE_STORAGE_CONNECTION_STRING"]
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string) 
-    container_name = os.getenv("AZURE_STORAGE_CONTAINER_RUBRIC")
-    try:  
-        await blob_service_client.create_container(container_name)  
-    except ResourceExistsError:  
-        pass  # Container already exists  
-    CONFIG_BLOB_CONTAINER_CLIENT = blob_service_client.get_container_client(container_name)  
+    filename = secure_filename(file.filename or "")
+    if filename == "":
+        return "No selected file", 400
+
+    # prepdocs uploads the file to Azure Blob Storage itself, before it parses and indexes it
+    job = ingestion_queue.create_job(filename)
+    await file.save(job.path)
+    try:
+        ingestion_queue.submit(job, get_prepdocs_args())
+    except asyncio.QueueFull:
+        return jsonify({"error": "Too many documents are being ingested, try again later."}), 503
+
+    return jsonify({"job_id": job.id, "status": job.status, "stage": job.stage}), 202
 
-    files = await request.files
-    if 'file' not in files:
-        # If no file is uploaded, return the SAS URL of the default CSV file
-        blob_file_name = "rubric.csv"
-    else:
-        file = files['file']
 
-        if file.filename == '':
-            return 'No selected file', 400
+@bp.route("/ingest_jobs/<job_id>", methods=["GET"])
+def ingest_job_status(job_id: str):
+    ingestion_queue: IngestionQueue = current_app.config[CONFIG_INGESTION_QUEUE]
+    job = ingestion_queue.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
 
-        filename = secure_filename(file.filename)
 
-        # Define the path in the blob storage where the file will be saved.
-        blob_file_name = f'{filename}'
+def get_rubric_store() -> RubricStore:
+    rubric_store: Optional[RubricStore] = current_app.config.get(CONFIG_RUBRIC_STORE)
+    if rubric_store is None:
+        # The rubric routes need AZURE_STORAGE_CONNECTION_STRING, whose account key signs the SAS URLs
+        abort(404)
+    return rubric_store
 
-        # Save the file to the 'rubric' folder in Azure Blob Storage  
-        blob_client = CONFIG_BLOB_CONTAINER_CLIENT.get_blob_client(blob_file_name)  
 
-        # Read the file data and upload it to the blob
-        file_data = file.read()
-        await blob_client.upload_blob(file_data)
+@bp.route("/upload_rubric", methods=["POST"])
+async def upload_rubric():
+    rubric_store = get_rubric_store()
 
-    # Generate SAS token
-    sas_token = generate_blob_sas(
-        blob_service_client.account_name,
-        container_name,
-        blob_name= filename,
-        account_key=blob_service_client.credential.account_key,
-        permission=BlobSasPermissions(read=True),
-        expiry=datetime.utcnow() + timedelta(hours=1)  # the token will be valid for 1 hour
-    )
+    files = await request.files
+    if "file" not in files:
+        # If no file is uploaded, return the SAS URL of the default CSV file
+        blob_file_name = DEFAULT_RUBRIC_FILE
+    else:
+        file = files["file"]
+        blob_file_name = secure_filename(file.filename or "")
+        if blob_file_name == "":
+            return "No selected file", 400
 
-    sas_url = blob_client.url + "?" + sas_token
+        # Save the file to the rubric container, which also refreshes the list of rubric files
+        await rubric_store.upload(blob_file_name, file.read())
 
-    return sas_url  # Return the SAS URL of the uploaded file or the default CSV file
+    return rubric_store.get_sas_url(blob_file_name)  # Return the SAS URL of the uploaded file or the default CSV file
 
 
-@bp.route('/get_csv_sas_url')
+@bp.route("/get_csv_sas_url")
 async def get_csv_sas_url():
-    
-    # Set up Azure Blob Storage client
-    connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    container_name = os.environ["AZURE_STORAGE_CONTAINER_RUBRIC"] #"rubric"
-
-    # Get the name of the file from the query parameters
-    blob_file_name = request.args.get('file', 'rubric.csv')  # Use 'rubric.csv' as the default file name
-
-    # Get the blob client for the specified file
-    blob_client = blob_service_client.get_blob_client(container_name, blob_file_name)
-
-    # Generate SAS token
-    sas_token = generate_blob_sas(
-        blob_service_client.account_name,
-        container_name,
-        blob_file_name,
-        account_key=blob_service_client.credential.account_key,
-        permission=BlobSasPermissions(read=True),
-        expiry=datetime.utcnow() + timedelta(hours=1)  # the token will be valid for 1 hour
-    )
+    rubric_store = get_rubric_store()
+    blob_file_name = request.args.get("file", DEFAULT_RUBRIC_FILE)
+    return rubric_store.get_sas_url(blob_file_name)  # Return the SAS URL of the specified file
 
-    sas_url = blob_client.url + "?" + sas_token
 
-    return sas_url  # Return the SAS URL of the specified file
+@bp.route("/get_rubric_files")
+async def get_rubric_files():
+    rubric_store = get_rubric_store()
+    try:
+        blob_names, etag = await rubric_store.list_files()
+    except Exception as e:
+        return str(e), 500
 
+    # The browser revalidates the list with its ETag on each page load, and gets a 304 while it is unchanged
+    if is_content_not_modified(etag, None):
+        response = await make_response("", 304)
+    else:
+        response = jsonify({"rubric_files": blob_names})
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
-@bp.route('/get_rubric_files')  
-async def get_rubric_files(): 
-        
-    connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")  
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)  
-    container_name = os.getenv("AZURE_STORAGE_CONTAINER_RUBRIC")
-    container_client = blob_service_client.get_container_client(container_name)  
-  
-    try:  
-        # List all blobs in the container  
-        blob_names = []  
-        async for blob in container_client.list_blobs():  
-            blob_names.append(blob.name)  
-          
-        # Make sure the default file is in the list  
-        default_file = "rubric.csv"  
-        if default_file not in blob_names:  
-            blob_names.insert(0, default_file)  
-  
-        return jsonify({"rubric_files": blob_names})  
-  
-    except Exception as e:  
-        return str(e), 500 
 
 @bp.before_app_serving
 async def setup_clients():
@@ -406,10 +523,19 @@ async def setup_clients():
     # Used only with non-Azure OpenAI deployments
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
     OPENAI_ORGANIZATION = os.getenv("OPENAI_ORGANIZATION")
+    # Connection pool of the OpenAI client shared by all approaches, sized for the concurrent requests of a worker
+    # (including the criteria of rubric evaluations) so that connections are reused instead of opened per request
+    OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "100"))
+    OPENAI_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY_SECONDS", "30"))
 
     AZURE_TENANT_ID = os.getenv("AZURE_TENANT_ID")
     AZURE_USE_AUTHENTICATION = os.getenv("AZURE_USE_AUTHENTICATION", "").lower() == "true"
     AZURE_ENFORCE_ACCESS_CONTROL = os.getenv("AZURE_ENFORCE_ACCESS_CONTROL", "").lower() == "true"
+    # Number of threads per worker for the On Behalf Of token exchanges, which MSAL makes synchronously
+    AZURE_AUTH_MAX_WORKERS = int(os.getenv("AZURE_AUTH_MAX_WORKERS", "4"))
+    # Number of seconds the groups of a user read from Microsoft Graph are kept, set to 0 to read them on every request
+    AZURE_AUTH_GROUPS_CACHE_TTL_SECONDS = float(os.getenv("AZURE_AUTH_GROUPS_CACHE_TTL_SECONDS", "900"))
     AZURE_SERVER_APP_ID = os.getenv("AZURE_SERVER_APP_ID")
     AZURE_SERVER_APP_SECRET = os.getenv("AZURE_SERVER_APP_SECRET")
     AZURE_CLIENT_APP_ID = os.getenv("AZURE_CLIENT_APP_ID")
@@ -423,6 +549,63 @@ async def setup_clients():
 
     USE_GPT4V = os.getenv("USE_GPT4V", "").lower() == "true"
 
+    # Per-worker cache for /content, set CONTENT_CACHE_MEMORY_MB to 0 to disable it
+    CONTENT_CACHE_MEMORY_MB = int(os.getenv("CONTENT_CACHE_MEMORY_MB", "32"))
+    CONTENT_CACHE_ENTRY_MB = int(os.getenv("CONTENT_CACHE_ENTRY_MB", "4"))
+    CONTENT_CACHE_DIR = os.getenv("CONTENT_CACHE_DIR")
+    CONTENT_CACHE_DISK_MB = int(os.getenv("CONTENT_CACHE_DISK_MB", "1024"))
+    # Per-worker cache for query embeddings, set EMBEDDING_CACHE_MAX_ENTRIES to 0 to disable it
+    EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "1000"))
+    EMBEDDING_CACHE_TTL_SECONDS = float(os.getenv("EMBEDDING_CACHE_TTL_SECONDS", "86400"))
+    # Per-worker cache for search results, set SEARCH_CACHE_MB to 0 to disable it
+    SEARCH_CACHE_MB = int(os.getenv("SEARCH_CACHE_MB", "16"))
+    SEARCH_CACHE_TTL_SECONDS = float(os.getenv("SEARCH_CACHE_TTL_SECONDS", "300"))
+    # Per-worker cache for answers to requests with a temperature of 0, set ANSWER_CACHE_MB to enable it
+    ANSWER_CACHE_MB = int(os.getenv("ANSWER_CACHE_MB", "0"))
+    ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+    # Per-worker cache for answers to paraphrased questions, set SEMANTIC_CACHE_MAX_ENTRIES to enable it
+    SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "0"))
+    SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "3600"))
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+    SEMANTIC_CACHE_SAMPLE_RATE = float(os.getenv("SEMANTIC_CACHE_SAMPLE_RATE", "0.05"))
+    # Per-worker cache for the page images sent to GPT-4 with Vision, set IMAGE_CACHE_MB to 0 to disable it
+    IMAGE_CACHE_MB = int(os.getenv("IMAGE_CACHE_MB", "32"))
+    # Number of page images the vision approaches download at once for a request
+    IMAGE_FETCH_MAX_CONCURRENCY = int(os.getenv("IMAGE_FETCH_MAX_CONCURRENCY", "4"))
+    # Connections the vision approaches keep open to Computer Vision, which embeds the queries for the image vectors
+    VISION_MAX_CONNECTIONS = int(os.getenv("VISION_MAX_CONNECTIONS", "100"))
+    # Fraction of the token limit of the model the sources can take in a prompt, requests can choose with the sources_token_fraction override
+    SOURCES_TOKEN_FRACTION = float(os.getenv("SOURCES_TOKEN_FRACTION", "0.5"))
+    # How the tables of the sources are written in a prompt (html, compact or auto to keep HTML when the system prompt
+    # asks for HTML tables), requests can choose with the table_format override
+    SOURCES_TABLE_FORMAT = os.getenv("SOURCES_TABLE_FORMAT", "html")
+    # Whether /chat retrieves with the question while the search query is generated, requests can choose with the speculative_retrieval override
+    CHAT_SPECULATIVE_RETRIEVAL = os.getenv("CHAT_SPECULATIVE_RETRIEVAL", "").lower() == "true"
+    # When /chat searches the question without generating a search query (never, first_turn, self_contained or always),
+    # requests can choose with the skip_query_rewrite override
+    CHAT_SKIP_QUERY_REWRITE = os.getenv("CHAT_SKIP_QUERY_REWRITE", "never")
+    CHAT_SKIP_QUERY_REWRITE_MAX_WORDS = int(os.getenv("CHAT_SKIP_QUERY_REWRITE_MAX_WORDS", "16"))
+    # Background ingestion of the documents uploaded to /upload_pdf, the limits apply to each worker
+    INGESTION_MAX_CONCURRENT_JOBS = int(os.getenv("INGESTION_MAX_CONCURRENT_JOBS", "1"))
+    INGESTION_MAX_QUEUED_JOBS = int(os.getenv("INGESTION_MAX_QUEUED_JOBS", "10"))
+    INGESTION_JOB_TIMEOUT_SECONDS = float(os.getenv("INGESTION_JOB_TIMEOUT_SECONDS", "3600"))
+    INGESTION_JOBS_DIR = os.getenv("INGESTION_JOBS_DIR", os.path.join(tempfile.gettempdir(), "ingestion_jobs"))
+    # Container of the rubric CSV files, the SAS URLs of the files are signed with the key of the connection string
+    AZURE_STORAGE_CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+    AZURE_STORAGE_CONTAINER_RUBRIC = os.getenv("AZURE_STORAGE_CONTAINER_RUBRIC", "rubric")
+    RUBRIC_LISTING_CACHE_TTL_SECONDS = float(os.getenv("RUBRIC_LISTING_CACHE_TTL_SECONDS", "60"))
+    RUBRIC_SAS_TTL_SECONDS = float(os.getenv("RUBRIC_SAS_TTL_SECONDS", "3600"))
+    # Number of criteria of a rubric evaluated at once, requests can ask for fewer with the max_concurrent_criteria override
+    RUBRIC_MAX_CONCURRENT_CRITERIA = int(os.getenv("RUBRIC_MAX_CONCURRENT_CRITERIA", "5"))
+    # Whether criteria whose sources overlap are answered by one completion, requests can choose with the pack_criteria override
+    RUBRIC_PACK_CRITERIA = os.getenv("RUBRIC_PACK_CRITERIA", "").lower() == "true"
+    # SQLite file of the rubric answers, search queries and embeddings kept across runs, set RUBRIC_CACHE_PATH to enable it
+    RUBRIC_CACHE_PATH = os.getenv("RUBRIC_CACHE_PATH")
+    RUBRIC_CACHE_TTL_SECONDS = float(os.getenv("RUBRIC_CACHE_TTL_SECONDS", str(7 * 86400)))
+    # Background rubric jobs, RUBRIC_JOBS_DIR must survive restarts (e.g. under /home on App Service) to resume the jobs
+    RUBRIC_JOBS_DIR = os.getenv("RUBRIC_JOBS_DIR", os.path.join(tempfile.gettempdir(), "rubric_jobs"))
+    RUBRIC_MAX_CONCURRENT_JOBS = int(os.getenv("RUBRIC_MAX_CONCURRENT_JOBS", "1"))
+
     # Use the current user identity to authenticate with Azure OpenAI, AI Search and Blob Storage (no secrets needed,
     # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the
     # keys for each service
@@ -439,8 +622,13 @@ async def setup_clients():
         endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
         credential=azure_credential,
     )
+    # Content is streamed to the browser chunk by chunk, so keep the first and subsequent GETs small
+    # instead of the SDK default of buffering up to 32MB in the first request
     blob_client = BlobServiceClient(
-        account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", credential=azure_credential
+        account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
+        credential=azure_credential,
+        max_single_get_size=CONTENT_CHUNK_SIZE,
+        max_chunk_get_size=CONTENT_CHUNK_SIZE,
     )
     blob_container_client = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
 
@@ -453,6 +641,8 @@ async def setup_clients():
         client_app_id=AZURE_CLIENT_APP_ID,
         tenant_id=AZURE_AUTH_TENANT_ID,
         require_access_control=AZURE_ENFORCE_ACCESS_CONTROL,
+        max_workers=AZURE_AUTH_MAX_WORKERS,
+        groups_cache_ttl=AZURE_AUTH_GROUPS_CACHE_TTL_SECONDS,
     )
 
     vision_key = None
@@ -465,6 +655,14 @@ async def setup_clients():
         await key_vault_client.close()
 
     # Used by the OpenAI SDK
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY_SECONDS,
+        ),
+        timeout=DEFAULT_TIMEOUT,
+    )
     openai_client: AsyncOpenAI
 
     if OPENAI_HOST == "azure":
@@ -474,17 +672,83 @@ async def setup_clients():
             api_version="2023-07-01-preview",
             azure_endpoint=f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com",
             azure_ad_token_provider=token_provider,
+            http_client=http_client,
         )
     else:
         openai_client = AsyncOpenAI(
             api_key=OPENAI_API_KEY,
             organization=OPENAI_ORGANIZATION,
+            http_client=http_client,
         )
 
     current_app.config[CONFIG_OPENAI_CLIENT] = openai_client
     current_app.config[CONFIG_SEARCH_CLIENT] = search_client
     current_app.config[CONFIG_BLOB_CONTAINER_CLIENT] = blob_container_client
     current_app.config[CONFIG_AUTH_CLIENT] = auth_helper
+    if CONTENT_CACHE_MEMORY_MB > 0 or CONTENT_CACHE_DIR:
+        current_app.config[CONFIG_CONTENT_CACHE] = ContentCache(
+            max_memory_bytes=CONTENT_CACHE_MEMORY_MB * 1024 * 1024,
+            max_memory_entry_bytes=min(CONTENT_CACHE_ENTRY_MB, CONTENT_CACHE_MEMORY_MB) * 1024 * 1024,
+            disk_dir=CONTENT_CACHE_DIR,
+            max_disk_bytes=CONTENT_CACHE_DISK_MB * 1024 * 1024,
+        )
+
+    embedding_cache = None
+    if EMBEDDING_CACHE_MAX_ENTRIES > 0:
+        embedding_cache = EmbeddingCache(max_entries=EMBEDDING_CACHE_MAX_ENTRIES, ttl=EMBEDDING_CACHE_TTL_SECONDS)
+    current_app.config[CONFIG_EMBEDDING_CACHE] = embedding_cache
+    search_cache = None
+    if SEARCH_CACHE_MB > 0:
+        search_cache = SearchCache(max_bytes=SEARCH_CACHE_MB * 1024 * 1024, ttl=SEARCH_CACHE_TTL_SECONDS)
+    current_app.config[CONFIG_SEARCH_CACHE] = search_cache
+    answer_cache = None
+    if ANSWER_CACHE_MB > 0:
+        answer_cache = AnswerCache(max_bytes=ANSWER_CACHE_MB * 1024 * 1024, ttl=ANSWER_CACHE_TTL_SECONDS)
+    current_app.config[CONFIG_ANSWER_CACHE] = answer_cache
+    semantic_cache = None
+    if SEMANTIC_CACHE_MAX_ENTRIES > 0:
+        semantic_cache = SemanticAnswerCache(
+            max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+            ttl=SEMANTIC_CACHE_TTL_SECONDS,
+            threshold=SEMANTIC_CACHE_THRESHOLD,
+            sample_rate=SEMANTIC_CACHE_SAMPLE_RATE,
+        )
+    current_app.config[CONFIG_SEMANTIC_CACHE] = semantic_cache
+    image_cache = None
+    if USE_GPT4V and IMAGE_CACHE_MB > 0:
+        image_cache = ImageCache(max_bytes=IMAGE_CACHE_MB * 1024 * 1024)
+    current_app.config[CONFIG_IMAGE_CACHE] = image_cache
+    vision_session = None
+    if USE_GPT4V:
+        # Used by the vision approaches to call Computer Vision, pooled across requests
+        vision_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=VISION_MAX_CONNECTIONS))
+    current_app.config[CONFIG_VISION_SESSION] = vision_session
+    rubric_cache = None
+    if RUBRIC_CACHE_PATH:
+        rubric_cache = RubricCache(SQLiteRubricCacheStore(RUBRIC_CACHE_PATH, ttl=RUBRIC_CACHE_TTL_SECONDS))
+    current_app.config[CONFIG_RUBRIC_CACHE] = rubric_cache
+    ingestion_queue = IngestionQueue(
+        jobs_dir=INGESTION_JOBS_DIR,
+        max_concurrent_jobs=INGESTION_MAX_CONCURRENT_JOBS,
+        max_queued_jobs=INGESTION_MAX_QUEUED_JOBS,
+        timeout=INGESTION_JOB_TIMEOUT_SECONDS,
+        on_success=invalidate_index_caches,
+    )
+    ingestion_queue.start()
+    current_app.config[CONFIG_INGESTION_QUEUE] = ingestion_queue
+    if AZURE_STORAGE_CONNECTION_STRING:
+        current_app.config[CONFIG_RUBRIC_STORE] = RubricStore(
+            connection_string=AZURE_STORAGE_CONNECTION_STRING,
+            container_name=AZURE_STORAGE_CONTAINER_RUBRIC,
+            listing_ttl=RUBRIC_LISTING_CACHE_TTL_SECONDS,
+            sas_ttl=RUBRIC_SAS_TTL_SECONDS,
+        )
+
+    rubric_job_runner = RubricJobRunner(
+        jobs_dir=RUBRIC_JOBS_DIR, evaluate=evaluate_rubric_job, max_concurrent_jobs=RUBRIC_MAX_CONCURRENT_JOBS
+    )
+    rubric_job_runner.start()
+    current_app.config[CONFIG_RUBRIC_JOB_RUNNER] = rubric_job_runner
 
     current_app.config[CONFIG_GPT4V_DEPLOYED] = bool(USE_GPT4V)
 
@@ -502,6 +766,12 @@ async def setup_clients():
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        embedding_cache=embedding_cache,
+        search_cache=search_cache,
+        answer_cache=answer_cache,
+        semantic_cache=semantic_cache,
+        sources_token_fraction=SOURCES_TOKEN_FRACTION,
+        table_format=SOURCES_TABLE_FORMAT,
     )
 
     if USE_GPT4V:
@@ -523,6 +793,15 @@ async def setup_clients():
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
+            embedding_cache=embedding_cache,
+            search_cache=search_cache,
+            answer_cache=answer_cache,
+            semantic_cache=semantic_cache,
+            image_cache=image_cache,
+            max_concurrent_image_fetches=IMAGE_FETCH_MAX_CONCURRENCY,
+            vision_session=vision_session,
+            sources_token_fraction=SOURCES_TOKEN_FRACTION,
+            table_format=SOURCES_TABLE_FORMAT,
         )
 
         current_app.config[CONFIG_CHAT_VISION_APPROACH] = ChatReadRetrieveReadVisionApproach(
@@ -540,6 +819,15 @@ async def setup_clients():
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
+            embedding_cache=embedding_cache,
+            search_cache=search_cache,
+            answer_cache=answer_cache,
+            semantic_cache=semantic_cache,
+            image_cache=image_cache,
+            max_concurrent_image_fetches=IMAGE_FETCH_MAX_CONCURRENCY,
+            vision_session=vision_session,
+            sources_token_fraction=SOURCES_TOKEN_FRACTION,
+            table_format=SOURCES_TABLE_FORMAT,
         )
 
     current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
@@ -554,6 +842,34 @@ async def setup_clients():
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        embedding_cache=embedding_cache,
+        search_cache=search_cache,
+        answer_cache=answer_cache,
+        semantic_cache=semantic_cache,
+        speculative_retrieval=CHAT_SPECULATIVE_RETRIEVAL,
+        skip_query_rewrite=CHAT_SKIP_QUERY_REWRITE,
+        skip_query_rewrite_max_words=CHAT_SKIP_QUERY_REWRITE_MAX_WORDS,
+        sources_token_fraction=SOURCES_TOKEN_FRACTION,
+        table_format=SOURCES_TABLE_FORMAT,
+    )
+
+    current_app.config[CONFIG_RUBRIC_APPROACH] = RubricEvaluationApproach(
+        search_client=search_client,
+        openai_client=openai_client,
+        auth_helper=auth_helper,
+        chatgpt_model=OPENAI_CHATGPT_MODEL,
+        chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
+        embedding_model=OPENAI_EMB_MODEL,
+        embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
+        sourcepage_field=KB_FIELDS_SOURCEPAGE,
+        content_field=KB_FIELDS_CONTENT,
+        query_language=AZURE_SEARCH_QUERY_LANGUAGE,
+        query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        max_concurrent_criteria=RUBRIC_MAX_CONCURRENT_CRITERIA,
+        pack_criteria=RUBRIC_PACK_CRITERIA,
+        rubric_cache=rubric_cache,
+        embedding_cache=embedding_cache,
+        search_cache=search_cache,
     )
 
 @bp.route("/api/rubric-evaluation", methods=["POST"])
@@ -566,7 +882,7 @@ async def evaluate_rubric():
     auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
     context["auth_claims"] = await auth_helper.get_auth_claims_if_enabled(request.headers)
     try:
-        rubric_evaluation_approach = current_app.config["rubric_evaluation_approach"]
+        rubric_evaluation_approach = current_app.config[CONFIG_RUBRIC_APPROACH]
 
         rubric_criteria = request_json["rubric_criteria"]  
         messages = request_json.get("messages")  
@@ -577,7 +893,10 @@ async def evaluate_rubric():
         messages = [{"role": msg["role"], "content": msg["content"]} for msg in messages]  
         
         print("Calling RubricEvaluationApproach.run method in test function")  
-        rubric_answers = await rubric_evaluation_approach.run(rubric_criteria, messages, context=context)  
+        # With "stream", an event is sent for each criterion as soon as it is evaluated, tagged with its index
+        rubric_answers = await rubric_evaluation_approach.run(
+            rubric_criteria, messages, stream=request_json.get("stream", False), context=context
+        )
 
         if isinstance(rubric_answers, dict):
             return jsonify(rubric_answers)
@@ -590,10 +909,82 @@ async def evaluate_rubric():
         return error_response(error, "/evaluate_rubric")
 
 
+async def evaluate_rubric_job(criteria: list[str], context: dict[str, Any]) -> AsyncGenerator[dict[str, Any], None]:
+    rubric_evaluation_approach: RubricEvaluationApproach = current_app.config[CONFIG_RUBRIC_APPROACH]
+    events = await rubric_evaluation_approach.run(criteria, [], stream=True, context=context)
+    return cast(AsyncGenerator[dict[str, Any], None], events)
+
+
+# Rubrics too large to be evaluated within a request run as background jobs, whose progress is reported by
+# /rubric_jobs/<job_id> and whose results are downloaded from /rubric_jobs/<job_id>/results.csv
+@bp.route("/rubric_jobs", methods=["POST"])
+async def create_rubric_job():
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 415
+    request_json = await request.get_json()
+    auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
+    auth_claims = await auth_helper.get_auth_claims_if_enabled(request.headers)
+    rubric = secure_filename(request_json.get("rubric") or DEFAULT_RUBRIC_FILE)
+    overrides = request_json.get("overrides", {})
+    # The documents the criteria are evaluated against, all documents by default
+    if sourcefiles := request_json.get("sourcefiles"):
+        overrides["include_sourcefiles"] = sourcefiles
+    try:
+        criteria = await get_rubric_store().load_criteria(rubric)
+    except ResourceNotFoundError:
+        return jsonify({"error": f"Rubric {rubric} not found"}), 404
+    if not criteria:
+        return jsonify({"error": f"Rubric {rubric} has no criteria"}), 400
+
+    rubric_job_runner: RubricJobRunner = current_app.config[CONFIG_RUBRIC_JOB_RUNNER]
+    job = rubric_job_runner.create_job(rubric, criteria, overrides, auth_claims)
+    return jsonify(job.to_dict()), 202
+
+
+async def get_rubric_job(job_id: str) -> RubricJob:
+    rubric_job_runner: RubricJobRunner = current_app.config[CONFIG_RUBRIC_JOB_RUNNER]
+    job = rubric_job_runner.get(job_id)
+    auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
+    auth_claims = await auth_helper.get_auth_claims_if_enabled(request.headers)
+    # Only the user who created a job can see it
+    if job is None or job.auth_claims.get("oid") != auth_claims.get("oid"):
+        abort(404)
+    return job
+
+
+@bp.route("/rubric_jobs/<job_id>", methods=["GET"])
+async def rubric_job_status(job_id: str):
+    job = await get_rubric_job(job_id)
+    return jsonify(job.to_dict())
+
+
+@bp.route("/rubric_jobs/<job_id>/results.csv", methods=["GET"])
+async def rubric_job_results(job_id: str):
+    job = await get_rubric_job(job_id)
+    rubric_job_runner: RubricJobRunner = current_app.config[CONFIG_RUBRIC_JOB_RUNNER]
+    response = await make_response(rubric_job_runner.to_csv(job))
+    response.mimetype = "text/csv"
+    response.headers["Content-Disposition"] = f'attachment; filename="{os.path.splitext(job.rubric)[0]}_results.csv"'
+    return response
+
+
 @bp.after_app_serving
 async def close_clients():
+    logging.info("Cache stats: %s", json.dumps(get_cache_stats()))
     await current_app.config[CONFIG_SEARCH_CLIENT].close()
+    await current_app.config[CONFIG_OPENAI_CLIENT].close()
     await current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].close()
+    if content_cache := current_app.config.get(CONFIG_CONTENT_CACHE):
+        await content_cache.close()
+    if vision_session := current_app.config.get(CONFIG_VISION_SESSION):
+        await vision_session.close()
+    await current_app.config[CONFIG_AUTH_CLIENT].close()
+    await current_app.config[CONFIG_INGESTION_QUEUE].close()
+    await current_app.config[CONFIG_RUBRIC_JOB_RUNNER].close()
+    if rubric_store := current_app.config.get(CONFIG_RUBRIC_STORE):
+        await rubric_store.close()
+    if rubric_cache := current_app.config.get(CONFIG_RUBRIC_CACHE):
+        await rubric_cache.close()
 
 
 def create_app():
@@ -1,34 +1,105 @@
+import asyncio
 import json
 import logging
 import re
+import time
+from dataclasses import asdict, dataclass
 from typing import Any, AsyncGenerator, Optional, Union
 
-import openai
+import numpy as np
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import QueryType, RawVectorQuery, VectorQuery
+from azure.search.documents.models import RawVectorQuery, VectorQuery
+from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletion
 
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.retrievethenread import RetrieveThenReadApproach
+from core.authentication import AuthenticationHelper
+from core.embeddingcache import EmbeddingCache
 from core.messagebuilder import MessageBuilder
-from core.modelhelper import get_token_limit
-from text import nonewlines
+from core.modelhelper import get_token_limit, num_tokens_from_messages
+from core.rubriccache import RubricCache
+from core.searchcache import SearchCache
+
+
+@dataclass
+class RetrievalGroup:
+    """The criteria, by index, that share the documents retrieved for one search query"""
+
+    search_query: str
+    indexes: list[int]
+    vector: Optional[VectorQuery] = None
+
+
+@dataclass
+class CriteriaPack:
+    """The criteria, by index, answered by one completion, the union of their sources and its prompt tokens"""
+
+    indexes: list[int]
+    sources: list[str]
+    tokens: int = 0
+
+
+@dataclass
+class AnswerUsage:
+    """The completions that answered the criteria of a rubric and their tokens"""
+
+    completions: int = 0
+    # Criteria answered from the rubric cache, without any completion
+    cached_answers: int = 0
+    packed_completions: int = 0
+    packed_criteria: int = 0
+    # Criteria of a pack whose answer was missing or could not be parsed, and were answered on their own
+    fallbacks: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    def add(self, chat_completion: ChatCompletion, packed_criteria: int = 0):
+        self.completions += 1
+        if packed_criteria:
+            self.packed_completions += 1
+            self.packed_criteria += packed_criteria
+        if chat_completion.usage:
+            self.prompt_tokens += chat_completion.usage.prompt_tokens
+            self.completion_tokens += chat_completion.usage.completion_tokens
+
 
 class RubricEvaluationApproach(ChatReadRetrieveReadApproach, RetrieveThenReadApproach):
+    # The answers are grounded like those of RetrieveThenReadApproach, rather than the chat
+    default_temperature = 0.3
+
+    # Appended to the system prompt when several criteria are answered by one completion
+    packed_answer_instructions = """
+Several numbered criteria are evaluated at once against the same sources. Answer each criterion on its own, following the rules above, and keep its source citations.
+Reply only with a JSON object of the form {"answers": [{"criterion": 1, "answer": "..."}]}, with one entry for each criterion."""
+    # Completion tokens reserved for the answer to each criterion of a pack
+    packed_answer_tokens = 256
+
     def __init__(
         self,
+        *,
         search_client: SearchClient,
-        openai_host: str,
-        chatgpt_deployment: Optional[str],
+        auth_helper: AuthenticationHelper,
+        openai_client: AsyncOpenAI,
         chatgpt_model: str,
-        embedding_deployment: Optional[str],
+        chatgpt_deployment: Optional[str],  # Not needed for non-Azure OpenAI
         embedding_model: str,
+        embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
         sourcepage_field: str,
         content_field: str,
         query_language: str,
         query_speller: str,
+        max_concurrent_criteria: int = 5,
+        query_similarity_threshold: float = 0.97,
+        pack_criteria: bool = False,
+        max_criteria_per_pack: int = 8,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        search_cache: Optional[SearchCache] = None,
+        rubric_cache: Optional[RubricCache] = None,
     ):
         self.search_client = search_client
-        self.openai_host = openai_host
+        self.auth_helper = auth_helper
+        self.openai_client = openai_client
         self.chatgpt_deployment = chatgpt_deployment
         self.chatgpt_model = chatgpt_model
         self.embedding_deployment = embedding_deployment
@@ -38,45 +109,391 @@ class RubricEvaluationApproach(ChatReadRetrieveReadApproach, RetrieveThenReadApp
         self.query_language = query_language
         self.query_speller = query_speller
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
-        self.logger = logging.getLogger(__name__)  
-
-    async def run(  
-        self,  
-        rubric_criteria: list[str],  
-        messages: list[dict],  
-        stream: bool = False,  
-        session_state: Any = None,  
-        context: dict[str, Any] = {},  
+        self.max_concurrent_criteria = max_concurrent_criteria
+        # Minimum cosine similarity between the embeddings of two search queries to search only once for both
+        self.query_similarity_threshold = query_similarity_threshold
+        # Whether criteria with overlapping sources are answered together, unless the request says otherwise
+        self.pack_criteria = pack_criteria
+        self.max_criteria_per_pack = max_criteria_per_pack
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.rubric_cache = rubric_cache
+        self.logger = logging.getLogger(__name__)
+
+    async def run(
+        self,
+        rubric_criteria: list[str],
+        messages: list[dict],
+        stream: bool = False,
+        session_state: Any = None,
+        context: dict[str, Any] = {},
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
-            
-        print("Rubric criteria:", rubric_criteria)  
-        print("Messages:", messages)  
-        print("Context:", context)  
-        
-        rubric_answers = []  # Initialize the rubric_answers variable here
-
-        for criterion in rubric_criteria:  
-            # a. Use the existing chatbot functionality to generate a search query for the current criterion  
-            search_query = await self.generate_search_query(criterion, messages, context)  
-                
-            # b. Retrieve relevant documents from the search index using the generated search query  
-            search_results = await self.retrieve_documents(search_query, context)  
-                
-            # c. Generate a contextual and content-specific answer using the search results and chat history  
-            answer = await self.generate_answer(criterion, search_results, messages, context)  
-                
-            # d. Store the generated answer for the current criterion  
-            rubric_answers.append(answer)  
-
-        return {"rubric_answers": rubric_answers}  # Return a dictionary with the rubric_answers key  
-    
-    async def generate_search_query(self, criterion: str, messages: list[dict], context: dict[str, Any]) -> str:
-        # Use the ChatReadRetrieveReadApproach's get_search_query method as a reference
-        # You can modify the method to accept the criterion as a parameter and use it to generate the search query
+        self.logger.debug("Evaluating %d rubric criteria", len(rubric_criteria))
+        overrides = context.get("overrides", {})
+        # Number of criteria evaluated at once for this request, never more than the limit of the app
+        max_concurrency = min(
+            overrides.get("max_concurrent_criteria") or self.max_concurrent_criteria, self.max_concurrent_criteria
+        )
+        events = self.evaluate_criteria(rubric_criteria, messages, context, max(max_concurrency, 1))
+        if stream:
+            return events
+
+        rubric_answers: list[Optional[str]] = [None] * len(rubric_criteria)
+        errors = []
+        retrieval_stats: dict[str, int] = {}
+        usage: dict[str, Any] = {}
+        async for event in events:
+            if "retrieval" in event:
+                retrieval_stats = event["retrieval"]
+            elif "usage" in event:
+                usage = event["usage"]
+            elif "error" in event:
+                errors.append(event)
+            else:
+                rubric_answers[event["index"]] = event["answer"]
+        return {"rubric_answers": rubric_answers, "errors": errors, "retrieval": retrieval_stats, "usage": usage}
+
+    async def evaluate_criteria(
+        self, rubric_criteria: list[str], messages: list[dict], context: dict[str, Any], max_concurrency: int
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        """
+        Evaluates the criteria concurrently, at most max_concurrency calls at a time, and yields an event for each
+        criterion as soon as it is evaluated, tagged with its index in rubric_criteria. A criterion that fails yields an
+        event with the type of the error instead of an answer, the other criteria are still evaluated.
+        The search queries of all criteria are generated first, so that plan_retrieval() can embed them in one request
+        and search once for the criteria that ask the same thing. An event with the retrieval statistics of the rubric
+        comes before the answers.
+        With the pack_criteria override, criteria whose sources overlap are answered together by one completion, see
+        pack_criteria_by_sources(). The last event reports the answer completions, their tokens and the seconds the
+        rubric took.
+        With a rubric cache, the criteria answered before against the same documents are answered from the cache first,
+        with "cached" set in their events, and only the other criteria are evaluated.
+        """
+        start = time.monotonic()
+        overrides = context.get("overrides", {})
+        usage = AnswerUsage()
+        answer_keys: list[str] = []
+        pending = list(range(len(rubric_criteria)))
+        if self.rubric_cache:
+            filter = self.build_filter(overrides, context.get("auth_claims", {}))
+            answer_keys = await self.rubric_cache.make_answer_keys(rubric_criteria, messages, overrides, filter)
+            cached_answers = await self.rubric_cache.get_answers(answer_keys)
+            pending = [index for index, key in enumerate(answer_keys) if key not in cached_answers]
+            for index, key in enumerate(answer_keys):
+                if key in cached_answers:
+                    usage.cached_answers += 1
+                    yield {
+                        "index": index,
+                        "criterion": rubric_criteria[index],
+                        "answer": cached_answers[key],
+                        "cached": True,
+                    }
+
+        if pending:
+            events = self.evaluate_pending_criteria(
+                rubric_criteria, pending, messages, context, asyncio.Semaphore(max_concurrency), usage, answer_keys
+            )
+            async for event in events:
+                yield event
+        yield {"usage": {**asdict(usage), "seconds": round(time.monotonic() - start, 3)}}
+
+    async def evaluate_pending_criteria(
+        self,
+        rubric_criteria: list[str],
+        pending: list[int],
+        messages: list[dict],
+        context: dict[str, Any],
+        semaphore: asyncio.Semaphore,
+        usage: AnswerUsage,
+        answer_keys: list[str],
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        """
+        Evaluates the criteria of rubric_criteria whose indexes are pending, see evaluate_criteria(). The answers are
+        added to the rubric cache, under their key in answer_keys.
+        """
+        overrides = context.get("overrides", {})
+
+        def error_event(index: int, error: Exception) -> dict[str, Any]:
+            self.logger.error("Rubric criterion %d failed", index, exc_info=error)
+            return {"index": index, "criterion": rubric_criteria[index], "error": type(error).__name__}
+
+        async def answer_event(index: int, answer: str, search_results: list[str]) -> dict[str, Any]:
+            if self.rubric_cache:
+                await self.rubric_cache.set_answer(answer_keys[index], answer, search_results)
+            return {"index": index, "criterion": rubric_criteria[index], "answer": answer}
+
+        # a. Use the existing chatbot functionality to generate a search query for each criterion
+        model = self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model
+        cached_queries: dict[str, str] = {}
+        if self.rubric_cache:
+            cached_queries = await self.rubric_cache.get_search_queries(
+                [rubric_criteria[index] for index in pending], messages, model
+            )
+
+        async def generate_search_query(criterion: str) -> str:
+            if criterion in cached_queries:
+                return cached_queries[criterion]
+            async with semaphore:
+                search_query = await self.generate_search_query(criterion, messages, context)
+            if self.rubric_cache:
+                await self.rubric_cache.set_search_query(criterion, messages, model, search_query)
+            return search_query
+
+        search_queries = await asyncio.gather(
+            *(generate_search_query(rubric_criteria[index]) for index in pending), return_exceptions=True
+        )
+        queries: dict[int, str] = {}
+        for index, search_query in zip(pending, search_queries):
+            if isinstance(search_query, Exception):
+                yield error_event(index, search_query)
+            elif isinstance(search_query, str):
+                queries[index] = search_query
+        if not queries:
+            return
+
+        # b. Retrieve the relevant documents once for each group of criteria with the same search query
+        try:
+            groups, retrieval_stats = await self.plan_retrieval(queries, context)
+        except Exception as error:
+            for index in queries:
+                yield error_event(index, error)
+            return
+        yield {"retrieval": retrieval_stats}
+
+        async def retrieve_documents(group: RetrievalGroup) -> list[str]:
+            async with semaphore:
+                return await self.retrieve_documents(group.search_query, context, group.vector)
+
+        # c. Generate a contextual and content-specific answer using the search results and chat history
+        async def answer(index: int, search_results: list[str]) -> dict[str, Any]:
+            try:
+                async with semaphore:
+                    answer = await self.generate_answer(
+                        rubric_criteria[index], search_results, messages, context, usage=usage
+                    )
+                return await answer_event(index, answer, search_results)
+            except Exception as error:
+                return error_event(index, error)
 
+        async def evaluate(index: int, search: asyncio.Task) -> list[dict[str, Any]]:
+            try:
+                search_results = await search
+            except Exception as error:
+                return [error_event(index, error)]
+            return [await answer(index, search_results)]
+
+        sources: dict[int, list[str]] = {}
+
+        async def evaluate_pack(pack: CriteriaPack) -> list[dict[str, Any]]:
+            if len(pack.indexes) == 1:
+                return [await answer(pack.indexes[0], pack.sources)]
+            try:
+                async with semaphore:
+                    answers = await self.generate_packed_answers(
+                        [rubric_criteria[index] for index in pack.indexes], pack.sources, context, usage
+                    )
+            except Exception:
+                self.logger.exception("Rubric criteria %s failed to be answered together", pack.indexes)
+                answers = [None] * len(pack.indexes)
+            events = [
+                await answer_event(index, packed_answer, sources[index])
+                for index, packed_answer in zip(pack.indexes, answers)
+                if packed_answer is not None
+            ]
+            fallbacks = [index for index, packed_answer in zip(pack.indexes, answers) if packed_answer is None]
+            usage.fallbacks += len(fallbacks)
+            return events + list(await asyncio.gather(*(answer(index, sources[index]) for index in fallbacks)))
+
+        searches = [asyncio.create_task(retrieve_documents(group)) for group in groups]
+        tasks: list[asyncio.Task] = []
+        try:
+            if overrides.get("pack_criteria", self.pack_criteria):
+                # The packs depend on the sources of all the criteria
+                search_results = await asyncio.gather(*searches, return_exceptions=True)
+                for group, results in zip(groups, search_results):
+                    for index in group.indexes:
+                        if isinstance(results, Exception):
+                            yield error_event(index, results)
+                        elif isinstance(results, list):
+                            sources[index] = results
+                packs = self.pack_criteria_by_sources(rubric_criteria, sources, overrides)
+                tasks = [asyncio.create_task(evaluate_pack(pack)) for pack in packs]
+            else:
+                tasks = [
+                    asyncio.create_task(evaluate(index, search))
+                    for group, search in zip(groups, searches)
+                    for index in group.indexes
+                ]
+            for task in asyncio.as_completed(tasks):
+                for event in await task:
+                    yield event
+        finally:
+            # Stops the remaining criteria when the client goes away
+            for search in searches:
+                search.cancel()
+            for task in tasks:
+                task.cancel()
+
+    async def plan_retrieval(
+        self, queries: dict[int, str], context: dict[str, Any]
+    ) -> tuple[list[RetrievalGroup], dict[str, int]]:
+        """
+        Groups the criteria, given as a map from their index to their search query, by search query. Queries that
+        only differ in case, punctuation or spacing are the same query. With vectors, the remaining queries are
+        embedded in a single request and a query whose embedding is within query_similarity_threshold of an earlier
+        one is merged into its group. Returns the groups and the number of calls they need and save.
+        """
+        overrides = context.get("overrides", {})
+        has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
+
+        groups: dict[str, RetrievalGroup] = {}
+        for index, search_query in queries.items():
+            key = " ".join(re.findall(r"\w+", search_query.lower())) or search_query
+            if key in groups:
+                groups[key].indexes.append(index)
+            else:
+                groups[key] = RetrievalGroup(search_query, [index])
+        planned = list(groups.values())
+
+        embedding_calls = 0
+        if has_vector:
+            vectors, embedding_calls = await self.embed_search_queries([group.search_query for group in planned])
+            embeddings = np.array([vector.vector for vector in vectors], dtype=np.float32)
+            embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+            similarities = embeddings @ embeddings.T
+            merged: list[RetrievalGroup] = []
+            kept: list[int] = []
+            for i, (group, vector) in enumerate(zip(planned, vectors)):
+                closest = max(kept, key=lambda j: similarities[i, j], default=None)
+                if closest is not None and similarities[i, closest] >= self.query_similarity_threshold:
+                    merged[kept.index(closest)].indexes.extend(group.indexes)
+                else:
+                    group.vector = vector
+                    merged.append(group)
+                    kept.append(i)
+            planned = merged
+
+        # The calls that one embedding request and one search per criterion would have made, and those made instead
+        retrieval_stats = {
+            "queries": len(queries),
+            "unique_queries": len(planned),
+            "embedding_calls": embedding_calls,
+            "embedding_calls_saved": len(queries) - embedding_calls if has_vector else 0,
+            "search_calls": len(planned),
+            "search_calls_saved": len(queries) - len(planned),
+        }
+        return planned, retrieval_stats
+
+    async def embed_search_queries(self, search_queries: list[str]) -> tuple[list[RawVectorQuery], int]:
+        """
+        Embeds the search queries that are not in the rubric cache with one request, and returns the embeddings of all
+        of them along with the number of requests made.
+        """
+        model = self.embedding_deployment if self.embedding_deployment else self.embedding_model
+        embeddings = await self.rubric_cache.get_embeddings(model, search_queries) if self.rubric_cache else {}
+        missing = [search_query for search_query in search_queries if search_query not in embeddings]
+        if missing:
+            for search_query, vector in zip(missing, await self.compute_text_embeddings(missing)):
+                embeddings[search_query] = vector.vector or []
+                if self.rubric_cache:
+                    await self.rubric_cache.set_embedding(model, search_query, embeddings[search_query])
+        vectors = [
+            RawVectorQuery(vector=embeddings[search_query], k=50, fields="embedding") for search_query in search_queries
+        ]
+        return vectors, 1 if missing else 0
+
+    def pack_criteria_by_sources(
+        self, rubric_criteria: list[str], sources: dict[int, list[str]], overrides: dict[str, Any]
+    ) -> list[CriteriaPack]:
+        """
+        Packs the criteria, given as a map from their index to their sources, so that each criterion shares at least
+        one source with the others of its pack. A criterion joins the pack it shares the most sources with, as long as
+        the prompt and the answers of the pack stay within the token limit of the model and the pack has fewer than
+        max_criteria_per_pack criteria, otherwise it starts a new pack.
+        """
+
+        def count_tokens(text: str) -> int:
+            return num_tokens_from_messages({"role": "user", "content": text}, self.chatgpt_model)
+
+        template = overrides.get("prompt_template") or self.system_chat_template
+        budget = self.chatgpt_token_limit - count_tokens(template + self.packed_answer_instructions)
+        source_tokens: dict[str, int] = {}
+        packs: list[CriteriaPack] = []
+        for index in sorted(sources):
+            criterion_sources = list(dict.fromkeys(sources[index]))
+            for source in criterion_sources:
+                if source not in source_tokens:
+                    source_tokens[source] = count_tokens(source)
+            criterion_tokens = count_tokens(rubric_criteria[index]) + self.packed_answer_tokens
+
+            best: Optional[tuple[int, int, CriteriaPack]] = None
+            for pack in packs:
+                shared = len(set(pack.sources).intersection(criterion_sources))
+                if not shared or len(pack.indexes) >= self.max_criteria_per_pack:
+                    continue
+                new_sources = [source for source in criterion_sources if source not in pack.sources]
+                tokens = pack.tokens + criterion_tokens + sum(source_tokens[source] for source in new_sources)
+                if tokens <= budget and (best is None or shared > best[0]):
+                    best = (shared, tokens, pack)
+            if best is None:
+                tokens = criterion_tokens + sum(source_tokens[source] for source in criterion_sources)
+                packs.append(CriteriaPack([index], criterion_sources, tokens))
+            else:
+                _, tokens, pack = best
+                pack.indexes.append(index)
+                pack.sources.extend(source for source in criterion_sources if source not in pack.sources)
+                pack.tokens = tokens
+        return packs
+
+    async def generate_packed_answers(
+        self, criteria: list[str], search_results: list[str], context: dict[str, Any], usage: AnswerUsage
+    ) -> list[Optional[str]]:
+        """
+        Answers several criteria with one completion, and returns the answers in the order of the criteria, with None
+        for the criteria whose answer is missing from the completion.
+        """
+        overrides = context.get("overrides", {})
+        content = "\n".join(search_results)
+        numbered_criteria = "\n".join(f"{number}. {criterion}" for number, criterion in enumerate(criteria, 1))
+
+        message_builder = MessageBuilder(
+            (overrides.get("prompt_template") or self.system_chat_template) + self.packed_answer_instructions,
+            self.chatgpt_model,
+        )
+        message_builder.insert_message("user", f"Criteria:\n{numbered_criteria}\nSources:\n {content}")
+
+        chat_completion = await self.openai_client.chat.completions.create(
+            # Azure Open AI takes the deployment name as the model name
+            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+            messages=message_builder.messages,  # type: ignore
+            temperature=self.get_temperature(overrides),
+            max_tokens=self.packed_answer_tokens * len(criteria),
+            n=1,
+        )
+        usage.add(chat_completion, packed_criteria=len(criteria))
+        return self.parse_packed_answers(chat_completion.choices[0].message.content or "", len(criteria))
+
+    def parse_packed_answers(self, content: str, count: int) -> list[Optional[str]]:
+        answers: list[Optional[str]] = [None] * count
+        # The model sometimes wraps the JSON object in a code block
+        match = re.search(r"\{.*\}", content, re.DOTALL)
+        try:
+            parsed = json.loads(match.group(0)) if match else None
+        except json.JSONDecodeError:
+            return answers
+        items = parsed.get("answers") if isinstance(parsed, dict) else None
+        for item in items if isinstance(items, list) else []:
+            if not isinstance(item, dict):
+                continue
+            number, answer = item.get("criterion"), item.get("answer")
+            if isinstance(number, int) and 1 <= number <= count and isinstance(answer, str) and answer.strip():
+                answers[number - 1] = answer.strip()
+        return answers
+
+    async def generate_search_query(self, criterion: str, messages: list[dict], context: dict[str, Any]) -> str:
         user_query_request = "Generate search query for: " + criterion
 
-        messages = self.get_messages_from_history(
+        query_messages = self.get_messages_from_history(
             system_prompt=self.query_prompt_template,
             model_id=self.chatgpt_model,
             history=messages,
@@ -85,27 +502,25 @@ class RubricEvaluationApproach(ChatReadRetrieveReadApproach, RetrieveThenReadApp
             few_shots=self.query_prompt_few_shots,
         )
 
-        chatgpt_args = {"deployment_id": self.chatgpt_deployment} if self.openai_host == "azure" else {}
-        chat_completion = await openai.ChatCompletion.acreate(
-            **chatgpt_args,
-            model=self.chatgpt_model,
-            messages=messages,
+        chat_completion = await self.openai_client.chat.completions.create(
+            messages=query_messages,
+            # Azure Open AI takes the deployment name as the model name
+            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
             temperature=0.0,
             max_tokens=1024,  # Setting too low risks malformed JSON, setting too high may affect performance
             n=1,
         )
 
-        query_text = chat_completion["choices"][0]["message"]["content"].strip()
-        return query_text
-    
-    async def retrieve_documents(self, search_query: str, context: dict[str, Any]) -> list[str]:
-        # Use the RetrieveThenReadApproach's run method as a reference
-        # You can modify the method to accept the search_query as a parameter and use it to retrieve the documents
+        return (chat_completion.choices[0].message.content or criterion).strip()
 
+    async def retrieve_documents(
+        self, search_query: str, context: dict[str, Any], vector: Optional[VectorQuery] = None
+    ) -> list[str]:
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
+        use_semantic_ranker = True if overrides.get("semantic_ranker") and has_text else False
         use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
         top = overrides.get("top", 3)
         filter = self.build_filter(overrides, auth_claims)
@@ -113,57 +528,26 @@ class RubricEvaluationApproach(ChatReadRetrieveReadApproach, RetrieveThenReadApp
         # If retrieval mode includes vectors, compute an embedding for the query
         vectors: list[VectorQuery] = []
         if has_vector:
-            embedding_args = {"deployment_id": self.embedding_deployment} if self.openai_host == "azure" else {}
-            embedding = await openai.Embedding.acreate(**embedding_args, model=self.embedding_model, input=search_query)
-            query_vector = embedding["data"][0]["embedding"]
-            vectors.append(RawVectorQuery(vector=query_vector, k=50, fields="embedding"))
+            vectors.append(vector or await self.compute_text_embedding(search_query))
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
-        query_text = search_query if has_text else ""
-
-        # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(
-                query_text,
-                filter=filter,
-                query_type=QueryType.SEMANTIC,
-                query_language=self.query_language,
-                query_speller=self.query_speller,
-                semantic_configuration_name="default",
-                top=top,
-                query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                vector_queries=vectors,
-            )
-        else:
-            r = await self.search_client.search(
-                query_text,
-                filter=filter,
-                top=top,
-                vector_queries=vectors,
-            )
-        if use_semantic_captions:
-            results = [
-                doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
-                async for doc in r
-            ]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
-        content = "\n".join(results)
+        query_text = search_query if has_text else None
+
+        results = await self.search(top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions)
+        return self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
 
-        return content.split('\n')
-    
     async def generate_answer(
-        self, criterion: str, search_results: list[str], messages: list[dict], context: dict[str, Any]
+        self,
+        criterion: str,
+        search_results: list[str],
+        messages: list[dict],
+        context: dict[str, Any],
+        usage: Optional[AnswerUsage] = None,
     ) -> str:
-        # Use the RetrieveThenReadApproach's run method as a reference
-        # You can modify the method to accept the criterion and search_results as parameters and use them to generate the answer
-
         overrides = context.get("overrides", {})
         content = "\n".join(search_results)
 
-        message_builder = MessageBuilder(
-            overrides.get("prompt_template") or self.system_chat_template, self.chatgpt_model
-        )
+        message_builder = MessageBuilder(overrides.get("prompt_template") or self.system_chat_template, self.chatgpt_model)
 
         # Add user question
         user_content = criterion + "\n" + f"Sources:\n {content}"
@@ -173,16 +557,15 @@ class RubricEvaluationApproach(ChatReadRetrieveReadApproach, RetrieveThenReadApp
         message_builder.insert_message("assistant", self.answer)
         message_builder.insert_message("user", self.question)
 
-        messages = message_builder.messages
-        chatgpt_args = {"deployment_id": self.chatgpt_deployment} if self.openai_host == "azure" else {}
-        chat_completion = await openai.ChatCompletion.acreate(
-            **chatgpt_args,
-            model=self.chatgpt_model,
-            messages=messages,
-            temperature=overrides.get("temperature") or 0.3,
+        chat_completion = await self.openai_client.chat.completions.create(
+            # Azure Open AI takes the deployment name as the model name
+            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+            messages=message_builder.messages,  # type: ignore
+            temperature=self.get_temperature(overrides),
             max_tokens=1024,
             n=1,
         )
+        if usage is not None:
+            usage.add(chat_completion)
 
-        answer = chat_completion["choices"][0]["message"]["content"].strip()
-        return answer
\ No newline at end of file
+        return (chat_completion.choices[0].message.content or "").strip()
@@ -1,8 +1,12 @@
+import asyncio
 import os
-from dataclasses import dataclass
+import re
+import time
+from dataclasses import dataclass, replace
 from typing import Any, AsyncGenerator, List, Optional, Union, cast
 
 import aiohttp
+import tiktoken
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import (
     CaptionResult,
@@ -12,8 +16,14 @@ from azure.search.documents.models import (
 )
 from openai import AsyncOpenAI
 
+from core.answercache import AnswerCache
 from core.authentication import AuthenticationHelper
-from text import nonewlines
+from core.embeddingcache import EmbeddingCache
+from core.modelhelper import get_encoding, num_tokens_from_text, trim_text_to_sentence
+from core.searchcache import SearchCache
+from core.semanticcache import SemanticAnswerCache, SemanticMatch
+from core.tablerenderer import render_tables_compact
+from text import nonewlines, overlap_length
 
 
 @dataclass
@@ -28,6 +38,8 @@ class Document:
     oids: Optional[List[str]]
     groups: Optional[List[str]]
     captions: List[CaptionResult]
+    # Number of tokens of the content, counted at ingestion, or None for sections indexed before it was stored
+    tokens: Optional[int] = None
 
     def serialize_for_results(self) -> dict[str, Any]:
         return {
@@ -72,7 +84,41 @@ class ThoughtStep:
     props: Optional[dict[str, Any]] = None
 
 
+@dataclass
+class AnswerLookup:
+    """Where an answer goes in the answer caches, as found by Approach.get_cached_answer"""
+
+    question: str = ""
+    key: Optional[str] = None
+    scope: Optional[int] = None
+    query_vector: Optional[RawVectorQuery] = None
+    # A semantic cache hit that is answered again to check it
+    sampled_match: Optional[SemanticMatch] = None
+
+
+# Shortest text shared by the end of a section and the start of another for them to be neighbours, the sections split
+# by prepdocs overlap by about 100 characters
+MIN_SECTION_OVERLAP = 20
+
+# A system prompt that asks for the answers to hold HTML tables, which the model writes better from HTML sources
+HTML_TABLE_PROMPT = re.compile(r"\bhtml tables?\b", re.IGNORECASE)
+
+
 class Approach:
+    embedding_cache: Optional[EmbeddingCache] = None
+    search_cache: Optional[SearchCache] = None
+    answer_cache: Optional[AnswerCache] = None
+    semantic_cache: Optional[SemanticAnswerCache] = None
+    # Pooled session of the Computer Vision calls, owned by the app, or a session per call when not set
+    vision_session: Optional[aiohttp.ClientSession] = None
+    # Temperature of the completion that answers the question, unless overridden
+    default_temperature: float = 0.3
+    # Fraction of the token limit of the model the sources can take in the prompt, unless overridden
+    sources_token_fraction: float = 0.5
+    # How the tables of the sources are written in the prompt, unless overridden: "html" as they are indexed, "compact"
+    # with fewer tokens, or "auto" to keep them in HTML when the system prompt asks for HTML tables
+    table_format: str = "html"
+
     def __init__(
         self,
         search_client: SearchClient,
@@ -83,6 +129,10 @@ class Approach:
         embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
         embedding_model: str,
         openai_host: str,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        search_cache: Optional[SearchCache] = None,
+        answer_cache: Optional[AnswerCache] = None,
+        semantic_cache: Optional[SemanticAnswerCache] = None,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -92,6 +142,10 @@ class Approach:
         self.embedding_deployment = embedding_deployment
         self.embedding_model = embedding_model
         self.openai_host = openai_host
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.answer_cache = answer_cache
+        self.semantic_cache = semantic_cache
 
     def build_filter(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
         exclude_category = overrides.get("exclude_category") or None
@@ -99,10 +153,76 @@ class Approach:
         filters = []
         if exclude_category:
             filters.append("category ne '{}'".format(exclude_category.replace("'", "''")))
+        include_sourcefiles = overrides.get("include_sourcefiles") or []
+        if include_sourcefiles:
+            # Restricts the search to the given documents, as named by sourcefile
+            sourcefiles = "|".join(sourcefile.replace("'", "''") for sourcefile in include_sourcefiles)
+            filters.append(f"search.in(sourcefile, '{sourcefiles}', '|')")
         if security_filter:
             filters.append(security_filter)
         return None if len(filters) == 0 else " and ".join(filters)
 
+    def get_temperature(self, overrides: dict[str, Any]) -> float:
+        temperature = overrides.get("temperature")
+        return self.default_temperature if temperature is None else temperature
+
+    def get_sources_token_limit(self, overrides: dict[str, Any], token_limit: int) -> int:
+        fraction = overrides.get("sources_token_fraction")
+        return int(token_limit * (self.sources_token_fraction if fraction is None else fraction))
+
+    def get_table_format(self, overrides: dict[str, Any], system_prompt: str) -> str:
+        table_format = overrides.get("table_format") or self.table_format
+        if table_format == "auto":
+            return "html" if HTML_TABLE_PROMPT.search(system_prompt) else "compact"
+        return table_format
+
+    def get_answer_cache_key(
+        self, messages: list[dict], overrides: dict[str, Any], auth_claims: dict[str, Any]
+    ) -> Optional[str]:
+        # Only deterministic completions are cached, other settings are expected to vary between identical requests
+        if not self.answer_cache or self.get_temperature(overrides) != 0:
+            return None
+        filter = self.build_filter(overrides, auth_claims)
+        return self.answer_cache.make_key(type(self).__name__, messages, overrides, filter)
+
+    async def get_cached_answer(
+        self, messages: list[dict], overrides: dict[str, Any], auth_claims: dict[str, Any]
+    ) -> tuple[Optional[dict[str, Any]], AnswerLookup]:
+        """
+        Looks up the answer to the request in the exact-match answer cache, then in the semantic answer cache.
+        The lookup is passed to cache_answer() once the request was answered, its query vector can be used for retrieval.
+        """
+        question = messages[-1]["content"]
+        lookup = AnswerLookup(
+            question=question if isinstance(question, str) else "",
+            key=self.get_answer_cache_key(messages, overrides, auth_claims),
+        )
+        if self.answer_cache and lookup.key and (response := self.answer_cache.get(lookup.key)):
+            return response, lookup
+        # The semantic cache relies on embeddings of the question, so it is only used when retrieval uses them too
+        has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
+        if self.semantic_cache and lookup.question and has_vector and self.get_temperature(overrides) == 0:
+            filter = self.build_filter(overrides, auth_claims)
+            lookup.scope = self.semantic_cache.make_scope(type(self).__name__, messages[:-1], overrides, filter)
+            lookup.query_vector = await self.compute_text_embedding(lookup.question)
+            if match := self.semantic_cache.get(lookup.scope, lookup.query_vector.vector or []):
+                if not self.semantic_cache.sample():
+                    return match.response, lookup
+                lookup.sampled_match = match
+        return None, lookup
+
+    def cache_answer(self, lookup: AnswerLookup, response: dict[str, Any]):
+        # Answers cut short by the token limit or a content filter are not worth replaying
+        if response["choices"][0]["finish_reason"] != "stop":
+            return
+        if self.answer_cache and lookup.key:
+            self.answer_cache.set(lookup.key, response)
+        if self.semantic_cache and lookup.scope is not None and lookup.query_vector and lookup.query_vector.vector:
+            if lookup.sampled_match:
+                self.semantic_cache.check_sample(lookup.sampled_match, lookup.question, response)
+            else:
+                self.semantic_cache.set(lookup.scope, lookup.query_vector.vector, lookup.question, response)
+
     async def search(
         self,
         top: int,
@@ -112,6 +232,21 @@ class Approach:
         use_semantic_ranker: bool,
         use_semantic_captions: bool,
     ) -> List[Document]:
+        cache_key = None
+        if self.search_cache:
+            cache_key = SearchCache.make_key(
+                top,
+                query_text,
+                filter,
+                vectors,
+                use_semantic_ranker,
+                use_semantic_captions,
+                self.query_language,
+                self.query_speller,
+            )
+            if (cached_documents := self.search_cache.get(cache_key)) is not None:
+                return cached_documents
+
         # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
         if use_semantic_ranker and query_text:
             results = await self.search_client.search(
@@ -145,8 +280,11 @@ class Approach:
                         oids=document.get("oids"),
                         groups=document.get("groups"),
                         captions=cast(List[CaptionResult], document.get("@search.captions")),
+                        tokens=document.get("tokens"),
                     )
                 )
+        if self.search_cache and cache_key:
+            self.search_cache.set(cache_key, documents)
         return documents
 
     def get_sources_content(
@@ -165,6 +303,123 @@ class Approach:
                 for doc in results
             ]
 
+    def pack_sources_content(
+        self,
+        results: List[Document],
+        use_semantic_captions: bool,
+        use_image_citation: bool,
+        max_tokens: int,
+        model: str,
+        table_format: str = "html",
+    ) -> tuple[list[str], dict[str, int]]:
+        """
+        Returns the sources of get_sources_content() that fit within max_tokens, in the rank order of the results, once
+        the text the results have in common was merged. The first source that doesn't fit is cut at the end of its last
+        sentence that does, and the sources after it are dropped. With the "compact" table format, the tables of the
+        sections are rendered with fewer tokens. The number of tokens that were packed, dropped and saved by the merge is
+        returned along with the sources.
+        """
+        encoding = get_encoding(model)
+        overlap_tokens_saved = 0
+        if not use_semantic_captions:
+            merged_results = self.merge_overlapping_results(results)
+            # Only the results that were stitched or trimmed are counted again
+            changed = [result for result in results if not any(result is merged for merged in merged_results)]
+            added = [merged for merged in merged_results if not any(merged is result for result in results)]
+            overlap_tokens_saved = sum(
+                self.num_tokens_from_source(result, False, use_image_citation, encoding) for result in changed
+            ) - sum(self.num_tokens_from_source(result, False, use_image_citation, encoding) for result in added)
+            results = merged_results
+            if table_format == "compact":
+                results = [self.render_tables(result) for result in results]
+        sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation)
+        packed: list[str] = []
+        packed_tokens = dropped_tokens = 0
+        full = False
+        for result, source in zip(results, sources_content):
+            citation = self.get_citation((result.sourcepage or ""), use_image_citation) + ": "
+            num_tokens = self.num_tokens_from_source(result, use_semantic_captions, use_image_citation, encoding)
+            if not full and packed_tokens + num_tokens <= max_tokens:
+                packed.append(source)
+                packed_tokens += num_tokens
+                continue
+            if not full:
+                full = True
+                trimmed = trim_text_to_sentence(source, max_tokens - packed_tokens, encoding)
+                # A source cut within its citation has nothing left to cite
+                if len(trimmed) > len(citation):
+                    trimmed_tokens = num_tokens_from_text(trimmed, encoding)
+                    packed.append(trimmed)
+                    packed_tokens += trimmed_tokens
+                    num_tokens = max(num_tokens - trimmed_tokens, 0)
+            dropped_tokens += num_tokens
+        return packed, {
+            "packed_tokens": packed_tokens,
+            "dropped_tokens": dropped_tokens,
+            "overlap_tokens_saved": overlap_tokens_saved,
+        }
+
+    def num_tokens_from_source(
+        self, result: Document, use_semantic_captions: bool, use_image_citation: bool, encoding: tiktoken.Encoding
+    ) -> int:
+        citation = self.get_citation((result.sourcepage or ""), use_image_citation) + ": "
+        if not use_semantic_captions and result.tokens is not None:
+            # The content was counted at ingestion, only its citation is left to count
+            return num_tokens_from_text(citation, encoding) + result.tokens
+        source = self.get_sources_content([result], use_semantic_captions, use_image_citation)[0]
+        return num_tokens_from_text(source, encoding)
+
+    def render_tables(self, result: Document) -> Document:
+        if not result.content:
+            return result
+        content = render_tables_compact(result.id or "", result.content)
+        return result if content == result.content else replace(result, content=content, tokens=None)
+
+    def merge_overlapping_results(self, results: List[Document]) -> List[Document]:
+        """
+        Removes the text that neighbouring sections of a source file have in common, as the sections split with an
+        overlap do. Sections of the same page are stitched into one passage, at the rank of the first of them, and of
+        sections of different pages, the lower ranked one is trimmed so that both keep their citations.
+        """
+        merged: list[Document] = []
+        for result in results:
+            passage, position = result, len(merged)
+            i = 0
+            while i < len(merged):
+                stitched = self.stitch_results(merged[i], passage)
+                if stitched is None:
+                    i += 1
+                    continue
+                # The stitched passage may now overlap a passage it didn't before
+                del merged[i]
+                passage, position = stitched, min(position, i)
+                i = 0
+            merged.insert(position, passage)
+
+        for i, higher in enumerate(merged):
+            for j in range(i + 1, len(merged)):
+                lower = merged[j]
+                if not higher.content or not lower.content or higher.sourcefile != lower.sourcefile:
+                    continue
+                if overlap := overlap_length(higher.content, lower.content, MIN_SECTION_OVERLAP):
+                    merged[j] = replace(lower, content=lower.content[overlap:], tokens=None)
+                elif overlap := overlap_length(lower.content, higher.content, MIN_SECTION_OVERLAP):
+                    merged[j] = replace(lower, content=lower.content[:-overlap], tokens=None)
+        # Sections whose text was all in a higher ranked one are dropped
+        return [result for result in merged if result.content or any(result is r for r in results)]
+
+    def stitch_results(self, first: Document, second: Document) -> Optional[Document]:
+        """Returns the passage of two sections of the same page whose texts overlap, or None if they don't"""
+        if not first.content or not second.content:
+            return None
+        if first.sourcefile != second.sourcefile or first.sourcepage != second.sourcepage:
+            return None
+        if overlap := overlap_length(first.content, second.content, MIN_SECTION_OVERLAP):
+            return replace(first, content=first.content + second.content[overlap:], tokens=None)
+        if overlap := overlap_length(second.content, first.content, MIN_SECTION_OVERLAP):
+            return replace(first, content=second.content + first.content[overlap:], tokens=None)
+        return None
+
     def get_citation(self, sourcepage: str, use_image_citation: bool) -> str:
         if use_image_citation:
             return sourcepage
@@ -178,28 +433,76 @@ class Approach:
             return sourcepage
 
     async def compute_text_embedding(self, q: str):
-        embedding = await self.openai_client.embeddings.create(
-            # Azure Open AI takes the deployment name as the model name
-            model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
-            input=q,
-        )
-        query_vector = embedding.data[0].embedding
+        # Azure Open AI takes the deployment name as the model name
+        model = self.embedding_deployment if self.embedding_deployment else self.embedding_model
+        query_vector = self.embedding_cache.get(model, q) if self.embedding_cache else None
+        if query_vector is None:
+            embedding = await self.openai_client.embeddings.create(
+                model=model,
+                input=q,
+            )
+            query_vector = embedding.data[0].embedding
+            if self.embedding_cache:
+                self.embedding_cache.set(model, q, query_vector)
         return RawVectorQuery(vector=query_vector, k=50, fields="embedding")
 
+    async def compute_text_embeddings(self, qs: list[str]) -> list[RawVectorQuery]:
+        # Embeds several queries with a single request, only those that are not in the embedding cache
+        model = self.embedding_deployment if self.embedding_deployment else self.embedding_model
+        query_vectors = [self.embedding_cache.get(model, q) if self.embedding_cache else None for q in qs]
+        missing = [i for i, query_vector in enumerate(query_vectors) if query_vector is None]
+        if missing:
+            embedding = await self.openai_client.embeddings.create(model=model, input=[qs[i] for i in missing])
+            for i, data in zip(missing, sorted(embedding.data, key=lambda data: data.index)):
+                query_vectors[i] = data.embedding
+                if self.embedding_cache:
+                    self.embedding_cache.set(model, qs[i], data.embedding)
+        return [RawVectorQuery(vector=query_vector, k=50, fields="embedding") for query_vector in query_vectors]
+
     async def compute_image_embedding(self, q: str, vision_endpoint: str, vision_key: str):
         endpoint = f"{vision_endpoint}computervision/retrieval:vectorizeText"
         params = {"api-version": "2023-02-01-preview", "modelVersion": "latest"}
         headers = {"Content-Type": "application/json", "Ocp-Apim-Subscription-Key": vision_key}
         data = {"text": q}
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
-            ) as response:
-                json = await response.json()
-                image_query_vector = json["vector"]
+        model = f"{endpoint}?modelVersion={params['modelVersion']}"
+        image_query_vector = self.embedding_cache.get(model, q) if self.embedding_cache else None
+        if image_query_vector is None:
+            session = self.vision_session or aiohttp.ClientSession()
+            try:
+                async with session.post(
+                    url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
+                ) as response:
+                    json = await response.json()
+                    image_query_vector = json["vector"]
+            finally:
+                if session is not self.vision_session:
+                    await session.close()
+            if self.embedding_cache:
+                self.embedding_cache.set(model, q, image_query_vector)
         return RawVectorQuery(vector=image_query_vector, k=50, fields="imageEmbedding")
 
+    async def compute_query_vectors(
+        self, q: str, vector_fields: list[str], vision_endpoint: str, vision_key: str
+    ) -> tuple[list[VectorQuery], dict[str, float]]:
+        """
+        Computes the query vector of each of the vector fields concurrently, in the order of the fields, along with the
+        seconds each one took
+        """
+
+        async def compute(field: str) -> tuple[VectorQuery, float]:
+            start = time.monotonic()
+            vector = (
+                await self.compute_text_embedding(q)
+                if field == "embedding"
+                else await self.compute_image_embedding(q, vision_endpoint, vision_key)
+            )
+            return vector, round(time.monotonic() - start, 3)
+
+        computed = await asyncio.gather(*(compute(field) for field in vector_fields))
+        vectors = [vector for vector, _ in computed]
+        return vectors, {field: seconds for field, (_, seconds) in zip(vector_fields, computed)}
+
     async def run(
         self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
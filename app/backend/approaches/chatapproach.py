@@ -12,6 +12,7 @@ from openai.types.chat import (
 
 from approaches.approach import Approach
 from core.messagebuilder import MessageBuilder
+from core.modelhelper import fit_images_to_token_limit
 
 
 class ChatApproach(Approach, ABC):
@@ -27,6 +28,7 @@ class ChatApproach(Approach, ABC):
         {"role": ASSISTANT, "content": "Show available health plans"},
     ]
     NO_RESPONSE = "0"
+    default_temperature = 0.7
 
     follow_up_questions_prompt_content = """Generate 3 very brief follow-up questions that the user would likely ask next.
     Enclose the follow-up questions in double angle brackets. Example:
@@ -81,6 +83,11 @@ class ChatApproach(Approach, ABC):
                 return query_text
         return user_query
 
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        # Queries that only differ in case, spacing or punctuation retrieve the same documents
+        return " ".join(re.findall(r"\w+", query.lower()))
+
     def extract_followup_questions(self, content: str):
         return content.split("<<")[0], re.findall(r"<<([^>>]+)>>", content)
 
@@ -96,22 +103,26 @@ class ChatApproach(Approach, ABC):
         message_builder = MessageBuilder(system_prompt, model_id)
 
         # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
-        for shot in reversed(few_shots):
-            message_builder.insert_message(shot.get("role"), shot.get("content"))
+        message_builder.insert_messages(few_shots)
 
         append_index = len(few_shots) + 1
 
+        if isinstance(user_content, list):
+            # Downgrade or drop the images of the question that don't fit on their own, the history is dropped first
+            user_content = fit_images_to_token_limit(user_content, max_tokens, model_id)
         message_builder.insert_message(self.USER, user_content, index=append_index)
         total_token_count = message_builder.count_tokens_for_message(dict(message_builder.messages[-1]))  # type: ignore
 
-        newest_to_oldest = list(reversed(history[:-1]))
-        for message in newest_to_oldest:
+        # Keep the newest messages of the history that fit within the budget, then insert them all at once
+        kept = 0
+        for message in reversed(history[:-1]):
             potential_message_count = message_builder.count_tokens_for_message(message)
             if (total_token_count + potential_message_count) > max_tokens:
                 logging.debug("Reached max tokens of %d, history will be truncated", max_tokens)
                 break
-            message_builder.insert_message(message["role"], message["content"], index=append_index)
             total_token_count += potential_message_count
+            kept += 1
+        message_builder.insert_messages(history[len(history) - 1 - kept : -1], index=append_index)
         return message_builder.messages
 
     async def run_without_streaming(
@@ -121,6 +132,11 @@ class ChatApproach(Approach, ABC):
         auth_claims: dict[str, Any],
         session_state: Any = None,
     ) -> dict[str, Any]:
+        cached_resp, answer_lookup = await self.get_cached_answer(history, overrides, auth_claims)
+        if cached_resp:
+            cached_resp["choices"][0]["session_state"] = session_state
+            return cached_resp
+
         extra_info, chat_coroutine = await self.run_until_final_call(
             history, overrides, auth_claims, should_stream=False
         )
@@ -131,9 +147,51 @@ class ChatApproach(Approach, ABC):
             content, followup_questions = self.extract_followup_questions(chat_resp["choices"][0]["message"]["content"])
             chat_resp["choices"][0]["message"]["content"] = content
             chat_resp["choices"][0]["context"]["followup_questions"] = followup_questions
+        self.cache_answer(answer_lookup, chat_resp)
         chat_resp["choices"][0]["session_state"] = session_state
         return chat_resp
 
+    async def replay_with_streaming(
+        self, chat_resp: dict[str, Any], session_state: Any = None
+    ) -> AsyncGenerator[dict, None]:
+        # Streams a cached answer in the same chunks as run_with_streaming, the follow-up questions coming last
+        context = chat_resp["choices"][0]["context"]
+        followup_questions = context.pop("followup_questions", None)
+        yield {
+            "choices": [
+                {
+                    "delta": {"role": self.ASSISTANT},
+                    "context": context,
+                    "session_state": session_state,
+                    "finish_reason": None,
+                    "index": 0,
+                }
+            ],
+            "object": "chat.completion.chunk",
+        }
+        yield {
+            "choices": [
+                {
+                    "delta": {"content": chat_resp["choices"][0]["message"]["content"]},
+                    "finish_reason": chat_resp["choices"][0]["finish_reason"],
+                    "index": 0,
+                }
+            ],
+            "object": "chat.completion.chunk",
+        }
+        if followup_questions:
+            yield {
+                "choices": [
+                    {
+                        "delta": {"role": self.ASSISTANT},
+                        "context": {"followup_questions": followup_questions},
+                        "finish_reason": None,
+                        "index": 0,
+                    }
+                ],
+                "object": "chat.completion.chunk",
+            }
+
     async def run_with_streaming(
         self,
         history: list[dict[str, str]],
@@ -141,6 +199,12 @@ class ChatApproach(Approach, ABC):
         auth_claims: dict[str, Any],
         session_state: Any = None,
     ) -> AsyncGenerator[dict, None]:
+        cached_resp, answer_lookup = await self.get_cached_answer(history, overrides, auth_claims)
+        if cached_resp:
+            async for event in self.replay_with_streaming(cached_resp, session_state):
+                yield event
+            return
+
         extra_info, chat_coroutine = await self.run_until_final_call(
             history, overrides, auth_claims, should_stream=True
         )
@@ -159,10 +223,14 @@ class ChatApproach(Approach, ABC):
 
         followup_questions_started = False
         followup_content = ""
+        # The streamed answer, kept to cache it once the stream completes
+        answer_content = ""
+        finish_reason = None
         async for event_chunk in await chat_coroutine:
             # "2023-07-01-preview" API version has a bug where first response has empty choices
             event = event_chunk.model_dump()  # Convert pydantic model to dict
             if event["choices"]:
+                finish_reason = event["choices"][0].get("finish_reason") or finish_reason
                 # if event contains << and not >>, it is start of follow-up question, truncate
                 content = event["choices"][0]["delta"].get("content")
                 content = content or ""  # content may either not exist in delta, or explicitly be None
@@ -171,12 +239,15 @@ class ChatApproach(Approach, ABC):
                     earlier_content = content[: content.index("<<")]
                     if earlier_content:
                         event["choices"][0]["delta"]["content"] = earlier_content
+                        answer_content += earlier_content
                         yield event
                     followup_content += content[content.index("<<") :]
                 elif followup_questions_started:
                     followup_content += content
                 else:
+                    answer_content += content
                     yield event
+        followup_questions = []
         if followup_content:
             _, followup_questions = self.extract_followup_questions(followup_content)
             yield {
@@ -190,6 +261,24 @@ class ChatApproach(Approach, ABC):
                 ],
                 "object": "chat.completion.chunk",
             }
+        if self.answer_cache or self.semantic_cache:
+            context = extra_info
+            if overrides.get("suggest_followup_questions"):
+                context = {**extra_info, "followup_questions": followup_questions}
+            self.cache_answer(
+                answer_lookup,
+                {
+                    "choices": [
+                        {
+                            "message": {"role": self.ASSISTANT, "content": answer_content},
+                            "context": context,
+                            "finish_reason": finish_reason,
+                            "index": 0,
+                        }
+                    ],
+                    "object": "chat.completion",
+                },
+            )
 
     async def run(
         self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
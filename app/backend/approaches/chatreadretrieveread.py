@@ -1,3 +1,6 @@
+import asyncio
+import re
+import time
 from typing import Any, Coroutine, Literal, Optional, Union, overload
 
 from azure.search.documents.aio import SearchClient
@@ -8,10 +11,14 @@ from openai.types.chat import (
     ChatCompletionChunk,
 )
 
-from approaches.approach import ThoughtStep
+from approaches.approach import Document, ThoughtStep
 from approaches.chatapproach import ChatApproach
+from core.answercache import AnswerCache
 from core.authentication import AuthenticationHelper
+from core.embeddingcache import EmbeddingCache
 from core.modelhelper import get_token_limit
+from core.searchcache import SearchCache
+from core.semanticcache import SemanticAnswerCache
 
 
 class ChatReadRetrieveReadApproach(ChatApproach):
@@ -36,6 +43,15 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         content_field: str,
         query_language: str,
         query_speller: str,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        search_cache: Optional[SearchCache] = None,
+        answer_cache: Optional[AnswerCache] = None,
+        semantic_cache: Optional[SemanticAnswerCache] = None,
+        speculative_retrieval: bool = False,
+        skip_query_rewrite: str = "never",
+        skip_query_rewrite_max_words: int = 16,
+        sources_token_fraction: float = 0.5,
+        table_format: str = "html",
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -49,6 +65,28 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         self.query_language = query_language
         self.query_speller = query_speller
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.answer_cache = answer_cache
+        self.semantic_cache = semantic_cache
+        # Whether to retrieve with the user's question while the search query is generated, per the
+        # speculative_retrieval override
+        self.speculative_retrieval = speculative_retrieval
+        # When to search the user's question as is, per the skip_query_rewrite override: "never", "first_turn",
+        # "self_contained" (first turns and follow-ups without references to the conversation) or "always"
+        self.skip_query_rewrite = skip_query_rewrite
+        self.skip_query_rewrite_max_words = skip_query_rewrite_max_words
+        self.sources_token_fraction = sources_token_fraction
+        self.table_format = table_format
+        # Moving average of the time taken to generate a search query, reported as saved when it was skipped
+        self.query_rewrite_seconds: Optional[float] = None
+
+    # Words of a follow-up question that likely refer to earlier messages, so it needs the conversation to be searched
+    anaphora_pattern = re.compile(
+        r"\b(it|its|they|them|their|theirs|this|that|these|those|he|she|him|her|his|former|latter|above|previous|"
+        r"same|else|other|one|ones)\b|^\W*(and|or|but|so|also|what about|how about)\b",
+        re.IGNORECASE,
+    )
 
     @property
     def system_message_chat_conversation(self):
@@ -121,44 +159,80 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             }
         ]
 
-        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        messages = self.get_messages_from_history(
-            system_prompt=self.query_prompt_template,
-            model_id=self.chatgpt_model,
-            history=history,
-            user_content=user_query_request,
-            max_tokens=self.chatgpt_token_limit - len(user_query_request),
-            few_shots=self.query_prompt_few_shots,
-        )
-
-        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            messages=messages,  # type: ignore
-            # Azure Open AI takes the deployment name as the model name
-            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-            temperature=0.0,
-            max_tokens=100,  # Setting too low risks malformed JSON, setting too high may affect performance
-            n=1,
-            functions=functions,
-            function_call="auto",
+        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question,
+        # unless the question can be searched as is
+        skip_query_rewrite = overrides.get("skip_query_rewrite", self.skip_query_rewrite)
+        skip_reason = self.get_query_rewrite_skip_reason(
+            skip_query_rewrite,
+            history,
+            overrides.get("skip_query_rewrite_max_words", self.skip_query_rewrite_max_words),
         )
+        speculative_task = None
+        query_rewrite_seconds = None
+        if skip_reason:
+            query_text = original_user_query
+        else:
+            messages = self.get_messages_from_history(
+                system_prompt=self.query_prompt_template,
+                model_id=self.chatgpt_model,
+                history=history,
+                user_content=user_query_request,
+                max_tokens=self.chatgpt_token_limit - len(user_query_request),
+                few_shots=self.query_prompt_few_shots,
+            )
 
-        query_text = self.get_search_query(chat_completion, original_user_query)
+            # Speculatively retrieve documents for the user's question while the search query is generated,
+            # the results are used if the generated query turns out to be the same question
+            if overrides.get("speculative_retrieval", self.speculative_retrieval):
+                speculative_task = asyncio.create_task(
+                    self.retrieve(
+                        original_user_query,
+                        top,
+                        filter,
+                        has_text,
+                        has_vector,
+                        use_semantic_ranker,
+                        use_semantic_captions,
+                    )
+                )
 
-        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
-
-        # If retrieval mode includes vectors, compute an embedding for the query
-        vectors: list[VectorQuery] = []
-        if has_vector:
-            vectors.append(await self.compute_text_embedding(query_text))
-
-        # Only keep the text query if the retrieval mode uses text, otherwise drop it
-        if not has_text:
-            query_text = None
+            query_rewrite_start = time.perf_counter()
+            try:
+                chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
+                    messages=messages,  # type: ignore
+                    # Azure Open AI takes the deployment name as the model name
+                    model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+                    temperature=0.0,
+                    max_tokens=100,  # Setting too low risks malformed JSON, setting too high may affect performance
+                    n=1,
+                    functions=functions,
+                    function_call="auto",
+                )
+            except BaseException:
+                if speculative_task:
+                    self.discard_task(speculative_task)
+                raise
 
-        results = await self.search(top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions)
+            query_text = self.get_search_query(chat_completion, original_user_query)
+            query_rewrite_seconds = time.perf_counter() - query_rewrite_start
+            self.query_rewrite_seconds = (
+                query_rewrite_seconds
+                if self.query_rewrite_seconds is None
+                else 0.9 * self.query_rewrite_seconds + 0.1 * query_rewrite_seconds
+            )
 
-        sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
-        content = "\n".join(sources_content)
+        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
+        speculation = None
+        if speculative_task and self.normalize_query(query_text) == self.normalize_query(original_user_query):
+            speculation = "hit"
+            results = await speculative_task
+        else:
+            if speculative_task:
+                speculation = "miss"
+                self.discard_task(speculative_task)
+            results = await self.retrieve(
+                query_text, top, filter, has_text, has_vector, use_semantic_ranker, use_semantic_captions
+            )
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
 
@@ -168,6 +242,16 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else "",
         )
 
+        sources_content, sources_tokens = self.pack_sources_content(
+            results,
+            use_semantic_captions,
+            use_image_citation=False,
+            max_tokens=self.get_sources_token_limit(overrides, self.chatgpt_token_limit),
+            model=self.chatgpt_model,
+            table_format=self.get_table_format(overrides, system_message),
+        )
+        content = "\n".join(sources_content)
+
         response_token_limit = 1024
         messages_token_limit = self.chatgpt_token_limit - response_token_limit
         messages = self.get_messages_from_history(
@@ -181,6 +265,17 @@ class ChatReadRetrieveReadApproach(ChatApproach):
 
         data_points = {"text": sources_content}
 
+        search_query_props: dict[str, Any] = {"use_semantic_captions": use_semantic_captions, "has_vector": has_vector}
+        if speculation:
+            search_query_props["speculative_retrieval"] = speculation
+        if skip_reason:
+            search_query_props["query_rewrite"] = f"skipped ({skip_reason})"
+            if self.query_rewrite_seconds is not None:
+                search_query_props["query_rewrite_seconds_saved"] = round(self.query_rewrite_seconds, 3)
+        elif skip_query_rewrite != "never" and query_rewrite_seconds is not None:
+            search_query_props["query_rewrite"] = "generated"
+            search_query_props["query_rewrite_seconds"] = round(query_rewrite_seconds, 3)
+
         extra_info = {
             "data_points": data_points,
             "thoughts": [
@@ -190,10 +285,11 @@ class ChatReadRetrieveReadApproach(ChatApproach):
                 ),
                 ThoughtStep(
                     "Generated search query",
-                    query_text,
-                    {"use_semantic_captions": use_semantic_captions, "has_vector": has_vector},
+                    # Only the retrieval modes with text use the query, vectors use its embedding
+                    query_text if has_text else None,
+                    search_query_props,
                 ),
-                ThoughtStep("Results", [result.serialize_for_results() for result in results]),
+                ThoughtStep("Results", [result.serialize_for_results() for result in results], sources_tokens),
                 ThoughtStep("Prompt", [str(message) for message in messages]),
             ],
         }
@@ -202,9 +298,53 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             # Azure Open AI takes the deployment name as the model name
             model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
             messages=messages,
-            temperature=overrides.get("temperature") or 0.7,
+            temperature=self.get_temperature(overrides),
             max_tokens=response_token_limit,
             n=1,
             stream=should_stream,
         )
         return (extra_info, chat_coroutine)
+
+    def get_query_rewrite_skip_reason(
+        self, skip_query_rewrite: str, history: list[dict[str, str]], max_words: int
+    ) -> Optional[str]:
+        """Returns why the last question can be searched as is per the skip_query_rewrite policy, or None"""
+        if skip_query_rewrite == "always":
+            return "always"
+        if skip_query_rewrite not in ("first_turn", "self_contained"):
+            return None
+        question = history[-1]["content"]
+        # Long questions are condensed to keywords, and questions not in English translated, by the generated query
+        if len(question.split()) > max_words or not question.isascii():
+            return None
+        if len(history) == 1:
+            return "first_turn"
+        if skip_query_rewrite == "self_contained" and not self.anaphora_pattern.search(question):
+            return "self_contained"
+        return None
+
+    async def retrieve(
+        self,
+        query_text: str,
+        top: int,
+        filter: Optional[str],
+        has_text: bool,
+        has_vector: bool,
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+    ) -> list[Document]:
+        # If retrieval mode includes vectors, compute an embedding for the query
+        vectors: list[VectorQuery] = []
+        if has_vector:
+            vectors.append(await self.compute_text_embedding(query_text))
+
+        # Only keep the text query if the retrieval mode uses text, otherwise drop it
+        return await self.search(
+            top, query_text if has_text else None, filter, vectors, use_semantic_ranker, use_semantic_captions
+        )
+
+    @staticmethod
+    def discard_task(task: asyncio.Task):
+        # Cancels a speculative task whose result isn't needed, retrieving its exception if it already failed
+        if not task.cancel() and not task.cancelled():
+            task.exception()
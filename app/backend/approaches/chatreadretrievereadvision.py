@@ -1,6 +1,8 @@
 from typing import Any, Coroutine, Optional, Union
 
+import aiohttp
 from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorQuery
 from azure.storage.blob.aio import ContainerClient
 from openai import AsyncOpenAI, AsyncStream
 from openai.types.chat import (
@@ -12,9 +14,18 @@ from openai.types.chat import (
 
 from approaches.approach import ThoughtStep
 from approaches.chatapproach import ChatApproach
+from core.answercache import AnswerCache
 from core.authentication import AuthenticationHelper
-from core.imageshelper import fetch_image
-from core.modelhelper import get_token_limit
+from core.embeddingcache import EmbeddingCache
+from core.imagecache import ImageCache
+from core.imageshelper import fetch_images
+from core.modelhelper import (
+    fit_images_to_token_limit,
+    get_token_limit,
+    num_tokens_from_messages,
+)
+from core.searchcache import SearchCache
+from core.semanticcache import SemanticAnswerCache
 
 
 class ChatReadRetrieveReadVisionApproach(ChatApproach):
@@ -42,6 +53,15 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         query_speller: str,
         vision_endpoint: str,
         vision_key: str,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        search_cache: Optional[SearchCache] = None,
+        answer_cache: Optional[AnswerCache] = None,
+        semantic_cache: Optional[SemanticAnswerCache] = None,
+        image_cache: Optional[ImageCache] = None,
+        max_concurrent_image_fetches: int = 4,
+        vision_session: Optional[aiohttp.ClientSession] = None,
+        sources_token_fraction: float = 0.5,
+        table_format: str = "html",
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -58,6 +78,15 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         self.vision_endpoint = vision_endpoint
         self.vision_key = vision_key
         self.chatgpt_token_limit = get_token_limit(gpt4v_model)
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.answer_cache = answer_cache
+        self.semantic_cache = semantic_cache
+        self.image_cache = image_cache
+        self.max_concurrent_image_fetches = max_concurrent_image_fetches
+        self.vision_session = vision_session
+        self.sources_token_fraction = sources_token_fraction
+        self.table_format = table_format
 
     @property
     def system_message_chat_conversation(self):
@@ -120,25 +149,19 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
 
-        # If retrieval mode includes vectors, compute an embedding for the query
-        vectors = []
+        # If retrieval mode includes vectors, compute an embedding of the query for each vector field, concurrently
+        vectors: list[VectorQuery] = []
+        vector_seconds: dict[str, float] = {}
         if has_vector:
-            for field in vector_fields:
-                vector = (
-                    await self.compute_text_embedding(query_text)
-                    if field == "embedding"
-                    else await self.compute_image_embedding(query_text, self.vision_endpoint, self.vision_key)
-                )
-                vectors.append(vector)
+            vectors, vector_seconds = await self.compute_query_vectors(
+                query_text, vector_fields, self.vision_endpoint, self.vision_key
+            )
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         if not has_text:
             query_text = None
 
         results = await self.search(top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions)
-        sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=True)
-        content = "\n".join(sources_content)
-
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
 
         # Allow client to replace the entire prompt, or to inject into the existing prompt using >>>
@@ -147,6 +170,16 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else "",
         )
 
+        sources_content, sources_tokens = self.pack_sources_content(
+            results,
+            use_semantic_captions,
+            use_image_citation=True,
+            max_tokens=self.get_sources_token_limit(overrides, self.chatgpt_token_limit),
+            model=self.gpt4v_model,
+            table_format=self.get_table_format(overrides, system_message),
+        )
+        content = "\n".join(sources_content)
+
         response_token_limit = 1024
         messages_token_limit = self.chatgpt_token_limit - response_token_limit
 
@@ -156,11 +189,18 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         if include_gtpV_text:
             user_content.append({"text": "\n\nSources:\n" + content, "type": "text"})
         if include_gtpV_images:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
-                if url:
-                    image_list.append({"image_url": url, "type": "image_url"})
+            for url in await fetch_images(
+                self.blob_container_client, results, self.image_cache, self.max_concurrent_image_fetches
+            ):
+                image_list.append({"image_url": url, "type": "image_url"})
             user_content.extend(image_list)
+            # Downgrade or drop the images that would take the prompt over the token limit, before it is sent
+            system_token_count = num_tokens_from_messages(
+                {"role": "system", "content": system_message}, self.gpt4v_model
+            )
+            user_content = fit_images_to_token_limit(
+                user_content, messages_token_limit - system_token_count, self.gpt4v_model
+            )
 
         messages = self.get_messages_from_history(
             system_prompt=system_message,
@@ -172,7 +212,7 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
 
         data_points = {
             "text": sources_content,
-            "images": [d["image_url"] for d in image_list],
+            "images": [part["image_url"] for part in user_content if part["type"] == "image_url"],
         }
 
         extra_info = {
@@ -185,9 +225,13 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
                 ThoughtStep(
                     "Generated search query",
                     query_text,
-                    {"use_semantic_captions": use_semantic_captions, "vector_fields": vector_fields},
+                    {
+                        "use_semantic_captions": use_semantic_captions,
+                        "vector_fields": vector_fields,
+                        "vector_seconds": vector_seconds,
+                    },
                 ),
-                ThoughtStep("Results", [result.serialize_for_results() for result in results]),
+                ThoughtStep("Results", [result.serialize_for_results() for result in results], sources_tokens),
                 ThoughtStep("Prompt", [str(message) for message in messages]),
             ],
         }
@@ -195,7 +239,7 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         chat_coroutine = self.openai_client.chat.completions.create(
             model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
             messages=messages,
-            temperature=overrides.get("temperature") or 0.7,
+            temperature=self.get_temperature(overrides),
             max_tokens=response_token_limit,
             n=1,
             stream=should_stream,
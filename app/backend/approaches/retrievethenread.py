@@ -6,8 +6,13 @@ from azure.search.documents.models import VectorQuery
 from openai import AsyncOpenAI
 
 from approaches.approach import Approach, ThoughtStep
+from core.answercache import AnswerCache
 from core.authentication import AuthenticationHelper
+from core.embeddingcache import EmbeddingCache
 from core.messagebuilder import MessageBuilder
+from core.modelhelper import get_token_limit
+from core.searchcache import SearchCache
+from core.semanticcache import SemanticAnswerCache
 
 # Replace these with your own values, either in environment variables or directly here
 AZURE_STORAGE_ACCOUNT = os.getenv("AZURE_STORAGE_ACCOUNT")
@@ -56,6 +61,12 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         content_field: str,
         query_language: str,
         query_speller: str,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        search_cache: Optional[SearchCache] = None,
+        answer_cache: Optional[AnswerCache] = None,
+        semantic_cache: Optional[SemanticAnswerCache] = None,
+        sources_token_fraction: float = 0.5,
+        table_format: str = "html",
     ):
         self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
@@ -69,6 +80,13 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.chatgpt_token_limit = get_token_limit(chatgpt_model)
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.answer_cache = answer_cache
+        self.semantic_cache = semantic_cache
+        self.sources_token_fraction = sources_token_fraction
+        self.table_format = table_format
 
     async def run(
         self,
@@ -80,6 +98,11 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         q = messages[-1]["content"]
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
+        cached_completion, answer_lookup = await self.get_cached_answer(messages, overrides, auth_claims)
+        if cached_completion:
+            cached_completion["choices"][0]["session_state"] = session_state
+            return cached_completion
+
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         use_semantic_ranker = overrides.get("semantic_ranker") and has_text
@@ -90,7 +113,7 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         # If retrieval mode includes vectors, compute an embedding for the query
         vectors: list[VectorQuery] = []
         if has_vector:
-            vectors.append(await self.compute_text_embedding(q))
+            vectors.append(answer_lookup.query_vector or await self.compute_text_embedding(q))
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         query_text = q if has_text else None
@@ -103,8 +126,15 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         model = self.chatgpt_model
         message_builder = MessageBuilder(template, model)
 
-        # Process results
-        sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
+        # Process results, keeping the sources that fit within their share of the token limit
+        sources_content, sources_tokens = self.pack_sources_content(
+            results,
+            use_semantic_captions,
+            use_image_citation=False,
+            max_tokens=self.get_sources_token_limit(overrides, self.chatgpt_token_limit),
+            model=model,
+            table_format=self.get_table_format(overrides, template),
+        )
 
         # Append user message
         content = "\n".join(sources_content)
@@ -118,7 +148,7 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
                 # Azure Open AI takes the deployment name as the model name
                 model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
                 messages=message_builder.messages,
-                temperature=overrides.get("temperature") or 0.3,
+                temperature=self.get_temperature(overrides),
                 max_tokens=1024,
                 n=1,
             )
@@ -135,11 +165,12 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
                         "use_semantic_captions": use_semantic_captions,
                     },
                 ),
-                ThoughtStep("Results", [result.serialize_for_results() for result in results]),
+                ThoughtStep("Results", [result.serialize_for_results() for result in results], sources_tokens),
                 ThoughtStep("Prompt", [str(message) for message in message_builder.messages]),
             ],
         }
 
         chat_completion["choices"][0]["context"] = extra_info
+        self.cache_answer(answer_lookup, chat_completion)
         chat_completion["choices"][0]["session_state"] = session_state
         return chat_completion
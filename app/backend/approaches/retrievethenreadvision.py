@@ -1,7 +1,9 @@
 import os
 from typing import Any, AsyncGenerator, Optional, Union
 
+import aiohttp
 from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorQuery
 from azure.storage.blob.aio import ContainerClient
 from openai import AsyncOpenAI
 from openai.types.chat import (
@@ -10,9 +12,15 @@ from openai.types.chat import (
 )
 
 from approaches.approach import Approach, ThoughtStep
+from core.answercache import AnswerCache
 from core.authentication import AuthenticationHelper
-from core.imageshelper import fetch_image
+from core.embeddingcache import EmbeddingCache
+from core.imagecache import ImageCache
+from core.imageshelper import fetch_images
 from core.messagebuilder import MessageBuilder
+from core.modelhelper import fit_images_to_token_limit, get_token_limit
+from core.searchcache import SearchCache
+from core.semanticcache import SemanticAnswerCache
 
 # Replace these with your own values, either in environment variables or directly here
 AZURE_STORAGE_ACCOUNT = os.getenv("AZURE_STORAGE_ACCOUNT")
@@ -54,6 +62,15 @@ class RetrieveThenReadVisionApproach(Approach):
         query_speller: str,
         vision_endpoint: str,
         vision_key: str,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        search_cache: Optional[SearchCache] = None,
+        answer_cache: Optional[AnswerCache] = None,
+        semantic_cache: Optional[SemanticAnswerCache] = None,
+        image_cache: Optional[ImageCache] = None,
+        max_concurrent_image_fetches: int = 4,
+        vision_session: Optional[aiohttp.ClientSession] = None,
+        sources_token_fraction: float = 0.5,
+        table_format: str = "html",
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -69,6 +86,16 @@ class RetrieveThenReadVisionApproach(Approach):
         self.query_speller = query_speller
         self.vision_endpoint = vision_endpoint
         self.vision_key = vision_key
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.answer_cache = answer_cache
+        self.semantic_cache = semantic_cache
+        self.image_cache = image_cache
+        self.max_concurrent_image_fetches = max_concurrent_image_fetches
+        self.gpt4v_token_limit = get_token_limit(gpt4v_model)
+        self.vision_session = vision_session
+        self.sources_token_fraction = sources_token_fraction
+        self.table_format = table_format
 
     async def run(
         self,
@@ -92,17 +119,14 @@ class RetrieveThenReadVisionApproach(Approach):
         filter = self.build_filter(overrides, auth_claims)
         use_semantic_ranker = overrides.get("semantic_ranker") and has_text
 
-        # If retrieval mode includes vectors, compute an embedding for the query
+        # If retrieval mode includes vectors, compute an embedding of the query for each vector field, concurrently
 
-        vectors = []
+        vectors: list[VectorQuery] = []
+        vector_seconds: dict[str, float] = {}
         if has_vector:
-            for field in vector_fields:
-                vector = (
-                    await self.compute_text_embedding(q)
-                    if field == "embedding"
-                    else await self.compute_image_embedding(q, self.vision_endpoint, self.vision_key)
-                )
-                vectors.append(vector)
+            vectors, vector_seconds = await self.compute_query_vectors(
+                q, vector_fields, self.vision_endpoint, self.vision_key
+            )
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         query_text = q if has_text else None
@@ -113,22 +137,34 @@ class RetrieveThenReadVisionApproach(Approach):
         user_content: list[ChatCompletionContentPartParam] = [{"text": q, "type": "text"}]
 
         template = overrides.get("prompt_template") or (self.system_chat_template_gpt4v)
+        response_token_limit = 1024
         model = self.gpt4v_model
         message_builder = MessageBuilder(template, model)
 
-        # Process results
-
-        sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=True)
+        # Process results, keeping the sources that fit within their share of the token limit
+        sources_content, sources_tokens = self.pack_sources_content(
+            results,
+            use_semantic_captions,
+            use_image_citation=True,
+            max_tokens=self.get_sources_token_limit(overrides, self.gpt4v_token_limit),
+            model=model,
+            table_format=self.get_table_format(overrides, template),
+        )
 
         if include_gtpV_text:
             content = "\n".join(sources_content)
             user_content.append({"text": content, "type": "text"})
         if include_gtpV_images:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
-                if url:
-                    image_list.append({"image_url": url, "type": "image_url"})
+            for url in await fetch_images(
+                self.blob_container_client, results, self.image_cache, self.max_concurrent_image_fetches
+            ):
+                image_list.append({"image_url": url, "type": "image_url"})
             user_content.extend(image_list)
+            # Downgrade or drop the images that would take the prompt over the token limit, before it is sent
+            system_token_count = message_builder.count_tokens_for_message(dict(message_builder.messages[0]))  # type: ignore
+            user_content = fit_images_to_token_limit(
+                user_content, self.gpt4v_token_limit - response_token_limit - system_token_count, model
+            )
 
         # Append user message
         message_builder.insert_message("user", user_content)
@@ -137,15 +173,15 @@ class RetrieveThenReadVisionApproach(Approach):
             await self.openai_client.chat.completions.create(
                 model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
                 messages=message_builder.messages,
-                temperature=overrides.get("temperature") or 0.3,
-                max_tokens=1024,
+                temperature=self.get_temperature(overrides),
+                max_tokens=response_token_limit,
                 n=1,
             )
         ).model_dump()
 
         data_points = {
             "text": sources_content,
-            "images": [d["image_url"] for d in image_list],
+            "images": [part["image_url"] for part in user_content if part["type"] == "image_url"],
         }
 
         extra_info = {
@@ -154,9 +190,13 @@ class RetrieveThenReadVisionApproach(Approach):
                 ThoughtStep(
                     "Search Query",
                     query_text,
-                    {"use_semantic_captions": use_semantic_captions, "vector_fields": vector_fields},
+                    {
+                        "use_semantic_captions": use_semantic_captions,
+                        "vector_fields": vector_fields,
+                        "vector_seconds": vector_seconds,
+                    },
                 ),
-                ThoughtStep("Results", [result.serialize_for_results() for result in results]),
+                ThoughtStep("Results", [result.serialize_for_results() for result in results], sources_tokens),
                 ThoughtStep("Prompt", [str(message) for message in message_builder.messages]),
             ],
         }
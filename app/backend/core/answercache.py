@@ -0,0 +1,50 @@
+import copy
+import hashlib
+import json
+from typing import Any, Optional
+
+from core.lrucache import LRUCache
+
+
+class AnswerCache:
+    """
+    Per-worker cache of the responses of the approaches, so that an identical request doesn't go through query rewriting,
+    retrieval and the completion again. Keys are a hash of the approach, the messages, the overrides, the filter
+    (which carries the security filter of the user, so answers are never shared across users with different access)
+    and the index version. The index version is bumped by invalidate() once documents were added to or removed from
+    the index, which drops all previous answers.
+    """
+
+    def __init__(self, max_bytes: int, ttl: Optional[float]):
+        self.cache: LRUCache[str, dict[str, Any]] = LRUCache(max_bytes=max_bytes, ttl=ttl, sizeof=self.sizeof)
+        self.index_version = 0
+
+    def make_key(self, approach: str, messages: list[dict], overrides: dict[str, Any], filter: Optional[str]) -> str:
+        payload = json.dumps(
+            [approach, messages, overrides, filter, self.index_version],
+            sort_keys=True,
+            separators=(",", ":"),
+            ensure_ascii=False,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def sizeof(response: dict[str, Any]) -> int:
+        # Rough size in memory, measured by the length of the response as JSON
+        return len(json.dumps(response, ensure_ascii=False, default=str))
+
+    def get(self, key: str) -> Optional[dict[str, Any]]:
+        response = self.cache.get(key)
+        # Callers get their own copy, to set the session state and stream it
+        return copy.deepcopy(response) if response is not None else None
+
+    def set(self, key: str, response: dict[str, Any]):
+        self.cache.set(key, copy.deepcopy(response))
+
+    def invalidate(self):
+        self.cache.clear()
+        self.index_version += 1
+
+    def get_stats(self) -> dict[str, Any]:
+        return {**self.cache.stats.to_dict(), "index_version": self.index_version}
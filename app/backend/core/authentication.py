@@ -1,7 +1,13 @@
 # Refactored from https://github.com/Azure-Samples/ms-identity-python-on-behalf-of
 
+import asyncio
+import base64
+import binascii
+import hashlib
 import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Optional
 
 import aiohttp
@@ -9,6 +15,8 @@ from azure.search.documents.indexes.models import SearchIndex
 from msal import ConfidentialClientApplication
 from msal.token_cache import TokenCache
 
+from core.lrucache import LRUCache
+
 
 # AuthError is raised when the authentication token sent by the client UI cannot be parsed or there is an authentication error accessing the graph API
 class AuthError(Exception):
@@ -32,6 +40,9 @@ class AuthenticationHelper:
         client_app_id: Optional[str],
         tenant_id: Optional[str],
         require_access_control: bool = False,
+        max_workers: int = 4,
+        claims_cache_max_entries: int = 10000,
+        groups_cache_ttl: float = 900,
     ):
         self.use_authentication = use_authentication
         self.server_app_id = server_app_id
@@ -39,6 +50,23 @@ class AuthenticationHelper:
         self.client_app_id = client_app_id
         self.tenant_id = tenant_id
         self.authority = f"https://login.microsoftonline.com/{tenant_id}"
+        self.executor: Optional[ThreadPoolExecutor] = None
+        # Claims of the access tokens seen by this worker, keyed by a hash of the token and kept until it expires
+        self.claims_cache: LRUCache[str, dict[str, Any]] = LRUCache(max_entries=claims_cache_max_entries)
+        # Exchanges in progress, which requests carrying the same token wait for instead of starting their own
+        self.pending_claims: dict[str, asyncio.Future[dict[str, Any]]] = {}
+        self.exchanges = 0
+        self.shared_exchanges = 0
+        # Groups of the users with a groups overage claim, keyed by oid, with the monotonic time to refresh them at
+        self.groups_cache_ttl = groups_cache_ttl
+        self.groups_cache: LRUCache[str, tuple[list[str], float]] = LRUCache(
+            max_entries=claims_cache_max_entries, ttl=groups_cache_ttl
+        )
+        self.groups_refreshes: dict[str, asyncio.Task] = {}
+        # Requests that waited for Microsoft Graph, and refreshes that ran in the background instead
+        self.graph_requests = 0
+        self.graph_background_refreshes = 0
+        self.graph_session: Optional[aiohttp.ClientSession] = None
 
         if self.use_authentication:
             field_names = [field.name for field in search_index.fields] if search_index else []
@@ -47,6 +75,8 @@ class AuthenticationHelper:
             self.confidential_client = ConfidentialClientApplication(
                 server_app_id, authority=self.authority, client_credential=server_app_secret, token_cache=TokenCache()
             )
+            # MSAL makes blocking network calls, so they run in a bounded thread pool instead of on the event loop
+            self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="msal")
         else:
             self.has_auth_fields = False
             self.require_access_control = False
@@ -109,6 +139,16 @@ class AuthenticationHelper:
 
         raise AuthError(error="Authorization header is expected", status_code=401)
 
+    @staticmethod
+    def get_token_expiry(token: str) -> Optional[float]:
+        # Reads the exp claim of a JWT without validating it, the token is validated by the On Behalf Of exchange
+        try:
+            payload = token.split(".")[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+            return float(claims["exp"])
+        except (IndexError, KeyError, TypeError, ValueError, binascii.Error):
+            return None
+
     def build_security_filters(self, overrides: dict[str, Any], auth_claims: dict[str, Any]):
         # Build different permutations of the oid or groups security filter using OData filters
         # https://learn.microsoft.com/azure/search/search-security-trimming-for-azure-search
@@ -143,34 +183,57 @@ class AuthenticationHelper:
             return None
 
     @staticmethod
-    async def list_groups(graph_resource_access_token: dict) -> list[str]:
+    async def list_groups(
+        graph_resource_access_token: dict, session: Optional[aiohttp.ClientSession] = None
+    ) -> list[str]:
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await AuthenticationHelper.list_groups(graph_resource_access_token, session)
+
         headers = {"Authorization": "Bearer " + graph_resource_access_token["access_token"]}
-        groups = []
-        async with aiohttp.ClientSession(headers=headers) as session:
-            resp_json = None
-            resp_status = None
-            async with session.get(url="https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id") as resp:
+        groups: list[str] = []
+        # Each page links to the next one, so pages can't be fetched in parallel. Ask for the largest page size instead,
+        # which returns the groups of most users in a single round trip.
+        url: Optional[str] = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id&$top=999"
+        while url:
+            async with session.get(url=url, headers=headers) as resp:
                 resp_json = await resp.json()
-                resp_status = resp.status
-                if resp_status != 200:
-                    raise AuthError(error=json.dumps(resp_json), status_code=resp_status)
-
-            while resp_status == 200:
-                value = resp_json["value"]
-                for group in value:
-                    groups.append(group["id"])
-                next_link = resp_json.get("@odata.nextLink")
-                if next_link:
-                    async with session.get(url=next_link) as resp:
-                        resp_json = await resp.json()
-                        resp_status = resp.status
-                else:
-                    break
-            if resp_status != 200:
-                raise AuthError(error=json.dumps(resp_json), status_code=resp_status)
+                if resp.status != 200:
+                    raise AuthError(error=json.dumps(resp_json), status_code=resp.status)
+            groups.extend(group["id"] for group in resp_json["value"])
+            url = resp_json.get("@odata.nextLink")
+        return groups
+
+    async def get_groups(self, oid: str, graph_resource_access_token: dict) -> list[str]:
+        cached = self.groups_cache.get(oid) if self.groups_cache_ttl > 0 else None
+        if cached is None:
+            self.graph_requests += 1
+            return await self.fetch_groups(oid, graph_resource_access_token)
 
+        groups, refresh_at = cached
+        if time.monotonic() >= refresh_at and oid not in self.groups_refreshes:
+            # Refresh the groups ahead of their expiry in the background, so that active users rarely wait for Graph
+            self.graph_background_refreshes += 1
+            refresh = asyncio.create_task(self.refresh_groups(oid, graph_resource_access_token))
+            self.groups_refreshes[oid] = refresh
+            refresh.add_done_callback(lambda _: self.groups_refreshes.pop(oid, None))
+        return list(groups)
+
+    async def fetch_groups(self, oid: str, graph_resource_access_token: dict) -> list[str]:
+        if self.graph_session is None or self.graph_session.closed:
+            self.graph_session = aiohttp.ClientSession()
+        groups = await AuthenticationHelper.list_groups(graph_resource_access_token, self.graph_session)
+        if self.groups_cache_ttl > 0:
+            self.groups_cache.set(oid, (groups, time.monotonic() + self.groups_cache_ttl * 0.8))
         return groups
 
+    async def refresh_groups(self, oid: str, graph_resource_access_token: dict):
+        try:
+            await self.fetch_groups(oid, graph_resource_access_token)
+        except Exception:
+            # The cached groups stay in use until they expire, the next request after that reads them from Graph
+            logging.exception("Exception refreshing the groups of a user")
+
     async def get_auth_claims_if_enabled(self, headers: dict) -> dict[str, Any]:
         if not self.use_authentication:
             return {}
@@ -179,30 +242,19 @@ class AuthenticationHelper:
             # The scope is set to the Microsoft Graph API, which may need to be called for more authorization information
             # https://learn.microsoft.com/en-us/azure/active-directory/develop/v2-oauth2-on-behalf-of-flow
             auth_token = AuthenticationHelper.get_token_auth_header(headers)
-            graph_resource_access_token = self.confidential_client.acquire_token_on_behalf_of(
-                user_assertion=auth_token, scopes=["https://graph.microsoft.com/.default"]
-            )
-            if "error" in graph_resource_access_token:
-                raise AuthError(error=str(graph_resource_access_token), status_code=401)
-
-            # Read the claims from the response. The oid and groups claims are used for security filtering
-            # https://learn.microsoft.com/azure/active-directory/develop/id-token-claims-reference
-            id_token_claims = graph_resource_access_token["id_token_claims"]
-            auth_claims = {"oid": id_token_claims["oid"], "groups": id_token_claims.get("groups") or []}
-
-            # A groups claim may have been omitted either because it was not added in the application manifest for the API application,
-            # or a groups overage claim may have been emitted.
-            # https://learn.microsoft.com/azure/active-directory/develop/id-token-claims-reference#groups-overage-claim
-            missing_groups_claim = "groups" not in id_token_claims
-            has_group_overage_claim = (
-                missing_groups_claim
-                and "_claim_names" in id_token_claims
-                and "groups" in id_token_claims["_claim_names"]
-            )
-            if missing_groups_claim or has_group_overage_claim:
-                # Read the user's groups from Microsoft Graph
-                auth_claims["groups"] = await AuthenticationHelper.list_groups(graph_resource_access_token)
-            return auth_claims
+            token_hash = hashlib.sha256(auth_token.encode("utf-8")).hexdigest()
+            auth_claims = self.claims_cache.get(token_hash)
+            if auth_claims is None:
+                exchange = self.pending_claims.get(token_hash)
+                if exchange is None:
+                    exchange = asyncio.ensure_future(self.exchange_token(auth_token, token_hash))
+                    self.pending_claims[token_hash] = exchange
+                    exchange.add_done_callback(lambda _: self.pending_claims.pop(token_hash, None))
+                else:
+                    self.shared_exchanges += 1
+                # A request that is cancelled doesn't cancel the exchange the other requests are waiting for
+                auth_claims = await asyncio.shield(exchange)
+            return {**auth_claims, "groups": list(auth_claims["groups"])}
         except AuthError as e:
             print(e.error)
             logging.exception("Exception getting authorization information - " + json.dumps(e.error))
@@ -214,3 +266,55 @@ class AuthenticationHelper:
             if self.require_access_control:
                 raise
             return {}
+
+    async def exchange_token(self, auth_token: str, token_hash: str) -> dict[str, Any]:
+        self.exchanges += 1
+        graph_resource_access_token = await asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            lambda: self.confidential_client.acquire_token_on_behalf_of(
+                user_assertion=auth_token, scopes=["https://graph.microsoft.com/.default"]
+            ),
+        )
+        if "error" in graph_resource_access_token:
+            raise AuthError(error=str(graph_resource_access_token), status_code=401)
+
+        # Read the claims from the response. The oid and groups claims are used for security filtering
+        # https://learn.microsoft.com/azure/active-directory/develop/id-token-claims-reference
+        id_token_claims = graph_resource_access_token["id_token_claims"]
+        auth_claims = {"oid": id_token_claims["oid"], "groups": id_token_claims.get("groups") or []}
+
+        # A groups claim may have been omitted either because it was not added in the application manifest for the API application,
+        # or a groups overage claim may have been emitted.
+        # https://learn.microsoft.com/azure/active-directory/develop/id-token-claims-reference#groups-overage-claim
+        missing_groups_claim = "groups" not in id_token_claims
+        has_group_overage_claim = (
+            missing_groups_claim and "_claim_names" in id_token_claims and "groups" in id_token_claims["_claim_names"]
+        )
+        if missing_groups_claim or has_group_overage_claim:
+            # Read the user's groups from Microsoft Graph
+            auth_claims["groups"] = await self.get_groups(auth_claims["oid"], graph_resource_access_token)
+
+        # Keep the claims until the access token expires, or for as long as the Graph token is valid if it can't be read
+        expiry = AuthenticationHelper.get_token_expiry(auth_token)
+        ttl = expiry - time.time() if expiry else float(graph_resource_access_token.get("expires_in", 0))
+        if ttl > 0:
+            self.claims_cache.set(token_hash, auth_claims, ttl=ttl)
+        return auth_claims
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            **self.claims_cache.stats.to_dict(),
+            "exchanges": self.exchanges,
+            "shared_exchanges": self.shared_exchanges,
+            "groups": {
+                **self.groups_cache.stats.to_dict(),
+                "graph_requests": self.graph_requests,
+                "graph_background_refreshes": self.graph_background_refreshes,
+            },
+        }
+
+    async def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
+        if self.graph_session:
+            await self.graph_session.close()
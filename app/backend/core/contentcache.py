@@ -0,0 +1,182 @@
+import asyncio
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+from typing import AsyncGenerator, BinaryIO, Optional, Union
+
+from azure.core import MatchConditions
+from azure.core.exceptions import AzureError
+from azure.storage.blob.aio import BlobClient
+
+from core.lrucache import LRUCache
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class CachedContent:
+    """
+    The bytes of a blob version held by the ContentCache, either in memory or memory-mapped from a file of the disk tier.
+    Files are mapped when they are looked up, so their bytes stay readable even if the file is evicted
+    while the response is being sent.
+    """
+
+    def __init__(self, data: Union[bytes, mmap.mmap]):
+        self.data = data
+
+    async def iter_bytes(self, start: int, stop: int) -> AsyncGenerator[bytes, None]:
+        if isinstance(self.data, bytes):
+            yield self.data if start == 0 and stop == len(self.data) else self.data[start:stop]
+            return
+
+        # ASGI requires each chunk to be a bytes object, so every chunk is copied out of the mapping as it is sent.
+        # The copies are bounded by CHUNK_SIZE rather than the size of the file, but a disk hit is not zero-copy.
+        # Slicing may page the file in from disk, so it runs in a thread to keep the event loop free.
+        try:
+            for offset in range(start, stop, CHUNK_SIZE):
+                yield await asyncio.to_thread(self.data.__getitem__, slice(offset, min(offset + CHUNK_SIZE, stop)))
+        finally:
+            self.close()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+
+class ContentCache:
+    """
+    Per-worker cache for the files served by the /content route, keyed by blob name and ETag.
+    Small blobs are kept in an in-memory LRU bounded by bytes. If a directory is given, larger blobs are
+    written to a disk tier (also an LRU bounded by bytes) in the background the first time they are requested.
+    Callers revalidate entries by reading the blob properties first and looking up the current ETag,
+    so a blob that was overwritten is never served from the cache.
+    """
+
+    def __init__(
+        self,
+        max_memory_bytes: int,
+        max_memory_entry_bytes: int,
+        disk_dir: Optional[str] = None,
+        max_disk_bytes: int = 0,
+    ):
+        self.max_memory_entry_bytes = max_memory_entry_bytes
+        self.memory: LRUCache[tuple[str, str], bytes] = LRUCache(max_bytes=max_memory_bytes, sizeof=len)
+        self.disk: Optional[LRUCache[tuple[str, str], str]] = None
+        self.disk_dir: Optional[str] = None
+        if disk_dir and max_disk_bytes > 0:
+            # Each worker gets its own directory since the LRU bookkeeping lives in the worker process
+            self.disk_dir = os.path.join(disk_dir, f"worker-{os.getpid()}")
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self.disk = LRUCache(max_bytes=max_disk_bytes, on_evict=lambda key, file_path: self._remove_file(file_path))
+        self.hits = 0
+        self.misses = 0
+        self.disk_fills: dict[tuple[str, str], asyncio.Task] = {}
+
+    async def get(self, blob_client: BlobClient, name: str, etag: str, size: int) -> Optional[CachedContent]:
+        """
+        Returns the cached content for this version of the blob. On a miss, blobs small enough for the memory tier
+        are downloaded and cached right away, while larger blobs are scheduled to be written to the disk tier
+        and None is returned so the caller streams them from storage.
+        None is also returned if the blob can't be downloaded, so the caller handles the error while streaming it.
+        """
+        key = (name, etag)
+        content = self.memory.get(key)
+        if content is not None:
+            self.hits += 1
+            return CachedContent(content)
+        file_path = self.disk.get(key) if self.disk is not None else None
+        if file_path is not None:
+            try:
+                mapped = await asyncio.to_thread(self._map_file, file_path)
+            except (OSError, ValueError):
+                # The file was evicted while it was being opened
+                logging.warning("Failed to open %s from the content cache", name, exc_info=True)
+            else:
+                self.hits += 1
+                return CachedContent(mapped)
+
+        self.misses += 1
+        self._discard_other_versions(name, etag)
+        if size <= self.max_memory_entry_bytes:
+            try:
+                blob = await blob_client.download_blob(etag=etag, match_condition=MatchConditions.IfNotModified)
+                content = await blob.readall()
+            except AzureError:
+                logging.warning("Failed to download %s into the content cache", name, exc_info=True)
+                return None
+            self.memory.set(key, content)
+            return CachedContent(content)
+        if self.disk is not None and self.disk.max_bytes is not None and size <= self.disk.max_bytes:
+            if key not in self.disk_fills:
+                self.disk_fills[key] = asyncio.create_task(self._fill_disk(blob_client, key))
+        return None
+
+    def get_stats(self) -> dict:
+        memory_stats = self.memory.stats.to_dict()
+        disk_stats = self.disk.stats.to_dict() if self.disk is not None else None
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory": memory_stats,
+            "disk": disk_stats,
+            "disk_fills_in_progress": len(self.disk_fills),
+        }
+
+    async def close(self):
+        for task in self.disk_fills.values():
+            task.cancel()
+        await asyncio.gather(*self.disk_fills.values(), return_exceptions=True)
+        self.memory.clear()
+        if self.disk is not None and self.disk_dir:
+            self.disk.clear()
+            await asyncio.to_thread(shutil.rmtree, self.disk_dir, ignore_errors=True)
+
+    async def _fill_disk(self, blob_client: BlobClient, key: tuple[str, str]):
+        assert self.disk is not None and self.disk_dir is not None
+        file_path = os.path.join(self.disk_dir, hashlib.sha256(f"{key[0]}\n{key[1]}".encode()).hexdigest())
+        temp_path = f"{file_path}.download"
+        try:
+            size = 0
+            blob = await blob_client.download_blob(etag=key[1], match_condition=MatchConditions.IfNotModified)
+            # File operations run in a thread so that a slow disk doesn't block the event loop
+            file: BinaryIO = await asyncio.to_thread(open, temp_path, "wb")
+            try:
+                async for chunk in blob.chunks():
+                    await asyncio.to_thread(file.write, chunk)
+                    size += len(chunk)
+            finally:
+                await asyncio.to_thread(file.close)
+            await asyncio.to_thread(os.replace, temp_path, file_path)
+            self.disk.set(key, file_path, size=size)
+            if key not in self.disk:
+                # The file was bigger than the whole disk budget
+                self._remove_file(file_path)
+        except Exception:
+            logging.exception("Failed to write %s to the content cache", key[0])
+            self._remove_file(temp_path)
+        finally:
+            self.disk_fills.pop(key, None)
+
+    def _discard_other_versions(self, name: str, etag: str):
+        # Entries for older versions of a blob can never be hit again, so free their space right away
+        for tier in (self.memory, self.disk):
+            if tier is not None:
+                for key in tier.keys():
+                    if key[0] == name and key[1] != etag:
+                        value = tier.pop(key)
+                        if isinstance(value, str):
+                            self._remove_file(value)
+
+    @staticmethod
+    def _map_file(file_path: str) -> mmap.mmap:
+        # The mapping keeps the bytes available after the file descriptor is closed or the file is removed
+        with open(file_path, "rb") as file:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def _remove_file(file_path: str):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,34 @@
+import unicodedata
+from array import array
+from typing import Any, Optional
+
+from core.lrucache import LRUCache
+
+
+class EmbeddingCache:
+    """
+    Per-worker cache of the query embeddings computed by the approaches, so that recurring questions don't call
+    the embedding models again. Entries are keyed by the model that computed them (e.g. the OpenAI deployment or the
+    vision endpoint and model version) and the normalized query text. Vectors are stored as float32 arrays,
+    which take an eighth of the memory of a list of Python floats.
+    """
+
+    def __init__(self, max_entries: int, ttl: Optional[float]):
+        self.cache: LRUCache[tuple[str, str], array] = LRUCache(
+            max_entries=max_entries, ttl=ttl, sizeof=lambda vector: vector.itemsize * len(vector)
+        )
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        # Queries that only differ by Unicode normalization form or whitespace get the same embedding
+        return " ".join(unicodedata.normalize("NFKC", text).split())
+
+    def get(self, model: str, text: str) -> Optional[list[float]]:
+        vector = self.cache.get((model, self.normalize(text)))
+        return vector.tolist() if vector is not None else None
+
+    def set(self, model: str, text: str, vector: list[float]):
+        self.cache.set((model, self.normalize(text)), array("f", vector))
+
+    def get_stats(self) -> dict[str, Any]:
+        return self.cache.stats.to_dict()
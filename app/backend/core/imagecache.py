@@ -0,0 +1,32 @@
+from typing import Any, Optional
+
+from core.lrucache import LRUCache
+
+
+class ImageCache:
+    """
+    Per-worker cache of the page images sent to GPT-4 with Vision, as base64 data URLs, so that pages which are often
+    retrieved aren't downloaded and encoded again. Entries are keyed by blob name and hold the ETag of the version
+    they were encoded from. Callers revalidate them with a conditional download, which returns no bytes while the blob
+    is unchanged, so a page image that was overwritten is never sent from the cache.
+    """
+
+    def __init__(self, max_bytes: int):
+        # A data URL is ASCII, so its length is its size in bytes
+        self.cache: LRUCache[str, tuple[str, str]] = LRUCache(max_bytes=max_bytes, sizeof=lambda entry: len(entry[1]))
+        self.stale = 0
+
+    def get(self, blob_name: str) -> Optional[tuple[str, str]]:
+        """Returns the ETag and the data URL of the cached version of the blob, if any"""
+        return self.cache.get(blob_name)
+
+    def set(self, blob_name: str, etag: str, url: str):
+        self.cache.set(blob_name, (etag, url))
+
+    def mark_stale(self, blob_name: str):
+        # The blob changed since it was cached
+        self.cache.pop(blob_name)
+        self.stale += 1
+
+    def get_stats(self) -> dict[str, Any]:
+        return {**self.cache.stats.to_dict(), "stale": self.stale}
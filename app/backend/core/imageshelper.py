@@ -1,11 +1,24 @@
+import asyncio
 import base64
 import os
+import threading
 from typing import Optional
 
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotModifiedError
 from azure.storage.blob.aio import ContainerClient
 from typing_extensions import Literal, Required, TypedDict
 
 from approaches.approach import Document
+from core.imagecache import ImageCache
+
+# Images bigger than this are encoded in a thread, so that the encoding doesn't block the event loop
+THREAD_ENCODE_MIN_BYTES = 256 * 1024
+# Encoding holds the GIL, so the thread encodes chunks of this size (a multiple of 3 bytes, so that their encodings can
+# be joined) and the event loop takes the GIL back between them. Threads encode one image at a time, as several threads
+# competing for the GIL would keep it from the event loop for longer.
+THREAD_ENCODE_CHUNK_BYTES = 3 * 16 * 1024
+thread_encode_lock = threading.Lock()
 
 
 class ImageURL(TypedDict, total=False):
@@ -16,21 +29,74 @@ class ImageURL(TypedDict, total=False):
     """Specifies the detail level of the image."""
 
 
-async def download_blob_as_base64(blob_container_client: ContainerClient, file_path: str) -> Optional[str]:
+def encode_data_url(data: bytes) -> str:
+    return f"data:image/png;base64,{base64.b64encode(data).decode('utf-8')}"
+
+
+def encode_data_url_in_chunks(data: bytes) -> str:
+    view = memoryview(data)
+    with thread_encode_lock:
+        encoded = b"".join(
+            base64.b64encode(view[start : start + THREAD_ENCODE_CHUNK_BYTES])
+            for start in range(0, len(data), THREAD_ENCODE_CHUNK_BYTES)
+        )
+    return f"data:image/png;base64,{encoded.decode('utf-8')}"
+
+
+async def download_blob_as_base64(
+    blob_container_client: ContainerClient, file_path: str, image_cache: Optional[ImageCache] = None
+) -> Optional[str]:
     base_name, _ = os.path.splitext(file_path)
-    blob = await blob_container_client.get_blob_client(base_name + ".png").download_blob()
+    blob_name = base_name + ".png"
+    blob_client = blob_container_client.get_blob_client(blob_name)
+    cached = image_cache.get(blob_name) if image_cache else None
+    if image_cache and cached:
+        etag, url = cached
+        try:
+            # Only downloads the blob if it changed since it was cached
+            blob = await blob_client.download_blob(etag=etag, match_condition=MatchConditions.IfModified)
+        except ResourceNotModifiedError:
+            return url
+        image_cache.mark_stale(blob_name)
+    else:
+        blob = await blob_client.download_blob()
 
     if not blob.properties:
         return None
-    img = base64.b64encode(await blob.readall()).decode("utf-8")
-    return f"data:image/png;base64,{img}"
+    data = await blob.readall()
+    if len(data) >= THREAD_ENCODE_MIN_BYTES:
+        url = await asyncio.to_thread(encode_data_url_in_chunks, data)
+    else:
+        url = encode_data_url(data)
+    if image_cache and blob.properties.etag:
+        image_cache.set(blob_name, blob.properties.etag, url)
+    return url
 
 
-async def fetch_image(blob_container_client: ContainerClient, result: Document) -> Optional[ImageURL]:
+async def fetch_image(
+    blob_container_client: ContainerClient, result: Document, image_cache: Optional[ImageCache] = None
+) -> Optional[ImageURL]:
     if result.sourcepage:
-        img = await download_blob_as_base64(blob_container_client, result.sourcepage)
+        img = await download_blob_as_base64(blob_container_client, result.sourcepage, image_cache)
         if img:
             return {"url": img, "detail": "auto"}
         else:
             return None
     return None
+
+
+async def fetch_images(
+    blob_container_client: ContainerClient,
+    results: list[Document],
+    image_cache: Optional[ImageCache] = None,
+    max_concurrency: int = 4,
+) -> list[ImageURL]:
+    """Fetches the page images of the results, at most max_concurrency at once, in the order of the results"""
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch(result: Document) -> Optional[ImageURL]:
+        async with semaphore:
+            return await fetch_image(blob_container_client, result, image_cache)
+
+    images = await asyncio.gather(*(fetch(result) for result in results))
+    return [image for image in images if image]
@@ -0,0 +1,223 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+from collections import OrderedDict, deque
+from dataclasses import asdict, dataclass, field
+from typing import Any, Awaitable, Callable, Optional
+
+# Lines that scripts/prepdocs.py prints in verbose mode, and the stage of the ingestion each of them starts
+STAGE_MARKERS = [
+    ("Ensuring search index", "preparing_index"),
+    ("Extracting text from", "parsing"),
+    ("Splitting", "splitting"),
+    ("Uploading blob", "uploading"),
+    ("Computing embeddings", "embedding"),
+    ("Indexing", "indexing"),
+]
+JOB_ID_PATTERN = re.compile("[0-9a-f]{32}")
+
+
+@dataclass
+class IngestionJob:
+    id: str
+    filename: str
+    directory: str
+    args: list[str]
+    status: str = "queued"  # queued, running, succeeded or failed
+    stage: str = "queued"
+    # The stages the job went through, with the time they started and how long they took
+    stages: list[dict[str, Any]] = field(default_factory=list)
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, self.filename)
+
+    def start_stage(self, stage: str):
+        now = time.time()
+        if self.stages and self.stages[-1]["seconds"] is None:
+            self.stages[-1]["seconds"] = round(now - self.stages[-1]["started_at"], 3)
+        self.stage = stage
+        if stage not in ("succeeded", "failed"):
+            self.stages.append({"stage": stage, "started_at": now, "seconds": None})
+
+    def to_dict(self) -> dict[str, Any]:
+        status = asdict(self)
+        # The directory and the command line are internal, and the command line can include keys
+        del status["directory"], status["args"]
+        return status
+
+
+class IngestionQueue:
+    """
+    Runs the ingestion of uploaded documents (scripts/prepdocs.py) in the background, so that uploads return right away
+    instead of blocking the worker for the whole parse, embed and index run.
+    Jobs wait in a bounded queue and at most max_concurrent_jobs of them run at once, each in its own process
+    with a lower CPU priority than the app, so ingestion never starves the chat requests of the worker.
+    The progress of a job is read from the output of prepdocs, and written to a file of jobs_dir each time
+    it changes, so that any worker of the host can report the status of a job.
+    Attributes:
+        jobs_dir (str): Directory for the uploaded files and the status of the jobs.
+        max_concurrent_jobs (int): Number of jobs that run at once.
+        max_queued_jobs (int): Number of jobs that can wait, submit() raises asyncio.QueueFull beyond that.
+        timeout (float): Number of seconds after which a running job is killed.
+        on_success (Callable[[str], Awaitable[None]]): Called with the file name once a job added it to the index.
+        retention (float): Number of seconds the status of a finished job is kept.
+    """
+
+    def __init__(
+        self,
+        jobs_dir: str,
+        max_concurrent_jobs: int,
+        max_queued_jobs: int,
+        timeout: float,
+        on_success: Optional[Callable[[str], Awaitable[None]]] = None,
+        retention: float = 86400,
+    ):
+        self.jobs_dir = jobs_dir
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.timeout = timeout
+        self.on_success = on_success
+        self.retention = retention
+        self.queue: asyncio.Queue[IngestionJob] = asyncio.Queue(maxsize=max_queued_jobs)
+        self.jobs: OrderedDict[str, IngestionJob] = OrderedDict()
+        self.workers: list[asyncio.Task] = []
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def start(self):
+        self.workers = [asyncio.create_task(self.work()) for _ in range(self.max_concurrent_jobs)]
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def create_job(self, filename: str) -> IngestionJob:
+        """
+        Creates a job and the directory its file is saved to, the job runs once it is passed to submit().
+        """
+        job_id = uuid.uuid4().hex
+        directory = os.path.join(self.jobs_dir, job_id)
+        os.makedirs(directory)
+        return IngestionJob(id=job_id, filename=filename, directory=directory, args=[])
+
+    def submit(self, job: IngestionJob, args: list[str]):
+        """
+        Queues a job to run the given command line, the path of the job's file is appended to it.
+        Raises asyncio.QueueFull when too many jobs are waiting already.
+        """
+        job.args = [*args, job.path]
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            shutil.rmtree(job.directory, ignore_errors=True)
+            raise
+        self.prune()
+        self.jobs[job.id] = job
+        job.start_stage("queued")
+        self.save(job)
+
+    def get(self, job_id: str) -> Optional[dict[str, Any]]:
+        if not JOB_ID_PATTERN.fullmatch(job_id):
+            return None
+        if job := self.jobs.get(job_id):
+            return job.to_dict()
+        # Jobs submitted to another worker of the host
+        try:
+            with open(os.path.join(self.jobs_dir, f"{job_id}.json"), encoding="utf-8") as status_file:
+                return json.load(status_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def save(self, job: IngestionJob):
+        # Written to a temporary file and renamed, so that other workers never read a partial status
+        path = os.path.join(self.jobs_dir, f"{job.id}.json")
+        with open(f"{path}.tmp", "w", encoding="utf-8") as status_file:
+            json.dump(job.to_dict(), status_file)
+        os.replace(f"{path}.tmp", path)
+
+    def prune(self):
+        expired = time.time() - self.retention
+        for job in list(self.jobs.values()):
+            if job.finished_at is not None and job.finished_at < expired:
+                del self.jobs[job.id]
+                try:
+                    os.remove(os.path.join(self.jobs_dir, f"{job.id}.json"))
+                except FileNotFoundError:
+                    pass
+
+    async def work(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.run(job)
+            finally:
+                self.queue.task_done()
+
+    async def run(self, job: IngestionJob):
+        job.status = "running"
+        job.start_stage("starting")
+        self.save(job)
+        output: deque[str] = deque(maxlen=20)
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *job.args,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                preexec_fn=lower_priority if hasattr(os, "nice") else None,
+            )
+            try:
+                await asyncio.wait_for(self.read_progress(job, process, output), self.timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                raise RuntimeError(f"Ingestion did not finish within {self.timeout:.0f} seconds")
+            except asyncio.CancelledError:
+                process.kill()
+                raise
+            if process.returncode != 0:
+                raise RuntimeError(f"Ingestion exited with code {process.returncode}: {' | '.join(output)}")
+        except Exception as error:
+            logging.exception("Ingestion job %s for %s failed", job.id, job.filename)
+            job.status = "failed"
+            job.error = str(error)
+        else:
+            job.status = "succeeded"
+            if self.on_success:
+                await self.on_success(job.filename)
+        finally:
+            job.finished_at = time.time()
+            job.start_stage(job.status)
+            shutil.rmtree(job.directory, ignore_errors=True)
+            self.save(job)
+
+    async def read_progress(self, job: IngestionJob, process: asyncio.subprocess.Process, output: deque[str]):
+        assert process.stdout is not None
+        async for raw_line in process.stdout:
+            line = raw_line.decode("utf-8", errors="replace").strip()
+            if not line:
+                continue
+            output.append(line)
+            for marker, stage in STAGE_MARKERS:
+                if line.startswith(marker) and stage != job.stage:
+                    job.start_stage(stage)
+                    self.save(job)
+                    break
+        await process.wait()
+
+    def get_stats(self) -> dict[str, Any]:
+        statuses = [job.status for job in self.jobs.values()]
+        return {status: statuses.count(status) for status in ("queued", "running", "succeeded", "failed")}
+
+
+def lower_priority():
+    # Runs in the child process before prepdocs starts
+    os.nice(10)
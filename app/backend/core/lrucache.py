@@ -0,0 +1,121 @@
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    entries: int = 0
+    bytes: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def to_dict(self) -> dict[str, Any]:
+        return {**asdict(self), "hit_rate": round(self.hit_rate, 4)}
+
+
+class LRUCache(Generic[K, V]):
+    """
+    A least-recently-used cache bounded by number of entries and/or total size in bytes, with an optional time-to-live.
+    Entries are evicted oldest first once either bound is exceeded, and expired entries are dropped when they are looked up.
+    The cache is not thread safe, it is meant to be used from a single event loop.
+    Attributes:
+        max_entries (int | None): Maximum number of entries, or None for no limit.
+        max_bytes (int | None): Maximum total size of the entries as measured by sizeof, or None for no limit.
+        ttl (float | None): Number of seconds an entry stays valid after it is set, or None to never expire.
+        sizeof (Callable): Returns the size in bytes of a value, used with max_bytes.
+        on_evict (Callable | None): Called with the key and value of every entry removed by eviction or expiry.
+    """
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        ttl: Optional[float] = None,
+        sizeof: Callable[[V], int] = lambda value: 0,
+        on_evict: Optional[Callable[[K, V], None]] = None,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+        self.stats = CacheStats()
+        # Maps each key to (value, size in bytes, monotonic expiry time or None)
+        self._entries: OrderedDict[K, tuple[V, int, Optional[float]]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        return self._get_entry(key) is not None
+
+    def get(self, key: K) -> Optional[V]:
+        entry = self._get_entry(key)
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def set(self, key: K, value: V, size: Optional[int] = None, ttl: Optional[float] = None):
+        """
+        Stores a value, replacing any previous value for the key, and evicts the least recently used entries if needed.
+        A value that is bigger than max_bytes on its own is not stored.
+        """
+        size = self.sizeof(value) if size is None else size
+        self.pop(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        self._entries[key] = (value, size, time.monotonic() + ttl if ttl is not None else None)
+        self.stats.bytes += size
+        self.stats.entries = len(self._entries)
+        while (self.max_entries is not None and len(self._entries) > self.max_entries) or (
+            self.max_bytes is not None and self.stats.bytes > self.max_bytes
+        ):
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.stats.evictions += 1
+
+    def pop(self, key: K) -> Optional[V]:
+        """Removes an entry without counting it as an eviction and returns its value, if any."""
+        if key not in self._entries:
+            return None
+        value, size, _ = self._entries.pop(key)
+        self.stats.bytes -= size
+        self.stats.entries = len(self._entries)
+        return value
+
+    def keys(self) -> list[K]:
+        return list(self._entries.keys())
+
+    def clear(self):
+        for key in list(self._entries.keys()):
+            self._remove(key)
+
+    def _get_entry(self, key: K) -> Optional[tuple[V, int, Optional[float]]]:
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] is not None and entry[2] <= time.monotonic():
+            self._remove(key)
+            self.stats.expirations += 1
+            return None
+        return entry
+
+    def _remove(self, key: K):
+        value = self._entries[key][0]
+        self.pop(key)
+        if self.on_evict:
+            self.on_evict(key, value)
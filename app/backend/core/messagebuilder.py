@@ -22,6 +22,7 @@ class MessageBuilder:
     Methods:
         __init__(self, system_content: str, chatgpt_model: str): Initializes the MessageBuilder instance.
         insert_message(self, role: str, content: str, index: int = 1): Inserts a new message to the conversation.
+        insert_messages(self, messages: list, index: int = 1): Inserts several messages to the conversation at once.
     """
 
     def __init__(self, system_content: str, chatgpt_model: str):
@@ -39,6 +40,21 @@ class MessageBuilder:
             content (str | List[ChatCompletionContentPartParam]): The content of the message.
             index (int): The index at which to insert the message.
         """
+        self.messages.insert(index, self.build_message(role, content))
+
+    def insert_messages(self, messages: list[dict[str, str]], index: int = 1):
+        """
+        Inserts messages into the conversation at the specified index, in their order, with a single shift of the
+        messages after them.
+        Args:
+            messages (list): The messages to insert, each with a "role" and a "content".
+            index (int): The index at which to insert the first message.
+        """
+        self.messages[index:index] = [self.build_message(message["role"], message["content"]) for message in messages]
+
+    def build_message(
+        self, role: str, content: Union[str, List[ChatCompletionContentPartParam]]
+    ) -> ChatCompletionMessageParam:
         message: ChatCompletionMessageParam
         if role == "user":
             message = ChatCompletionUserMessageParam(role="user", content=self.normalize_content(content))
@@ -50,7 +66,7 @@ class MessageBuilder:
             )
         else:
             raise ValueError(f"Invalid role: {role}")
-        self.messages.insert(index, message)
+        return message
 
     def count_tokens_for_message(self, message: dict[str, str]):
         return num_tokens_from_messages(message, self.model)
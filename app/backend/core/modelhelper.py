@@ -1,7 +1,19 @@
 from __future__ import annotations
 
+import base64
+import binascii
+import hashlib
+import logging
+import math
+import re
+import struct
+from functools import lru_cache
+from typing import Any
+
 import tiktoken
 
+from core.lrucache import LRUCache
+
 MODELS_2_TOKEN_LIMITS = {
     "gpt-35-turbo": 4000,
     "gpt-3.5-turbo": 4000,
@@ -15,6 +27,26 @@ MODELS_2_TOKEN_LIMITS = {
 
 AOAI_2_OAI = {"gpt-35-turbo": "gpt-3.5-turbo", "gpt-35-turbo-16k": "gpt-3.5-turbo-16k", "gpt-4v": "gpt-4-turbo-vision"}
 
+# Token counts of the texts of the messages, keyed by encoding and a hash of the text. Clients send the whole
+# conversation with every request, so the history is counted once per process instead of once per turn.
+TOKEN_COUNT_CACHE_MAX_ENTRIES = 10000
+token_count_cache: LRUCache[tuple[str, bytes], int] = LRUCache(max_entries=TOKEN_COUNT_CACHE_MAX_ENTRIES)
+
+# Cost of an image, see https://platform.openai.com/docs/guides/vision/calculating-costs: a low detail image costs the
+# base tokens, a high detail image also costs the tile tokens for each tile of 512px once it is scaled to fit within
+# 2048x2048 and then, if its shortest side is still longer, to a shortest side of 768px.
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+IMAGE_TILE_SIZE = 512
+IMAGE_MAX_SIZE = 2048
+IMAGE_MAX_SHORTEST_SIZE = 768
+# Images whose size can't be read are costed as the most expensive high detail image
+IMAGE_UNKNOWN_DIMENSIONS = (IMAGE_MAX_SHORTEST_SIZE, IMAGE_MAX_SIZE)
+PNG_DATA_URL_PREFIX = "data:image/png;base64,"
+
+# The end of a sentence, where a text that doesn't fit within a token limit is cut
+SENTENCE_END = re.compile(r"[.!?](?=\s|$)")
+
 
 def get_token_limit(model_id: str) -> int:
     if model_id not in MODELS_2_TOKEN_LIMITS:
@@ -37,19 +69,119 @@ def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
         output: 11
     """
 
-    encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+    encoding = get_encoding(model)
     num_tokens = 2  # For "role" and "content" keys
     for key, value in message.items():
         if isinstance(value, list):
             for v in value:
-                # TODO: Update token count for images https://github.com/openai/openai-cookbook/pull/881/files
                 if isinstance(v, str):
-                    num_tokens += len(encoding.encode(v))
+                    num_tokens += num_tokens_from_text(v, encoding)
+                elif v.get("type") == "text":
+                    num_tokens += num_tokens_from_text(v["text"], encoding)
+                elif v.get("type") == "image_url":
+                    num_tokens += num_tokens_from_image_url(v["image_url"])
         else:
-            num_tokens += len(encoding.encode(value))
+            num_tokens += num_tokens_from_text(value, encoding)
     return num_tokens
 
 
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Returns the encoding of a chat model, which is only looked up once per process"""
+    return tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+
+
+def num_tokens_from_text(text: str, encoding: tiktoken.Encoding) -> int:
+    """Returns the number of tokens of a text, from the token count cache if it was counted before"""
+    key = (encoding.name, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+    num_tokens = token_count_cache.get(key)
+    if num_tokens is None:
+        num_tokens = len(encoding.encode(text))
+        token_count_cache.set(key, num_tokens)
+    return num_tokens
+
+
+def trim_text_to_sentence(text: str, max_tokens: int, encoding: tiktoken.Encoding) -> str:
+    """Returns the longest start of the text that ends with a sentence and fits within max_tokens, which may be empty"""
+    if max_tokens <= 0:
+        return ""
+    head = encoding.decode(encoding.encode(text)[:max_tokens])
+    end = 0
+    for match in SENTENCE_END.finditer(head):
+        end = match.end()
+    return head[:end]
+
+
+def get_image_dimensions(url: str) -> tuple[int, int] | None:
+    """
+    Returns the width and height of the image of a base64 PNG data URL, read from the IHDR chunk at the start of the
+    PNG without decoding the image, or None for other URLs.
+    """
+    if not url.startswith(PNG_DATA_URL_PREFIX):
+        return None
+    # The signature, the length and type of the IHDR chunk and its width and height are the first 24 bytes, which are
+    # encoded by the first 32 characters
+    try:
+        header = base64.b64decode(url[len(PNG_DATA_URL_PREFIX) : len(PNG_DATA_URL_PREFIX) + 32])
+    except binascii.Error:
+        return None
+    if len(header) < 24 or header[:8] != b"\x89PNG\r\n\x1a\n" or header[12:16] != b"IHDR":
+        return None
+    width, height = struct.unpack(">II", header[16:24])
+    return width, height
+
+
+def num_tokens_from_image(width: int, height: int, detail: str = "auto") -> int:
+    """
+    Returns the number of tokens of an image of the given size and detail. Images with "auto" detail are costed as high
+    detail, which is what the model picks for all but the smallest images.
+    """
+    if detail == "low":
+        return IMAGE_BASE_TOKENS
+    if max(width, height) > IMAGE_MAX_SIZE:
+        scale = IMAGE_MAX_SIZE / max(width, height)
+        width, height = int(width * scale), int(height * scale)
+    if min(width, height) > IMAGE_MAX_SHORTEST_SIZE:
+        scale = IMAGE_MAX_SHORTEST_SIZE / min(width, height)
+        width, height = int(width * scale), int(height * scale)
+    tiles = math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE)
+    return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * tiles
+
+
+def num_tokens_from_image_url(image_url: dict[str, Any]) -> int:
+    width, height = get_image_dimensions(image_url["url"]) or IMAGE_UNKNOWN_DIMENSIONS
+    return num_tokens_from_image(width, height, image_url.get("detail", "auto"))
+
+
+def fit_images_to_token_limit(content: list[Any], max_tokens: int, model: str) -> list[Any]:
+    """
+    Returns the parts of the content of a user message with as many of its images as needed downgraded to low detail,
+    and then dropped, for the message to fit within max_tokens. The last images, of the lowest ranked results, go first.
+    The text parts are kept, even if they don't fit on their own.
+    """
+    num_tokens = num_tokens_from_messages({"role": "user", "content": content}, model)  # type: ignore[dict-item]
+    if num_tokens <= max_tokens:
+        return content
+    content = list(content)
+    image_indexes = [i for i, part in enumerate(content) if part.get("type") == "image_url"]
+    for i in reversed(image_indexes):
+        if num_tokens <= max_tokens:
+            break
+        image_url = content[i]["image_url"]
+        if image_url.get("detail") != "low":
+            num_tokens -= num_tokens_from_image_url(image_url) - IMAGE_BASE_TOKENS
+            content[i] = {**content[i], "image_url": {**image_url, "detail": "low"}}
+    dropped = 0
+    for i in reversed(image_indexes):
+        if num_tokens <= max_tokens:
+            break
+        num_tokens -= IMAGE_BASE_TOKENS
+        del content[i]
+        dropped += 1
+    logging.debug("Fit the images of the message within %d tokens, %d images were dropped", max_tokens, dropped)
+    return content
+
+
 def get_oai_chatmodel_tiktok(aoaimodel: str) -> str:
     message = "Expected Azure OpenAI ChatGPT model name"
     if aoaimodel == "" or aoaimodel is None:
@@ -0,0 +1,252 @@
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from array import array
+from dataclasses import asdict, dataclass
+from typing import Any, Optional
+
+
+class RubricCacheStore(ABC):
+    """
+    Storage of the RubricCache: string values by key, each tagged with the source files it was computed from, and the
+    version of the index. SQLiteRubricCacheStore keeps them in a file of the host, another implementation can share
+    them across hosts.
+    """
+
+    @abstractmethod
+    async def get_many(self, keys: list[str]) -> dict[str, str]:
+        """Returns the values of the keys that are stored and not expired"""
+
+    @abstractmethod
+    async def put(self, key: str, value: str, sourcefiles: list[str] = []):
+        """Stores a value, replacing the previous value of the key"""
+
+    @abstractmethod
+    async def delete_by_sourcefiles(self, sourcefiles: list[str]) -> set[str]:
+        """Deletes the values tagged with any of the source files, and returns the source files that had values"""
+
+    @abstractmethod
+    async def get_index_version(self) -> int:
+        pass
+
+    @abstractmethod
+    async def bump_index_version(self) -> int:
+        """Increments the index version and deletes the values tagged with a source file, returns the new version"""
+
+    async def close(self):
+        pass
+
+
+class SQLiteRubricCacheStore(RubricCacheStore):
+    """
+    RubricCacheStore in a SQLite file, shared by the workers of the host and kept across restarts.
+    Queries run in a thread, one at a time for this worker, so they don't block the event loop.
+    Attributes:
+        path (str): Path of the database file, created if it doesn't exist.
+        ttl (float | None): Number of seconds a value stays valid after it is set, or None to never expire.
+    """
+
+    def __init__(self, path: str, ttl: Optional[float] = None):
+        self.path = path
+        self.ttl = ttl
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            # Write-ahead logging lets the other workers read while one of them writes
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL);
+                CREATE TABLE IF NOT EXISTS entry_sourcefiles (key TEXT NOT NULL, sourcefile TEXT NOT NULL);
+                CREATE INDEX IF NOT EXISTS entry_sourcefiles_sourcefile ON entry_sourcefiles (sourcefile);
+                CREATE INDEX IF NOT EXISTS entry_sourcefiles_key ON entry_sourcefiles (key);
+                CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+                INSERT OR IGNORE INTO meta (name, value) VALUES ('index_version', 0);
+                """)
+
+    def _execute(self, statements: list[tuple[str, tuple]]) -> list[list[tuple]]:
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                results = [self.connection.execute(sql, parameters).fetchall() for sql, parameters in statements]
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+            return results
+
+    async def get_many(self, keys: list[str]) -> dict[str, str]:
+        values: dict[str, str] = {}
+        # SQLite allows 999 parameters per statement in older versions
+        for start in range(0, len(keys), 900):
+            batch = keys[start : start + 900]
+            placeholders = ",".join("?" * len(batch))
+            [rows] = await asyncio.to_thread(
+                self._execute,
+                [
+                    (
+                        f"SELECT key, value FROM entries WHERE key IN ({placeholders})"
+                        " AND (expires_at IS NULL OR expires_at > ?)",
+                        (*batch, time.time()),
+                    )
+                ],
+            )
+            values.update(rows)
+        return values
+
+    async def put(self, key: str, value: str, sourcefiles: list[str] = []):
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        await asyncio.to_thread(
+            self._execute,
+            [
+                ("INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)", (key, value, expires_at)),
+                ("DELETE FROM entry_sourcefiles WHERE key = ?", (key,)),
+            ]
+            + [
+                ("INSERT INTO entry_sourcefiles (key, sourcefile) VALUES (?, ?)", (key, sourcefile))
+                for sourcefile in dict.fromkeys(sourcefiles)
+            ],
+        )
+
+    async def delete_by_sourcefiles(self, sourcefiles: list[str]) -> set[str]:
+        if not sourcefiles:
+            return set()
+        placeholders = ",".join("?" * len(sourcefiles))
+        subquery = f"SELECT key FROM entry_sourcefiles WHERE sourcefile IN ({placeholders})"
+        [rows, _, _] = await asyncio.to_thread(
+            self._execute,
+            [
+                (
+                    f"SELECT DISTINCT sourcefile FROM entry_sourcefiles WHERE sourcefile IN ({placeholders})",
+                    tuple(sourcefiles),
+                ),
+                (f"DELETE FROM entries WHERE key IN ({subquery})", tuple(sourcefiles)),
+                (f"DELETE FROM entry_sourcefiles WHERE key IN ({subquery})", tuple(sourcefiles)),
+            ],
+        )
+        return {sourcefile for (sourcefile,) in rows}
+
+    async def get_index_version(self) -> int:
+        [[(index_version,)]] = await asyncio.to_thread(
+            self._execute, [("SELECT value FROM meta WHERE name = 'index_version'", ())]
+        )
+        return index_version
+
+    async def bump_index_version(self) -> int:
+        [_, [(index_version,)], *_] = await asyncio.to_thread(
+            self._execute,
+            [
+                ("UPDATE meta SET value = value + 1 WHERE name = 'index_version'", ()),
+                ("SELECT value FROM meta WHERE name = 'index_version'", ()),
+                # The answers of earlier versions can't be looked up anymore, the search queries and embeddings stay
+                ("DELETE FROM entries WHERE key IN (SELECT key FROM entry_sourcefiles)", ()),
+                ("DELETE FROM entry_sourcefiles", ()),
+                ("DELETE FROM entries WHERE expires_at <= ?", (time.time(),)),
+            ],
+        )
+        return index_version
+
+    async def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+@dataclass
+class RubricCacheStats:
+    answer_hits: int = 0
+    answer_misses: int = 0
+    query_hits: int = 0
+    query_misses: int = 0
+    embedding_hits: int = 0
+    embedding_misses: int = 0
+    # Source files re-indexed after answers that cited them were cached, and ingested files that were new to the cache
+    reindexed_files: int = 0
+    new_files: int = 0
+
+
+class RubricCache:
+    """
+    Persistent cache of the rubric evaluations, so that a rubric run again against unchanged documents only evaluates
+    the criteria that changed. It keeps the answer to each criterion, keyed by a hash of the criterion, the messages,
+    the overrides, the filter (which carries the security filter of the user) and the index version, along with the
+    search query generated for each criterion and the embedding of each search query.
+    Answers are tagged with the files of their sources. Once a file was indexed again, invalidate_files() drops the
+    answers that used it, and if no cached answer used it (a new document, which might answer any criterion), it bumps
+    the index version, which drops all answers. Search queries and embeddings don't depend on the index and stay.
+    """
+
+    def __init__(self, store: RubricCacheStore):
+        self.store = store
+        self.stats = RubricCacheStats()
+
+    @staticmethod
+    def make_key(kind: str, *parts: Any) -> str:
+        payload = json.dumps([kind, *parts], sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def make_answer_keys(
+        self, criteria: list[str], messages: list[dict], overrides: dict[str, Any], filter: Optional[str]
+    ) -> list[str]:
+        # How the criteria are scheduled doesn't change their answers
+        overrides = {name: value for name, value in overrides.items() if name != "max_concurrent_criteria"}
+        index_version = await self.store.get_index_version()
+        return [
+            self.make_key("answer", criterion, messages, overrides, filter, index_version) for criterion in criteria
+        ]
+
+    async def get_answers(self, keys: list[str]) -> dict[str, str]:
+        answers = await self.store.get_many(keys)
+        self.stats.answer_hits += len(answers)
+        self.stats.answer_misses += len(keys) - len(answers)
+        return answers
+
+    async def set_answer(self, key: str, answer: str, sources: list[str]):
+        # Sources start with their citation, e.g. "Benefit_Options.pdf#page=2: ..."
+        sourcefiles = [source.split(": ", 1)[0].split("#", 1)[0] for source in sources]
+        await self.store.put(key, answer, sourcefiles)
+
+    async def get_search_queries(self, criteria: list[str], messages: list[dict], model: str) -> dict[str, str]:
+        keys = {criterion: self.make_key("query", criterion, messages, model) for criterion in criteria}
+        stored = await self.store.get_many(list(keys.values()))
+        search_queries = {criterion: stored[key] for criterion, key in keys.items() if key in stored}
+        self.stats.query_hits += len(search_queries)
+        self.stats.query_misses += len(keys) - len(search_queries)
+        return search_queries
+
+    async def set_search_query(self, criterion: str, messages: list[dict], model: str, search_query: str):
+        await self.store.put(self.make_key("query", criterion, messages, model), search_query)
+
+    async def get_embeddings(self, model: str, texts: list[str]) -> dict[str, list[float]]:
+        keys = {text: self.make_key("embedding", model, text) for text in texts}
+        stored = await self.store.get_many(list(keys.values()))
+        embeddings = {
+            text: array("f", base64.b64decode(stored[key])).tolist() for text, key in keys.items() if key in stored
+        }
+        self.stats.embedding_hits += len(embeddings)
+        self.stats.embedding_misses += len(keys) - len(embeddings)
+        return embeddings
+
+    async def set_embedding(self, model: str, text: str, embedding: list[float]):
+        # Stored as base64 float32, the precision of the embeddings
+        value = base64.b64encode(array("f", embedding).tobytes()).decode("ascii")
+        await self.store.put(self.make_key("embedding", model, text), value)
+
+    async def invalidate_files(self, sourcefiles: list[str]):
+        reindexed = await self.store.delete_by_sourcefiles(sourcefiles)
+        self.stats.reindexed_files += len(reindexed)
+        if len(reindexed) < len(set(sourcefiles)):
+            self.stats.new_files += len(set(sourcefiles)) - len(reindexed)
+            await self.store.bump_index_version()
+
+    async def close(self):
+        await self.store.close()
+
+    def get_stats(self) -> dict[str, Any]:
+        return asdict(self.stats)
@@ -0,0 +1,234 @@
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows, where only one worker runs the jobs of a directory
+    fcntl = None  # type: ignore[assignment]
+
+JOB_ID_PATTERN = re.compile("[0-9a-f]{32}")
+
+
+@dataclass
+class RubricJob:
+    id: str
+    rubric: str
+    criteria: list[str]
+    # The overrides and the auth claims of the request that created the job, used for every criterion
+    overrides: dict[str, Any] = field(default_factory=dict)
+    auth_claims: dict[str, Any] = field(default_factory=dict)
+    status: str = "queued"  # queued, running, succeeded or failed
+    completed: int = 0
+    errors: int = 0
+    # More than one once the job resumed after the worker that ran it stopped
+    attempts: int = 0
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+
+    def to_dict(self) -> dict[str, Any]:
+        status = asdict(self)
+        # The criteria can be long, and the overrides and the claims are internal
+        del status["criteria"], status["overrides"], status["auth_claims"]
+        status["total"] = len(self.criteria)
+        return status
+
+
+class RubricJobRunner:
+    """
+    Evaluates large rubrics in the background, outside of the request that submits them, so they are not cut off by
+    the request timeout of the app.
+    Each job has a directory in jobs_dir with its status and a checkpoint file, to which the result of each criterion is
+    appended (and flushed to disk) as soon as it is evaluated. A job that was interrupted, because its worker crashed or
+    was recycled, is picked up again by the next worker that scans the directory, and only evaluates the criteria that
+    have no answer yet. A lock on the job's directory ensures only one worker of the host runs a job at a time.
+    Attributes:
+        jobs_dir (str): Directory of the jobs, which must survive restarts of the app to resume the jobs.
+        evaluate (Callable): Evaluates a list of criteria with the given context, and returns the events of
+            RubricEvaluationApproach.evaluate_criteria().
+        max_concurrent_jobs (int): Number of jobs this worker runs at once.
+        scan_interval (float): Number of seconds between two scans of jobs_dir for the jobs left by other workers.
+        retention (float): Number of seconds a finished job is kept.
+    """
+
+    def __init__(
+        self,
+        jobs_dir: str,
+        evaluate: Callable[[list[str], dict[str, Any]], Awaitable[AsyncIterator[dict[str, Any]]]],
+        max_concurrent_jobs: int = 1,
+        scan_interval: float = 60,
+        retention: float = 7 * 86400,
+    ):
+        self.jobs_dir = jobs_dir
+        self.evaluate = evaluate
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.scan_interval = scan_interval
+        self.retention = retention
+        self.queue: asyncio.Queue[str] = asyncio.Queue()
+        # The jobs queued or running in this worker
+        self.pending: set[str] = set()
+        self.tasks: list[asyncio.Task] = []
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.max_concurrent_jobs)]
+        self.tasks.append(asyncio.create_task(self.scan_periodically()))
+
+    async def close(self):
+        # Running jobs stay "running" on disk, so the next worker resumes them
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def create_job(
+        self, rubric: str, criteria: list[str], overrides: dict[str, Any], auth_claims: dict[str, Any]
+    ) -> RubricJob:
+        job = RubricJob(
+            id=uuid.uuid4().hex, rubric=rubric, criteria=criteria, overrides=overrides, auth_claims=auth_claims
+        )
+        os.makedirs(os.path.join(self.jobs_dir, job.id))
+        self.save(job)
+        self.enqueue(job.id)
+        return job
+
+    def get(self, job_id: str) -> Optional[RubricJob]:
+        if not JOB_ID_PATTERN.fullmatch(job_id):
+            return None
+        try:
+            with open(os.path.join(self.jobs_dir, job_id, "job.json"), encoding="utf-8") as job_file:
+                return RubricJob(**json.load(job_file))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def save(self, job: RubricJob):
+        # Written to a temporary file and renamed, so that other workers never read a partial status
+        path = os.path.join(self.jobs_dir, job.id, "job.json")
+        with open(f"{path}.tmp", "w", encoding="utf-8") as job_file:
+            json.dump(asdict(job), job_file)
+        os.replace(f"{path}.tmp", path)
+
+    def read_rows(self, job: RubricJob) -> dict[int, dict[str, Any]]:
+        """Returns the checkpointed result of each evaluated criterion, by index, the latest one if it was retried"""
+        rows: dict[int, dict[str, Any]] = {}
+        try:
+            with open(os.path.join(self.jobs_dir, job.id, "rows.jsonl"), encoding="utf-8") as rows_file:
+                for line in rows_file:
+                    try:
+                        row = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line is partial if the worker stopped while writing it
+                        continue
+                    rows[row["index"]] = row
+        except FileNotFoundError:
+            pass
+        return rows
+
+    def to_csv(self, job: RubricJob) -> str:
+        rows = self.read_rows(job)
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(["Criteria", "Answer", "Error"])
+        for index, criterion in enumerate(job.criteria):
+            row = rows.get(index, {})
+            writer.writerow([criterion, row.get("answer", ""), row.get("error", "")])
+        return output.getvalue()
+
+    def enqueue(self, job_id: str):
+        if job_id not in self.pending:
+            self.pending.add(job_id)
+            self.queue.put_nowait(job_id)
+
+    def scan(self):
+        """Queues the unfinished jobs of the directory, and removes the finished jobs past their retention"""
+        expired = time.time() - self.retention
+        for job_id in os.listdir(self.jobs_dir):
+            job = self.get(job_id)
+            if job is None:
+                continue
+            if job.status in ("queued", "running"):
+                self.enqueue(job.id)
+            elif job.finished_at is not None and job.finished_at < expired:
+                shutil.rmtree(os.path.join(self.jobs_dir, job.id), ignore_errors=True)
+
+    async def scan_periodically(self):
+        while True:
+            try:
+                self.scan()
+            except OSError:
+                logging.exception("Failed to scan the rubric jobs")
+            await asyncio.sleep(self.scan_interval)
+
+    async def work(self):
+        while True:
+            job_id = await self.queue.get()
+            try:
+                await self.run(job_id)
+            finally:
+                self.pending.discard(job_id)
+                self.queue.task_done()
+
+    async def run(self, job_id: str):
+        with open(os.path.join(self.jobs_dir, job_id, "lock"), "w") as lock_file:
+            if fcntl is not None:
+                try:
+                    # Released by the OS if the worker dies
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return  # Another worker of the host is running the job
+            job = self.get(job_id)
+            if job is None or job.status not in ("queued", "running"):
+                return
+            try:
+                await self.evaluate_job(job)
+            except Exception as error:
+                logging.exception("Rubric job %s failed", job.id)
+                job.status = "failed"
+                job.error = str(error)
+            else:
+                job.status = "succeeded"
+            job.finished_at = time.time()
+            self.save(job)
+
+    async def evaluate_job(self, job: RubricJob):
+        rows = self.read_rows(job)
+        # Criteria that failed are evaluated again when the job resumes
+        pending = [index for index in range(len(job.criteria)) if "answer" not in rows.get(index, {})]
+        job.status = "running"
+        job.attempts += 1
+        job.started_at = job.started_at or time.time()
+        self.save(job)
+
+        context = {"overrides": job.overrides, "auth_claims": job.auth_claims}
+        events = await self.evaluate([job.criteria[index] for index in pending], context)
+        rows_path = os.path.join(self.jobs_dir, job.id, "rows.jsonl")
+        with open(rows_path, "a+b") as rows_file:
+            # Ends the partial line of a worker that stopped while writing it
+            if rows_file.tell() > 0:
+                rows_file.seek(-1, os.SEEK_END)
+                if rows_file.read(1) != b"\n":
+                    rows_file.write(b"\n")
+            async for event in events:
+                if "index" not in event:
+                    continue
+                index = pending[event["index"]]
+                row = {"index": index}
+                row.update({"error": event["error"]} if "error" in event else {"answer": event["answer"]})
+                rows_file.write(json.dumps(row).encode("utf-8") + b"\n")
+                rows_file.flush()
+                os.fsync(rows_file.fileno())
+                rows[index] = row
+                job.completed = sum(1 for row in rows.values() if "answer" in row)
+                job.errors = len(rows) - job.completed
+                self.save(job)
@@ -0,0 +1,100 @@
+import asyncio
+import csv
+import hashlib
+import io
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Optional
+from urllib.parse import quote
+
+from azure.core.exceptions import ResourceExistsError
+from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+from azure.storage.blob.aio import BlobServiceClient
+
+from core.lrucache import LRUCache
+
+DEFAULT_RUBRIC_FILE = "rubric.csv"
+
+
+class RubricStore:
+    """
+    The container of the rubric CSV files, with one client (and connection pool) for the lifetime of the worker.
+    The list of files is cached for listing_ttl seconds and dropped as soon as this worker uploads a file.
+    Read-only SAS URLs are valid for sas_ttl seconds and handed out again until sas_refresh_margin seconds before
+    they expire, so a URL is always usable for at least that long.
+    The account key of the connection string signs the SAS URLs.
+    """
+
+    def __init__(
+        self,
+        connection_string: str,
+        container_name: str,
+        listing_ttl: float = 60,
+        sas_ttl: float = 3600,
+        sas_refresh_margin: float = 300,
+    ):
+        self.service_client = BlobServiceClient.from_connection_string(connection_string)
+        self.container_client = self.service_client.get_container_client(container_name)
+        self.listing_ttl = listing_ttl
+        self.sas_ttl = sas_ttl
+        # The names of the files, an ETag for them and the monotonic time the listing expires
+        self.listing: Optional[tuple[list[str], str, float]] = None
+        self.listing_lock = asyncio.Lock()
+        self.listings = 0
+        self.sas_urls: LRUCache[str, str] = LRUCache(max_entries=1000, ttl=max(sas_ttl - sas_refresh_margin, 0))
+        self.container_created = False
+
+    async def list_files(self) -> tuple[list[str], str]:
+        # Requests that arrive while the container is listed wait for that listing instead of starting their own
+        async with self.listing_lock:
+            if self.listing is None or self.listing[2] <= time.monotonic():
+                names = [blob.name async for blob in self.container_client.list_blobs()]
+                # Make sure the default file is in the list
+                if DEFAULT_RUBRIC_FILE not in names:
+                    names.insert(0, DEFAULT_RUBRIC_FILE)
+                etag = hashlib.sha256("\n".join(names).encode("utf-8")).hexdigest()[:32]
+                self.listing = (names, etag, time.monotonic() + self.listing_ttl)
+                self.listings += 1
+            names, etag, _ = self.listing
+        return list(names), etag
+
+    async def upload(self, name: str, data: bytes):
+        if not self.container_created:
+            try:
+                await self.container_client.create_container()
+            except ResourceExistsError:
+                pass
+            self.container_created = True
+        await self.container_client.upload_blob(name, data, overwrite=True)
+        self.listing = None
+
+    async def load_criteria(self, name: str) -> list[str]:
+        """
+        Returns the criteria of a rubric file: the first column of each row after the header row, like the rubric page
+        """
+        downloader = await self.container_client.download_blob(name)
+        data = await downloader.readall()
+        rows = csv.reader(io.StringIO(data.decode("utf-8-sig")))
+        next(rows, None)
+        return [row[0].strip() for row in rows if row and row[0].strip()]
+
+    def get_sas_url(self, name: str) -> str:
+        sas_url = self.sas_urls.get(name)
+        if sas_url is None:
+            sas_token = generate_blob_sas(
+                self.service_client.credential.account_name,
+                self.container_client.container_name,
+                name,
+                account_key=self.service_client.credential.account_key,
+                permission=BlobSasPermissions(read=True),
+                expiry=datetime.now(timezone.utc) + timedelta(seconds=self.sas_ttl),
+            )
+            sas_url = f"{self.container_client.url}/{quote(name)}?{sas_token}"
+            self.sas_urls.set(name, sas_url)
+        return sas_url
+
+    async def close(self):
+        await self.service_client.close()
+
+    def get_stats(self) -> dict[str, Any]:
+        return {"listings": self.listings, "sas_urls": self.sas_urls.stats.to_dict()}
@@ -0,0 +1,75 @@
+import hashlib
+from array import array
+from typing import TYPE_CHECKING, Any, Optional
+
+from azure.search.documents.models import RawVectorQuery, VectorQuery
+
+from core.lrucache import LRUCache
+
+if TYPE_CHECKING:
+    from approaches.approach import Document
+
+
+class SearchCache:
+    """
+    Per-worker cache of the documents returned by Approach.search, so that a repeated question doesn't go through
+    AI Search (and its semantic ranker) again. The key includes the filter, which carries the security filter of the user,
+    so results trimmed for one user are never returned to another. Entries expire after the TTL, and invalidate() drops
+    all of them once documents were added to or removed from the index.
+    """
+
+    def __init__(self, max_bytes: int, ttl: Optional[float]):
+        self.cache: LRUCache[tuple, list[Document]] = LRUCache(max_bytes=max_bytes, ttl=ttl, sizeof=self.sizeof)
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(
+        top: int,
+        query_text: Optional[str],
+        filter: Optional[str],
+        vectors: list[VectorQuery],
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+        query_language: Optional[str],
+        query_speller: Optional[str],
+    ) -> tuple:
+        vector_keys = []
+        for vector in vectors:
+            # Hash the query vectors, which are too big to be part of the key themselves
+            values = vector.vector if isinstance(vector, RawVectorQuery) and vector.vector else []
+            digest = hashlib.sha256(array("d", values).tobytes()).hexdigest()
+            vector_keys.append((vector.fields, vector.k, digest))
+        return (
+            top,
+            query_text,
+            filter,
+            tuple(vector_keys),
+            bool(use_semantic_ranker),
+            bool(use_semantic_captions),
+            query_language,
+            query_speller,
+        )
+
+    @staticmethod
+    def sizeof(documents: list["Document"]) -> int:
+        # Rough size in memory, a float in a list takes 32 bytes and a character of ASCII text takes one
+        size = 0
+        for document in documents:
+            size += 512 + len(document.content or "")
+            size += 32 * (len(document.embedding or []) + len(document.image_embedding or []))
+        return size
+
+    def get(self, key: tuple) -> Optional[list["Document"]]:
+        documents = self.cache.get(key)
+        # Callers get their own list, the documents themselves are shared and must not be modified
+        return list(documents) if documents is not None else None
+
+    def set(self, key: tuple, documents: list["Document"]):
+        self.cache.set(key, list(documents))
+
+    def invalidate(self):
+        self.cache.clear()
+        self.invalidations += 1
+
+    def get_stats(self) -> dict[str, Any]:
+        return {**self.cache.stats.to_dict(), "invalidations": self.invalidations}
@@ -0,0 +1,164 @@
+import copy
+import hashlib
+import json
+import logging
+import random
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Optional
+
+import numpy as np
+
+
+@dataclass
+class SemanticCacheStats:
+    hits: int = 0
+    misses: int = 0
+    # Misses whose closest answer was within 0.05 of the threshold, a high count suggests lowering it
+    near_misses: int = 0
+    evictions: int = 0
+    # Hits that were answered again anyway to check the cached answer, and those that turned out to be wrong
+    sampled_hits: int = 0
+    false_hits: int = 0
+
+    def to_dict(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            **asdict(self),
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "false_hit_rate": round(self.false_hits / self.sampled_hits, 4) if self.sampled_hits else 0.0,
+        }
+
+
+@dataclass
+class SemanticMatch:
+    response: dict[str, Any]
+    question: str
+    score: float
+
+
+class SemanticAnswerCache:
+    """
+    Per-worker cache of the responses of the approaches, looked up by the similarity of the query embedding to the
+    questions answered before, so that paraphrases of a question get the same answer. Entries are grouped in scopes,
+    a hash of the approach, the earlier messages, the overrides, the filter (which carries the security filter of the user)
+    and the index version, and a lookup only considers the entries of its own scope.
+    The embeddings of all entries are rows of a single matrix, scored against the query with one matrix product.
+    A fraction of the hits is answered again to measure how many of them were false hits, see check_sample().
+    Attributes:
+        max_entries (int): Maximum number of entries, the least recently used entry is replaced once it is full.
+        ttl (float | None): Number of seconds an entry stays valid after it is set, or None to never expire.
+        threshold (float): Minimum cosine similarity between the query and a cached question for a hit.
+        sample_rate (float): Fraction of the hits that are checked against a new answer.
+    """
+
+    def __init__(self, max_entries: int, ttl: Optional[float], threshold: float, sample_rate: float = 0.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.stats = SemanticCacheStats()
+        self.index_version = 0
+        # Unit length embeddings, one row per entry, allocated once the number of dimensions is known
+        self.embeddings: Optional[np.ndarray] = None
+        self.scopes = np.zeros(max_entries, dtype=np.int64)
+        # Monotonic expiry time of each entry, free slots have already expired
+        self.expires = np.full(max_entries, -np.inf)
+        self.last_used = np.zeros(max_entries)
+        self.entries: list[Optional[tuple[str, dict[str, Any]]]] = [None] * max_entries
+
+    def make_scope(self, approach: str, messages: list[dict], overrides: dict[str, Any], filter: Optional[str]) -> int:
+        payload = json.dumps(
+            [approach, messages, overrides, filter, self.index_version],
+            sort_keys=True,
+            separators=(",", ":"),
+            ensure_ascii=False,
+            default=str,
+        )
+        return int.from_bytes(hashlib.sha256(payload.encode("utf-8")).digest()[:8], "little", signed=True)
+
+    def normalize(self, embedding: list[float]) -> Optional[np.ndarray]:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm == 0 or (self.embeddings is not None and vector.shape[0] != self.embeddings.shape[1]):
+            return None
+        return vector / norm
+
+    def get(self, scope: int, embedding: list[float]) -> Optional[SemanticMatch]:
+        vector = self.normalize(embedding)
+        if self.embeddings is None or vector is None:
+            self.stats.misses += 1
+            return None
+        now = time.monotonic()
+        valid = (self.scopes == scope) & (self.expires > now)
+        scores = np.where(valid, self.embeddings @ vector, -1.0)
+        slot = int(np.argmax(scores))
+        score = float(scores[slot])
+        entry = self.entries[slot]
+        if score < self.threshold or entry is None:
+            self.stats.misses += 1
+            if score >= self.threshold - 0.05:
+                self.stats.near_misses += 1
+            return None
+        self.stats.hits += 1
+        self.last_used[slot] = now
+        question, response = entry
+        # Callers get their own copy, to set the session state and stream it
+        return SemanticMatch(response=copy.deepcopy(response), question=question, score=score)
+
+    def set(self, scope: int, embedding: list[float], question: str, response: dict[str, Any]):
+        vector = self.normalize(embedding)
+        if vector is None:
+            return
+        if self.embeddings is None:
+            self.embeddings = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+        now = time.monotonic()
+        # Fill an expired or free slot first, otherwise replace the least recently used entry
+        slot = int(np.argmin(np.where(self.expires > now, self.last_used, -np.inf)))
+        if self.expires[slot] > now:
+            self.stats.evictions += 1
+        self.embeddings[slot] = vector
+        self.scopes[slot] = scope
+        self.expires[slot] = now + self.ttl if self.ttl is not None else np.inf
+        self.last_used[slot] = now
+        self.entries[slot] = (question, copy.deepcopy(response))
+
+    def sample(self) -> bool:
+        return random.random() < self.sample_rate
+
+    def check_sample(self, match: SemanticMatch, question: str, response: dict[str, Any]):
+        """
+        Compares a cached answer with the new answer to the same question, which counts as a false hit
+        when less than half of the sources they were grounded on are the same.
+        """
+        self.stats.sampled_hits += 1
+        cached_sources = self.get_sources(match.response)
+        sources = self.get_sources(response)
+        union = cached_sources | sources
+        if union and len(cached_sources & sources) / len(union) < 0.5:
+            self.stats.false_hits += 1
+            logging.warning(
+                "Semantic cache false hit with similarity %.4f: %r was answered like %r",
+                match.score,
+                question,
+                match.question,
+            )
+
+    @staticmethod
+    def get_sources(response: dict[str, Any]) -> frozenset[str]:
+        data_points = response["choices"][0].get("context", {}).get("data_points", {})
+        return frozenset(source.split(":", 1)[0] for source in data_points.get("text", []))
+
+    def invalidate(self):
+        self.expires.fill(-np.inf)
+        self.entries = [None] * self.max_entries
+        self.index_version += 1
+
+    def get_stats(self) -> dict[str, Any]:
+        entries = int(np.count_nonzero(self.expires > time.monotonic()))
+        return {
+            **self.stats.to_dict(),
+            "entries": entries,
+            "threshold": self.threshold,
+            "index_version": self.index_version,
+        }
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import hashlib
+import html
+import re
+
+from core.lrucache import LRUCache
+
+# Compact renderings of the sections with tables, keyed by section id and a hash of the content, which changes when the
+# section is indexed again
+TABLE_RENDER_CACHE_MAX_ENTRIES = 10000
+table_render_cache: LRUCache[tuple[str, bytes], str] = LRUCache(max_entries=TABLE_RENDER_CACHE_MAX_ENTRIES)
+
+# The tables written by prepdocs, and the end of a table that a section starts within, as sections are split mid-table
+TABLE = re.compile(r"<table\b[^>]*>.*?(?:</table>|$)|^(?:(?!<table\b).)*?</table>", re.DOTALL | re.IGNORECASE)
+TABLE_TAG = re.compile(r"(</?(?:table|tr|th|td)\b[^>]*>)", re.IGNORECASE)
+COLUMN_SPAN = re.compile(r"colspan=[\"']?(\d+)", re.IGNORECASE)
+CELL_SEPARATOR = " | "
+ROW_SEPARATOR = " || "
+
+
+def render_table(table: str) -> str:
+    """
+    Renders the HTML of a table, or of the part of a table within a section, as its rows separated by " || " with their
+    cells separated by " | ". Cells that span columns are followed by empty cells, so that the columns line up.
+    """
+    rows: list[list[str]] = []
+    row: list[str] = []
+    text = ""
+    span = 1
+    for token in TABLE_TAG.split(table):
+        if not TABLE_TAG.fullmatch(token):
+            text += token
+            continue
+        tag = token.lower()
+        if tag.startswith(("</td", "</th")):
+            row.append(text)
+            row.extend([""] * (span - 1))
+            text, span = "", 1
+            continue
+        # Text outside of a cell is the end of a cell the section starts within
+        if text.strip():
+            row.append(text)
+        text = ""
+        if tag.startswith(("<td", "<th")):
+            span = int(match.group(1)) if (match := COLUMN_SPAN.search(token)) else 1
+        elif row:
+            rows.append(row)
+            row = []
+    if text.strip():
+        row.append(text)
+    if row:
+        rows.append(row)
+    return ROW_SEPARATOR.join(CELL_SEPARATOR.join(html.unescape(cell).strip() for cell in row) for row in rows)
+
+
+def render_tables_compact(section_id: str, content: str) -> str:
+    """Returns the content of a section with its tables rendered by render_table(), cached by section"""
+    if "</t" not in content and "<table" not in content:
+        return content
+    key = (section_id, hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest())
+    rendered = table_render_cache.get(key)
+    if rendered is None:
+        rendered = TABLE.sub(lambda match: render_table(match.group(0)), content)
+        table_render_cache.set(key, rendered)
+    return rendered
@@ -1,2 +1,12 @@
 def nonewlines(s: str) -> str:
     return s.replace("\n", " ").replace("\r", " ")
+
+
+def overlap_length(first: str, second: str, min_length: int) -> int:
+    """Returns the length of the longest end of first that second starts with, or 0 if it is shorter than min_length"""
+    start = first.find(second[:min_length], max(len(first) - len(second), 0))
+    while start != -1 and len(first) - start >= min_length:
+        if second.startswith(first[start:]):
+            return len(first) - start
+        start = first.find(second[:min_length], start + 1)
+    return 0
@@ -259,10 +259,11 @@ const RubricEvaluation = () => {
       
             // When a file is uploaded, add an object containing the file name and the SAS URL to uploadedFiles  
             xhr.onloadend = () => {  
-                if (xhr.status === 200) {  
+                if (xhr.status === 202) {  
                     console.log("File upload successful");  
       
-                    // The backend should return a success message  
+                    // The backend ingests the file in the background and returns the id of the ingestion job,  
+                    // whose progress is reported by /ingest_jobs/<job_id>  
                     const responseMessage = xhr.responseText;  
       
                     console.log(responseMessage); // Log the response message  
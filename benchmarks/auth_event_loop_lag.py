@@ -0,0 +1,95 @@
+"""
+Measures how long the event loop is blocked while users log in concurrently with authentication enabled.
+
+The On Behalf Of exchange of MSAL is replaced by a blocking sleep of the given latency, like the network call it makes.
+A ticker coroutine records how late it wakes up while the logins run, which is the delay every other request
+of the worker sees. With the exchange on the event loop the lag grows with the number of concurrent logins,
+in the thread pool it stays flat.
+
+Usage:
+    python benchmarks/auth_event_loop_lag.py --logins 1 10 50 --latency 0.2
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from unittest import mock
+
+import msal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app", "backend"))
+
+from core.authentication import AuthenticationHelper  # noqa: E402
+
+
+async def measure_lag(logins: int, latency: float, on_event_loop: bool) -> tuple[float, float]:
+    def acquire_token_on_behalf_of(self, *args, **kwargs):
+        time.sleep(latency)
+        return {"access_token": "MockToken", "id_token_claims": {"oid": "OID_X", "groups": ["GROUP_Y"]}}
+
+    with mock.patch.object(msal.ConfidentialClientApplication, "__init__", lambda self, *args, **kwargs: None):
+        helper = AuthenticationHelper(
+            search_index=None,
+            use_authentication=True,
+            server_app_id="SERVER_APP",
+            server_app_secret="SERVER_SECRET",
+            client_app_id="CLIENT_APP",
+            tenant_id="TENANT_ID",
+            max_workers=max(logins, 4),
+        )
+    helper.confidential_client.acquire_token_on_behalf_of = acquire_token_on_behalf_of.__get__(  # type: ignore
+        helper.confidential_client
+    )
+    if on_event_loop:
+        # What the helper used to do: call MSAL directly from the coroutine
+        loop = asyncio.get_running_loop()
+        helper.executor = None
+        loop.run_in_executor = lambda executor, func, *args: wrap_result(func(*args))  # type: ignore
+
+    lags = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - start - 0.01)
+
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.sleep(0.05)
+    start = time.perf_counter()
+    # Every user logs in with their own token, so the exchanges are not shared
+    await asyncio.gather(
+        *[helper.get_auth_claims_if_enabled({"Authorization": f"Bearer token-{i}"}) for i in range(logins)]
+    )
+    elapsed = time.perf_counter() - start
+    done.set()
+    await ticker_task
+    await helper.close()
+    return max(lags), elapsed
+
+
+def wrap_result(result) -> asyncio.Future:
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(result)
+    return future
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Event loop lag during concurrent logins")
+    parser.add_argument("--logins", nargs="+", type=int, default=[1, 10, 50], help="Numbers of concurrent logins")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds taken by each token exchange")
+    args = parser.parse_args()
+
+    print(f"{'logins':>7} {'mode':>12} {'max loop lag ms':>16} {'all logins ms':>14}")
+    for logins in args.logins:
+        for on_event_loop in (False, True):
+            lag, elapsed = asyncio.run(measure_lag(logins, args.latency, on_event_loop))
+            mode = "event loop" if on_event_loop else "thread pool"
+            print(f"{logins:>7} {mode:>12} {lag * 1000:>16.0f} {elapsed * 1000:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
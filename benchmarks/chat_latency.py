@@ -0,0 +1,204 @@
+"""
+Measures how long ChatReadRetrieveReadApproach takes until the final chat completion is sent, with and without the
+speculative retrieval that searches the user's question while the search query is generated.
+
+Requests are replayed from a JSON Lines file in which each line holds the "messages" of a recorded /chat request and
+the "search_query" that was generated for it (0 when none was). OpenAI is replaced by a local stand-in server that
+returns the recorded search query, and AI Search by an in-process stand-in. Each call takes its given latency with a
+random jitter of up to 50%, drawn per request and the same for both modes. Without a file, a sample of first turns
+and follow-ups is replayed.
+
+Usage:
+    python benchmarks/chat_latency.py --traffic chat_traffic.jsonl --latency 0.4 --search-latency 0.15
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+import httpx
+from aiohttp import web
+from openai import AsyncOpenAI
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app", "backend"))
+
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach  # noqa: E402
+from core.authentication import AuthenticationHelper  # noqa: E402
+
+SAMPLE_TRAFFIC = [
+    {"messages": [{"role": "user", "content": "What termination rights do we have?"}], "search_query": "0"},
+    {"messages": [{"role": "user", "content": "Governing law"}], "search_query": "governing law"},
+    {
+        "messages": [{"role": "user", "content": "Is there a limitation of liability clause?"}],
+        "search_query": "Is there a limitation of liability clause",
+    },
+    {
+        "messages": [{"role": "user", "content": "Can the supplier change prices?"}],
+        "search_query": "supplier price changes",
+    },
+    {
+        "messages": [
+            {"role": "user", "content": "What are the payment terms?"},
+            {"role": "assistant", "content": "Invoices are payable within 30 days [terms.pdf#page=2]."},
+            {"role": "user", "content": "And what if we pay late?"},
+        ],
+        "search_query": "late payment interest",
+    },
+    {
+        "messages": [
+            {"role": "user", "content": "Who owns the intellectual property?"},
+            {"role": "assistant", "content": "The supplier keeps the IP of its products [terms.pdf#page=4]."},
+            {"role": "user", "content": "Does that include custom work?"},
+        ],
+        "search_query": "intellectual property ownership custom work",
+    },
+]
+
+
+class StandInOpenAI:
+    def __init__(self, latency: float, search_queries: dict[str, str]):
+        self.latency = latency
+        self.search_queries = search_queries
+        self.jitter = 1.0
+
+    async def chat_completions(self, request: web.Request) -> web.Response:
+        question = (await request.json())["messages"][-1]["content"].removeprefix("Generate search query for: ")
+        await asyncio.sleep(self.latency * self.jitter)
+        return web.json_response(
+            {
+                "id": "chatcmpl-1",
+                "object": "chat.completion",
+                "created": 0,
+                "model": "gpt-35-turbo",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": self.search_queries.get(question, "0")},
+                        "finish_reason": "stop",
+                    }
+                ],
+            }
+        )
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency / 4 * self.jitter)
+        return web.json_response(
+            {
+                "object": "list",
+                "data": [{"object": "embedding", "index": 0, "embedding": [0.1] * 1536}],
+                "model": "text-embedding-ada-002",
+                "usage": {"prompt_tokens": 8, "total_tokens": 8},
+            }
+        )
+
+
+class StandInSearchResults:
+    def by_page(self):
+        async def pages():
+            async def page():
+                yield {
+                    "id": "1",
+                    "content": "The supplier may terminate with 30 days notice.",
+                    "sourcepage": "terms.pdf",
+                }
+
+            yield page()
+
+        return pages()
+
+
+class StandInSearchClient:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.jitter = 1.0
+
+    async def search(self, *args, **kwargs) -> StandInSearchResults:
+        await asyncio.sleep(self.latency * self.jitter)
+        return StandInSearchResults()
+
+
+async def measure(
+    traffic: list[dict], latency: float, search_latency: float, speculative: bool, seed: int
+) -> tuple[list[float], int]:
+    rng = random.Random(seed)
+    search_queries = {request["messages"][-1]["content"]: request["search_query"] for request in traffic}
+    stand_in = StandInOpenAI(latency, search_queries)
+    search_client = StandInSearchClient(search_latency)
+    server_app = web.Application()
+    server_app.router.add_post("/v1/chat/completions", stand_in.chat_completions)
+    server_app.router.add_post("/v1/embeddings", stand_in.embeddings)
+    runner = web.AppRunner(server_app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # type: ignore[union-attr]
+
+    openai_client = AsyncOpenAI(
+        api_key="stand-in", base_url=f"http://127.0.0.1:{port}/v1", http_client=httpx.AsyncClient()
+    )
+    approach = ChatReadRetrieveReadApproach(
+        search_client=search_client,  # type: ignore[arg-type]
+        auth_helper=AuthenticationHelper(None, False, None, None, None, None),
+        openai_client=openai_client,
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment=None,
+        embedding_model="text-embedding-ada-002",
+        embedding_deployment=None,
+        sourcepage_field="sourcepage",
+        content_field="content",
+        query_language="en-us",
+        query_speller="lexicon",
+        speculative_retrieval=speculative,
+    )
+    durations = []
+    hits = 0
+    for request in traffic:
+        stand_in.jitter = search_client.jitter = 1 + rng.random() / 2
+        start = time.perf_counter()
+        extra_info, chat_coroutine = await approach.run_until_final_call(request["messages"], {}, {}, False)
+        durations.append(time.perf_counter() - start)
+        chat_coroutine.close()  # The final answer takes the same time in both modes
+        hits += extra_info["thoughts"][1].props.get("speculative_retrieval") == "hit"
+
+    await openai_client.close()
+    await runner.cleanup()
+    return durations, hits
+
+
+def percentile(values: list[float], percent: int) -> float:
+    return statistics.quantiles(values, n=100, method="inclusive")[percent - 1] if len(values) > 1 else values[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat latency until the final completion, with speculative retrieval")
+    parser.add_argument("--traffic", help="JSON Lines file of recorded requests, defaults to a built-in sample")
+    parser.add_argument("--latency", type=float, default=0.4, help="Seconds taken by the search query generation")
+    parser.add_argument("--search-latency", type=float, default=0.15, help="Seconds taken by each search")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the latency jitter")
+    args = parser.parse_args()
+
+    traffic = SAMPLE_TRAFFIC
+    if args.traffic:
+        with open(args.traffic, encoding="utf-8") as traffic_file:
+            traffic = [json.loads(line) for line in traffic_file if line.strip()]
+
+    results = {}
+    print(f"{'mode':>11} {'requests':>9} {'hits':>5} {'p50 (s)':>8} {'p95 (s)':>8}")
+    for mode, speculative in (("sequential", False), ("speculative", True)):
+        durations, hits = asyncio.run(measure(traffic, args.latency, args.search_latency, speculative, args.seed))
+        results[mode] = durations
+        print(
+            f"{mode:>11} {len(durations):>9} {hits:>5} {percentile(durations, 50):>8.3f} {percentile(durations, 95):>8.3f}"
+        )
+    for percent in (50, 95):
+        saved = percentile(results["sequential"], percent) - percentile(results["speculative"], percent)
+        print(f"p{percent} saved: {saved:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Measures how many tokens of sources the approaches save by merging the overlapping sections of a source file, on the
+PDFs of data/.
+
+The PDFs are parsed with pypdf and split like prepdocs does, with an overlap between neighbouring sections. Each query is
+a sentence of the corpus, and the sections that share the most words with it stand in for the top search results. The
+sources are measured as the prompt would hold them, before and after the sections were merged.
+
+Usage:
+    python benchmarks/chunk_merge.py --top 6 --queries 200
+"""
+
+import argparse
+import asyncio
+import glob
+import os
+import random
+import re
+import statistics
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app", "backend"))
+
+from approaches.approach import Approach, Document  # noqa: E402
+from core.modelhelper import get_encoding, num_tokens_from_text  # noqa: E402
+
+from scripts.prepdocslib.blobmanager import BlobManager  # noqa: E402
+from scripts.prepdocslib.pdfparser import LocalPdfParser  # noqa: E402
+from scripts.prepdocslib.textsplitter import TextSplitter  # noqa: E402
+
+MODEL = "gpt-35-turbo"
+WORD = re.compile(r"[a-z0-9]{4,}")
+
+
+async def load_sections(pattern: str) -> list[Document]:
+    sections = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, "rb") as f:
+            pages = [page async for page in LocalPdfParser().parse(f)]
+        filename = os.path.basename(path)
+        for i, split_page in enumerate(TextSplitter(has_image_embeddings=False).split_pages(pages)):
+            sections.append(
+                Document(
+                    id=f"{filename}-page-{i}",
+                    content=split_page.text,
+                    embedding=None,
+                    image_embedding=None,
+                    category=None,
+                    sourcepage=BlobManager.sourcepage_from_file_page(filename, split_page.page_num),
+                    sourcefile=filename,
+                    oids=None,
+                    groups=None,
+                    captions=[],
+                )
+            )
+    return sections
+
+
+def search(sections: list[Document], query: str, top: int) -> list[Document]:
+    words = set(WORD.findall(query.lower()))
+    scores = [len(words & set(WORD.findall((section.content or "").lower()))) for section in sections]
+    ranked = sorted(range(len(sections)), key=lambda i: scores[i], reverse=True)
+    return [sections[i] for i in ranked[:top]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tokens of sources saved by merging overlapping sections")
+    parser.add_argument("--data", default=os.path.join(os.path.dirname(__file__), "..", "data", "*.pdf"))
+    parser.add_argument("--top", type=int, default=6, help="Number of search results of each query")
+    parser.add_argument("--queries", type=int, default=200, help="Number of queries sampled from the corpus")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    sections = asyncio.run(load_sections(args.data))
+    sentences = [
+        sentence
+        for section in sections
+        for sentence in re.split(r"(?<=[.!?])\s+", section.content or "")
+        if len(WORD.findall(sentence.lower())) >= 5
+    ]
+    queries = random.Random(args.seed).sample(sentences, min(args.queries, len(sentences)))
+
+    approach = Approach(None, None, None, None, None, None, "", "")  # type: ignore[arg-type]
+    encoding = get_encoding(MODEL)
+    before, after, merged_queries = [], [], 0
+    for query in queries:
+        results = search(sections, query, args.top)
+        sources = approach.get_sources_content(results, False, False)
+        before.append(sum(num_tokens_from_text(source, encoding) for source in sources))
+        _, props = approach.pack_sources_content(results, False, False, 1_000_000, MODEL)
+        after.append(props["packed_tokens"])
+        merged_queries += props["overlap_tokens_saved"] > 0
+
+    print(f"{len(sections)} sections, {len(queries)} queries, top {args.top}")
+    print(f"queries with overlapping results: {merged_queries} ({merged_queries / len(queries):.0%})")
+    print(f"{'':>8} {'mean':>8} {'median':>8}")
+    print(f"{'before':>8} {statistics.mean(before):>8.0f} {statistics.median(before):>8.0f}")
+    print(f"{'after':>8} {statistics.mean(after):>8.0f} {statistics.median(after):>8.0f}")
+    print(f"tokens of sources saved: {1 - sum(after) / sum(before):.1%}")
+
+
+if __name__ == "__main__":
+    main()
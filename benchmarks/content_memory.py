@@ -0,0 +1,195 @@
+"""
+Measures the peak memory (RSS) used by the /content route while serving blobs of increasing size.
+
+Each measurement runs in a fresh Python process so that the peak RSS of one run does not leak into the next.
+Blob Storage is replaced by an in-process transport that generates the requested byte ranges on the fly,
+so no Azure resources are needed and the only large allocations are the ones made by the app.
+
+Usage:
+    python benchmarks/content_memory.py --sizes 16 64 256
+"""
+
+import argparse
+import asyncio
+import os
+import re
+import resource
+import subprocess
+import sys
+from unittest import mock
+
+import aiohttp
+from azure.core.credentials_async import AsyncTokenCredential
+from azure.core.pipeline.transport import (
+    AioHttpTransportResponse,
+    AsyncHttpTransport,
+    HttpRequest,
+)
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app", "backend"))
+
+import app  # noqa: E402
+
+
+class MockToken:
+    token = ""
+    expires_on = 9999999999
+
+
+class MockAzureCredential(AsyncTokenCredential):
+    async def get_token(self, *scopes, **kwargs):
+        return MockToken()
+
+
+class MockAiohttpClientResponse(aiohttp.ClientResponse):
+    def __init__(self, url, body_bytes, status, headers):
+        self._body = body_bytes
+        self._headers = headers
+        self._cache = {}
+        self.status = status
+        self.reason = "OK"
+        self._url = url
+
+
+class GeneratedBlobTransport(AsyncHttpTransport):
+    """Serves a blob of the given size, allocating only the byte ranges that are requested."""
+
+    def __init__(self, size: int):
+        self.size = size
+
+    async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
+        headers = {
+            "Content-Type": "application/pdf",
+            "ETag": '"0x8DBF2C5A1B3C4D5"',
+            "Last-Modified": "Wed, 06 Dec 2023 10:00:00 GMT",
+            "x-ms-blob-type": "BlockBlob",
+        }
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(self.size)
+            return AioHttpTransportResponse(request, MockAiohttpClientResponse(request.url, b"", 200, headers))
+        start, end = 0, self.size - 1
+        if match := re.match(r"bytes=(\d+)-(\d*)", request.headers.get("x-ms-range", "")):
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+        headers["Content-Range"] = f"bytes {start}-{end}/{self.size}"
+        headers["Content-Length"] = str(end - start + 1)
+        body = bytes(end - start + 1)
+        return AioHttpTransportResponse(request, MockAiohttpClientResponse(request.url, body, 206, headers))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+async def fetch_discarding_body(asgi_app, path: str) -> int:
+    # Drive the ASGI app directly so the response body is dropped as it arrives instead of being collected
+    disconnected = asyncio.Event()
+    received = 0
+    first_receive = True
+
+    async def receive():
+        nonlocal first_receive
+        if first_receive:
+            first_receive = False
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal received
+        if message["type"] == "http.response.body":
+            received += len(message.get("body", b""))
+            if not message.get("more_body"):
+                disconnected.set()
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", b"localhost")],
+        "client": ("127.0.0.1", 0),
+        "server": ("localhost", 80),
+        "extensions": {},
+    }
+    await asgi_app(scope, receive, send)
+    return received
+
+
+async def measure(size_mb: int, buffered: bool) -> None:
+    from azure.storage.blob.aio import BlobServiceClient
+
+    size = size_mb * 1024 * 1024
+    blob_service_client = BlobServiceClient(
+        "https://benchmark.blob.core.windows.net",
+        credential=MockAzureCredential(),
+        transport=GeneratedBlobTransport(size),
+        max_single_get_size=app.CONTENT_CHUNK_SIZE,
+        max_chunk_get_size=app.CONTENT_CHUNK_SIZE,
+    )
+    container_client = blob_service_client.get_container_client("content")
+
+    with mock.patch("app.DefaultAzureCredential") as mock_default_azure_credential:
+        mock_default_azure_credential.return_value = MockAzureCredential()
+        quart_app = app.create_app()
+        async with quart_app.test_app():
+            quart_app.config[app.CONFIG_BLOB_CONTAINER_CLIENT] = container_client
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if buffered:
+                # What the route used to do: read the whole blob into memory before responding
+                blob = await container_client.get_blob_client("contract.pdf").download_blob()
+                received = len(await blob.readall())
+            else:
+                received = await fetch_discarding_body(quart_app, "/content/contract.pdf")
+            rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    assert received == size, f"Expected {size} bytes, received {received}"
+    print(f"{size_mb},{'buffered' if buffered else 'streamed'},{rss_before // 1024},{rss_after // 1024}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak RSS of the /content route by blob size")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[16, 64, 256], help="Blob sizes in MB")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--buffered", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    os.environ.update(
+        {
+            "AZURE_STORAGE_ACCOUNT": "benchmark",
+            "AZURE_STORAGE_CONTAINER": "content",
+            "AZURE_SEARCH_SERVICE": "benchmark",
+            "AZURE_SEARCH_INDEX": "benchmark",
+            "AZURE_OPENAI_CHATGPT_MODEL": "gpt-35-turbo",
+            "OPENAI_HOST": "openai",
+            "OPENAI_API_KEY": "benchmark",
+            "APP_LOG_LEVEL": "WARNING",
+        }
+    )
+    if args.child is not None:
+        asyncio.run(measure(args.child, args.buffered))
+        return
+
+    print(f"{'size MB':>8} {'mode':>9} {'peak RSS before MB':>19} {'peak RSS after MB':>18} {'growth MB':>10}")
+    for size_mb in args.sizes:
+        for buffered in (False, True):
+            command = [sys.executable, __file__, "--child", str(size_mb)] + (["--buffered"] if buffered else [])
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout.strip()
+            size, mode, before, after = output.splitlines()[-1].split(",")
+            print(f"{size:>8} {mode:>9} {before:>19} {after:>18} {int(after) - int(before):>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Measures how long the vision approaches take to fetch the page images of the search results, before and after the
+images were fetched concurrently and cached.
+
+The blobs are served by the MockBlobClient of the tests, which answers each download after the given latency with a
+page image padded to the given size. "before" downloads and encodes the images one after the other, like the loop the
+approaches used to run. "concurrent" fetches up to --concurrency images at once, and "cached" also keeps the data URLs
+in an ImageCache that is warm from an earlier request, so each image only costs a conditional request that returns
+no bytes.
+
+Usage:
+    python benchmarks/image_fetch.py --top 6 --latency 0.05 --image-kb 600 --concurrency 4
+"""
+
+import argparse
+import asyncio
+import base64
+import os
+import sys
+import time
+
+from azure.core.exceptions import ResourceNotModifiedError
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app", "backend"))
+
+from tests.mocks import MockBlob, MockBlobClient  # noqa: E402
+
+from approaches.approach import Document  # noqa: E402
+from core.imagecache import ImageCache  # noqa: E402
+from core.imageshelper import fetch_images  # noqa: E402
+
+
+class StandInBlob(MockBlob):
+    def __init__(self, data: bytes):
+        super().__init__()
+        self.data = data
+
+    async def readall(self):
+        return self.data
+
+
+class StandInBlobClient(MockBlobClient):
+    def __init__(self, latency: float, data: bytes):
+        self.latency = latency
+        self.data = data
+
+    async def download_blob(self, **kwargs):
+        await asyncio.sleep(self.latency)
+        blob = StandInBlob(self.data)
+        if kwargs.get("etag") == blob.properties.etag:
+            raise ResourceNotModifiedError()
+        return blob
+
+
+class StandInContainerClient:
+    def __init__(self, latency: float, data: bytes):
+        self.latency = latency
+        self.data = data
+
+    def get_blob_client(self, name: str) -> StandInBlobClient:
+        return StandInBlobClient(self.latency, self.data)
+
+
+async def fetch_image_before(container: StandInContainerClient, result: Document) -> str:
+    # The download and the encoding of the approaches before the change
+    blob = await container.get_blob_client(str(result.sourcepage)).download_blob()
+    img = base64.b64encode(await blob.readall()).decode("utf-8")
+    return f"data:image/png;base64,{img}"
+
+
+async def measure(mode: str, top: int, latency: float, size: int, concurrency: int, requests: int) -> float:
+    # The PNG of MockBlob, padded to the size of a page image
+    png = await MockBlob().readall()
+    container = StandInContainerClient(latency, png + b"\x00" * max(size - len(png), 0))
+    results = [
+        Document(
+            id=str(i),
+            content="",
+            embedding=None,
+            image_embedding=None,
+            category=None,
+            sourcepage=f"Financial Market Analysis Report 2023-{i}.png",
+            sourcefile="Financial Market Analysis Report 2023.pdf",
+            oids=None,
+            groups=None,
+            captions=[],
+        )
+        for i in range(top)
+    ]
+    image_cache = ImageCache(max_bytes=256 * 1024 * 1024) if mode == "cached" else None
+    if image_cache:
+        await fetch_images(container, results, image_cache, concurrency)  # type: ignore[arg-type]
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        if mode == "before":
+            for result in results:
+                await fetch_image_before(container, result)
+        else:
+            await fetch_images(container, results, image_cache, concurrency)  # type: ignore[arg-type]
+    return (time.perf_counter() - start) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Page image fetch time before and after concurrency and caching")
+    parser.add_argument("--top", type=int, default=6, help="Number of search results with a page image")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds taken by each blob download")
+    parser.add_argument("--image-kb", type=int, default=600, help="Size of each page image in KB")
+    parser.add_argument("--concurrency", type=int, default=4, help="Images fetched at once after the change")
+    parser.add_argument("--requests", type=int, default=5, help="Requests measured in each mode")
+    args = parser.parse_args()
+
+    print(f"{'mode':>10} {'ms/request':>11}")
+    for mode in ("before", "concurrent", "cached"):
+        elapsed = asyncio.run(
+            measure(mode, args.top, args.latency, args.image_kb * 1024, args.concurrency, args.requests)
+        )
+        print(f"{mode:>10} {elapsed * 1000:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Compares the documents /chat retrieves with and without generating a search query, to decide whether questions can
+be searched as is with the skip_query_rewrite policy.
+
+Each question of a JSON Lines file (one object per line with the "messages" of a /chat request) is retrieved twice
+against the deployed OpenAI and AI Search services, configured by the same environment variables as the app: once with
+the generated search query and once with the question as is. The overlap is the share of the documents retrieved
+by both (intersection over union of their ids). It is reported for all the questions and for those the given policy
+would search as is, along with the time until the final completion in both modes.
+
+Usage:
+    ./scripts/loadenv.sh
+    python benchmarks/query_rewrite_eval.py --questions chat_questions.jsonl --policy self_contained --output eval.csv
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Any
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app", "backend"))
+
+import app  # noqa: E402
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach  # noqa: E402
+
+
+async def retrieve(
+    approach: ChatReadRetrieveReadApproach, messages: list[dict], overrides: dict[str, Any]
+) -> tuple[list[str], str, float]:
+    start = time.perf_counter()
+    extra_info, chat_coroutine = await approach.run_until_final_call(messages, overrides, {}, False)
+    elapsed = time.perf_counter() - start
+    chat_coroutine.close()  # Only the retrieval is compared
+    _, search_query, results = extra_info["thoughts"][:3]
+    return [document["id"] for document in results.description], search_query.description, elapsed
+
+
+async def evaluate(questions: list[dict], policy: str, max_words: int, overrides: dict[str, Any]) -> list[dict]:
+    quart_app = app.create_app()
+    rows = []
+    async with quart_app.test_app():
+        approach: ChatReadRetrieveReadApproach = quart_app.config[app.CONFIG_CHAT_APPROACH]
+        for question in questions:
+            messages = question["messages"]
+            rewritten_ids, search_query, rewritten_seconds = await retrieve(
+                approach, messages, {**overrides, "skip_query_rewrite": "never", "speculative_retrieval": False}
+            )
+            as_is_ids, _, as_is_seconds = await retrieve(
+                approach, messages, {**overrides, "skip_query_rewrite": "always"}
+            )
+            union = set(rewritten_ids) | set(as_is_ids)
+            skip_reason = approach.get_query_rewrite_skip_reason(policy, messages, max_words)
+            rows.append(
+                {
+                    "question": messages[-1]["content"],
+                    "search_query": search_query,
+                    "skipped_by_policy": skip_reason is not None,
+                    "overlap": len(set(rewritten_ids) & set(as_is_ids)) / len(union) if union else 1.0,
+                    "same_top_result": rewritten_ids[:1] == as_is_ids[:1],
+                    "rewritten_seconds": rewritten_seconds,
+                    "as_is_seconds": as_is_seconds,
+                }
+            )
+    return rows
+
+
+def report(label: str, rows: list[dict]):
+    if not rows:
+        print(f"{label:>25} {0:>9}")
+        return
+    print(
+        f"{label:>25} {len(rows):>9} {statistics.mean(row['overlap'] for row in rows):>8.2f}"
+        f" {statistics.mean(row['same_top_result'] for row in rows):>8.0%}"
+        f" {statistics.median(row['rewritten_seconds'] for row in rows):>17.3f}"
+        f" {statistics.median(row['as_is_seconds'] for row in rows):>13.3f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retrieval overlap of /chat with and without the query rewrite")
+    parser.add_argument("--questions", required=True, help="JSON Lines file of requests with their messages")
+    parser.add_argument("--policy", default="self_contained", choices=["first_turn", "self_contained", "always"])
+    parser.add_argument("--max-words", type=int, default=16, help="Longest question the policy searches as is")
+    parser.add_argument("--overrides", default="{}", help="JSON overrides of every request, e.g. the retrieval_mode")
+    parser.add_argument("--output", help="CSV file of the result of each question")
+    args = parser.parse_args()
+
+    with open(args.questions, encoding="utf-8") as questions_file:
+        questions = [json.loads(line) for line in questions_file if line.strip()]
+    rows = asyncio.run(evaluate(questions, args.policy, args.max_words, json.loads(args.overrides)))
+
+    print(
+        f"{'questions':>25} {'count':>9} {'overlap':>8} {'same top':>8} {'rewritten p50 (s)':>17} {'as is p50 (s)':>13}"
+    )
+    report("all", rows)
+    report(f"skipped by {args.policy}", [row for row in rows if row["skipped_by_policy"]])
+    if args.output:
+        with open(args.output, "w", newline="", encoding="utf-8") as output_file:
+            writer = csv.DictWriter(output_file, fieldnames=list(rows[0]) if rows else ["question"])
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Measures how long RubricEvaluationApproach takes to evaluate a rubric, before and after it moved to the shared,
+pooled AsyncOpenAI client and concurrent criteria.
+
+OpenAI is replaced by a local stand-in server that answers chat completions and embeddings after the given latency,
+and AI Search by an in-process stand-in that returns three documents after its own latency.
+"before" evaluates one criterion at a time and opens a new connection for every OpenAI call, like the module-level
+calls of the pre-1.0 openai package did. "after" uses a client with a keep-alive pool and evaluates
+--concurrency criteria at once. "packed" also answers the criteria that share sources with one completion
+(the pack_criteria override). The server counts the connections it accepted, and the prompt tokens are those the
+stand-in reports, about four characters each.
+
+Usage:
+    python benchmarks/rubric_throughput.py --criteria 10 30 --latency 0.2 --concurrency 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+
+import httpx
+from aiohttp import web
+from openai import AsyncOpenAI
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app", "backend"))
+
+from approaches.RubricEvaluationApproach import RubricEvaluationApproach  # noqa: E402
+from core.authentication import AuthenticationHelper  # noqa: E402
+
+
+class StandInOpenAI:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.connections: set = set()
+
+    async def chat_completions(self, request: web.Request) -> web.Response:
+        self.connections.add(request.transport.get_extra_info("peername") if request.transport else None)
+        messages = (await request.json())["messages"]
+        content = "The supplier may terminate. [terms.pdf#page=1]"
+        if '{"answers"' in messages[0]["content"]:
+            criteria = re.findall(r"^(\d+)\. ", messages[-1]["content"], re.MULTILINE)
+            content = json.dumps({"answers": [{"criterion": int(number), "answer": content} for number in criteria]})
+        prompt_tokens = sum(len(str(message["content"])) for message in messages) // 4
+        await asyncio.sleep(self.latency)
+        return web.json_response(
+            {
+                "id": "chatcmpl-1",
+                "object": "chat.completion",
+                "created": 0,
+                "model": "gpt-35-turbo",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 10, "total_tokens": prompt_tokens + 10},
+            }
+        )
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        self.connections.add(request.transport.get_extra_info("peername") if request.transport else None)
+        inputs = (await request.json())["input"]
+        await asyncio.sleep(self.latency / 4)
+        return web.json_response(
+            {
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": [0.1] * 1536}
+                    for i in range(len(inputs) if isinstance(inputs, list) else 1)
+                ],
+                "model": "text-embedding-ada-002",
+                "usage": {"prompt_tokens": 8, "total_tokens": 8},
+            }
+        )
+
+
+class StandInSearchResults:
+    def __init__(self, documents: list[dict]):
+        self.documents = documents
+
+    def by_page(self):
+        async def pages():
+            async def page():
+                for document in self.documents:
+                    yield document
+
+            yield page()
+
+        return pages()
+
+
+class StandInSearchClient:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def search(self, *args, **kwargs) -> StandInSearchResults:
+        await asyncio.sleep(self.latency)
+        return StandInSearchResults(
+            [
+                {
+                    "id": str(i),
+                    "content": "The supplier may terminate with 30 days notice.",
+                    "sourcepage": f"terms.pdf#page={i}",
+                }
+                for i in range(1, 4)
+            ]
+        )
+
+
+async def measure(criteria: int, latency: float, concurrency: int, pooled: bool, pack: bool) -> tuple[float, int, int]:
+    stand_in = StandInOpenAI(latency)
+    server_app = web.Application()
+    server_app.router.add_post("/v1/chat/completions", stand_in.chat_completions)
+    server_app.router.add_post("/v1/embeddings", stand_in.embeddings)
+    runner = web.AppRunner(server_app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # type: ignore[union-attr]
+
+    # Without keep-alive every call opens its own connection
+    limits = httpx.Limits(max_connections=100, max_keepalive_connections=100 if pooled else 0)
+    openai_client = AsyncOpenAI(
+        api_key="stand-in", base_url=f"http://127.0.0.1:{port}/v1", http_client=httpx.AsyncClient(limits=limits)
+    )
+    approach = RubricEvaluationApproach(
+        search_client=StandInSearchClient(latency / 4),  # type: ignore[arg-type]
+        auth_helper=AuthenticationHelper(None, False, None, None, None, None),
+        openai_client=openai_client,
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment=None,
+        embedding_model="text-embedding-ada-002",
+        embedding_deployment=None,
+        sourcepage_field="sourcepage",
+        content_field="content",
+        query_language="en-us",
+        query_speller="lexicon",
+        max_concurrent_criteria=concurrency if pooled else 1,
+    )
+    rubric = [f"Can the supplier terminate the agreement for reason {i}?" for i in range(criteria)]
+    start = time.perf_counter()
+    result = await approach.run(rubric, [], context={"overrides": {"pack_criteria": pack}})
+    elapsed = time.perf_counter() - start
+    assert isinstance(result, dict) and not result["errors"], result
+
+    await openai_client.close()
+    await runner.cleanup()
+    return elapsed, len(stand_in.connections), result["usage"]["prompt_tokens"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rubric evaluation throughput before and after pooling")
+    parser.add_argument("--criteria", nargs="+", type=int, default=[10, 30], help="Numbers of rubric criteria")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds taken by each chat completion")
+    parser.add_argument("--concurrency", type=int, default=5, help="Criteria evaluated at once after the change")
+    args = parser.parse_args()
+
+    print(f"{'criteria':>8} {'mode':>7} {'seconds':>8} {'criteria/s':>11} {'connections':>12} {'prompt tokens':>14}")
+    for criteria in args.criteria:
+        for mode, pooled, pack in (("before", False, False), ("after", True, False), ("packed", True, True)):
+            elapsed, connections, prompt_tokens = asyncio.run(
+                measure(criteria, args.latency, args.concurrency, pooled, pack)
+            )
+            print(
+                f"{criteria:>8} {mode:>7} {elapsed:>8.2f} {criteria / elapsed:>11.1f} {connections:>12} {prompt_tokens:>14}"
+            )
+
+
+if __name__ == "__main__":
+    main()
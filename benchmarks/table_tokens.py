@@ -0,0 +1,93 @@
+"""
+Compares the tokens the sections of the PDFs of data/ take in a prompt with their tables in HTML, as prepdocs indexes
+them, and rendered in the compact table format of the approaches.
+
+The tables are written by Azure AI Document Intelligence, so the PDFs are parsed by the service configured for
+prepdocs, and split into sections like prepdocs does. The parsed pages are saved to --pages, so that later runs don't
+parse the PDFs again.
+
+Usage:
+    ./scripts/loadenv.sh
+    python benchmarks/table_tokens.py --formrecognizerservice "$AZURE_FORMRECOGNIZER_SERVICE" --pages pages.json
+"""
+
+import argparse
+import asyncio
+import glob
+import json
+import os
+import sys
+from typing import Union
+
+from azure.core.credentials import AzureKeyCredential
+from azure.core.credentials_async import AsyncTokenCredential
+from azure.identity.aio import AzureDeveloperCliCredential
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app", "backend"))
+
+from core.modelhelper import get_encoding  # noqa: E402
+from core.tablerenderer import render_tables_compact  # noqa: E402
+
+from scripts.prepdocslib.pdfparser import DocumentAnalysisPdfParser, Page  # noqa: E402
+from scripts.prepdocslib.textsplitter import TextSplitter  # noqa: E402
+
+MODEL = "gpt-35-turbo"
+
+
+async def parse_pdfs(pattern: str, service: str, key: str) -> dict[str, list[dict]]:
+    credential: Union[AsyncTokenCredential, AzureKeyCredential] = (
+        AzureKeyCredential(key) if key else AzureDeveloperCliCredential(process_timeout=60)
+    )
+    parser = DocumentAnalysisPdfParser(
+        endpoint=f"https://{service}.cognitiveservices.azure.com/", credential=credential
+    )
+    parsed = {}
+    for path in sorted(glob.glob(pattern)):
+        with open(path, "rb") as f:
+            parsed[os.path.basename(path)] = [page.__dict__ async for page in parser.parse(f)]
+    return parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tokens of the sections with HTML and compact tables")
+    parser.add_argument("--data", default=os.path.join(os.path.dirname(__file__), "..", "data", "*.pdf"))
+    parser.add_argument("--formrecognizerservice", help="Document Intelligence service that parses the PDFs")
+    parser.add_argument("--formrecognizerkey", help="Key of the service, instead of the azd login")
+    parser.add_argument("--pages", help="JSON file of the parsed pages, written on the first run and read afterwards")
+    args = parser.parse_args()
+
+    if args.pages and os.path.exists(args.pages):
+        with open(args.pages) as f:
+            parsed = json.load(f)
+    else:
+        if not args.formrecognizerservice:
+            parser.error("--formrecognizerservice is needed to parse the PDFs")
+        parsed = asyncio.run(parse_pdfs(args.data, args.formrecognizerservice, args.formrecognizerkey))
+        if args.pages:
+            with open(args.pages, "w") as f:
+                json.dump(parsed, f)
+
+    encoding = get_encoding(MODEL)
+    print(f"{'file':<60} {'sections':>8} {'tables':>7} {'html':>8} {'compact':>8} {'saved':>6}")
+    total_html = total_compact = 0
+    for filename, pages in parsed.items():
+        sections = list(TextSplitter(has_image_embeddings=False).split_pages([Page(**page) for page in pages]))
+        html_tokens = compact_tokens = with_tables = 0
+        for i, section in enumerate(sections):
+            compact = render_tables_compact(f"{filename}-page-{i}", section.text)
+            with_tables += compact != section.text
+            html_tokens += len(encoding.encode(section.text))
+            compact_tokens += len(encoding.encode(compact))
+        total_html += html_tokens
+        total_compact += compact_tokens
+        saved = 1 - compact_tokens / html_tokens if html_tokens else 0
+        print(
+            f"{filename[:60]:<60} {len(sections):>8} {with_tables:>7} {html_tokens:>8} {compact_tokens:>8} {saved:>6.1%}"
+        )
+    if total_html:
+        print(f"tokens saved by the compact tables: {1 - total_compact / total_html:.1%}")
+
+
+if __name__ == "__main__":
+    main()
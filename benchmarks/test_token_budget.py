@@ -0,0 +1,112 @@
+"""
+Benchmarks how long /chat takes to fit a 50-turn conversation within the token limit of the model, before and after the
+encoding was looked up once per process, the token counts of the messages were cached, and the messages that fit were
+inserted all at once.
+
+"before" replays the previous implementation, which looked up the encoding and tokenized every message on every turn.
+"cold" is the first request of a conversation, when none of its messages were counted yet, and "warm" is a follow-up
+request, which resends the history that was counted for the previous turn.
+
+Usage:
+    python -m pytest benchmarks/test_token_budget.py --benchmark-columns=min,median,mean
+"""
+
+import pytest
+import tiktoken
+
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from core.authentication import AuthenticationHelper
+from core.messagebuilder import MessageBuilder
+from core.modelhelper import get_oai_chatmodel_tiktok, token_count_cache
+
+MODEL = "gpt-35-turbo"
+MAX_TOKENS = 3000
+TURNS = 50
+
+
+def make_history(turns: int) -> list[dict[str, str]]:
+    history = []
+    for turn in range(turns):
+        history.append({"role": "user", "content": f"Question {turn}: what does the contract say about clause {turn}?"})
+        history.append(
+            {
+                "role": "assistant",
+                "content": f"Clause {turn} says that either party may terminate the agreement with 30 days written "
+                "notice, provided that all outstanding invoices are paid and the confidential information of the "
+                f"other party is returned or destroyed [contract.pdf#page={turn}].",
+            }
+        )
+    history.append({"role": "user", "content": "And what about the renewal?"})
+    return history
+
+
+def num_tokens_before(message: dict[str, str], model: str) -> int:
+    encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+    return 2 + sum(len(encoding.encode(value)) for value in message.values())
+
+
+def get_messages_from_history_before(history: list[dict[str, str]]) -> list:
+    message_builder = MessageBuilder("You are a helpful assistant.", MODEL)
+    message_builder.insert_message("user", history[-1]["content"], index=1)
+    total_token_count = num_tokens_before(dict(message_builder.messages[-1]), MODEL)  # type: ignore[arg-type]
+    for message in reversed(history[:-1]):
+        potential_message_count = num_tokens_before(message, MODEL)
+        if (total_token_count + potential_message_count) > MAX_TOKENS:
+            break
+        message_builder.insert_message(message["role"], message["content"], index=1)
+        total_token_count += potential_message_count
+    return message_builder.messages
+
+
+@pytest.fixture
+def approach() -> ChatReadRetrieveReadApproach:
+    return ChatReadRetrieveReadApproach(
+        search_client=None,  # type: ignore[arg-type]
+        auth_helper=AuthenticationHelper(None, False, None, None, None, None),
+        openai_client=None,  # type: ignore[arg-type]
+        chatgpt_model=MODEL,
+        chatgpt_deployment=None,
+        embedding_model="text-embedding-ada-002",
+        embedding_deployment=None,
+        sourcepage_field="sourcepage",
+        content_field="content",
+        query_language="en-us",
+        query_speller="lexicon",
+    )
+
+
+def get_messages_from_history(approach: ChatReadRetrieveReadApproach, history: list[dict[str, str]]) -> list:
+    return approach.get_messages_from_history(
+        system_prompt="You are a helpful assistant.",
+        model_id=MODEL,
+        history=history,
+        user_content=history[-1]["content"],
+        max_tokens=MAX_TOKENS,
+    )
+
+
+@pytest.mark.benchmark(group=f"{TURNS}-turn history")
+def test_history_before(benchmark, approach):
+    history = make_history(TURNS)
+    messages = benchmark(get_messages_from_history_before, history)
+    assert messages == get_messages_from_history(approach, history)
+
+
+@pytest.mark.benchmark(group=f"{TURNS}-turn history")
+def test_history_cold(benchmark, approach):
+    history = make_history(TURNS)
+    messages = benchmark.pedantic(
+        get_messages_from_history,
+        args=(approach, history),
+        setup=token_count_cache.clear,
+        rounds=50,
+    )
+    assert 2 < len(messages) < len(history)
+
+
+@pytest.mark.benchmark(group=f"{TURNS}-turn history")
+def test_history_warm(benchmark, approach):
+    history = make_history(TURNS)
+    get_messages_from_history(approach, history[:-2])
+    messages = benchmark(get_messages_from_history, approach, history)
+    assert 2 < len(messages) < len(history)
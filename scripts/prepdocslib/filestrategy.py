@@ -1,5 +1,5 @@
 from enum import Enum
-from typing import List, Optional
+from typing import Callable, List, Optional
 
 from .blobmanager import BlobManager
 from .embeddings import ImageEmbeddings, OpenAIEmbeddings
@@ -33,6 +33,7 @@ class FileStrategy(Strategy):
         search_analyzer_name: Optional[str] = None,
         use_acls: bool = False,
         category: Optional[str] = None,
+        on_content_changed: Optional[Callable[[], None]] = None,
     ):
         self.list_file_strategy = list_file_strategy
         self.blob_manager = blob_manager
@@ -44,6 +45,7 @@ class FileStrategy(Strategy):
         self.search_analyzer_name = search_analyzer_name
         self.use_acls = use_acls
         self.category = category
+        self.on_content_changed = on_content_changed
 
     async def setup(self, search_info: SearchInfo):
         search_manager = SearchManager(
@@ -56,7 +58,13 @@ class FileStrategy(Strategy):
         await search_manager.create_index()
 
     async def run(self, search_info: SearchInfo):
-        search_manager = SearchManager(search_info, self.search_analyzer_name, self.use_acls, self.embeddings)
+        search_manager = SearchManager(
+            search_info,
+            self.search_analyzer_name,
+            self.use_acls,
+            self.embeddings,
+            on_content_changed=self.on_content_changed,
+        )
         if self.document_action == DocumentAction.Add:
             files = self.list_file_strategy.list()
             async for file in files:
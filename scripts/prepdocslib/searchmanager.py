@@ -1,7 +1,8 @@
 import asyncio
 import os
-from typing import List, Optional
+from typing import Callable, List, Optional
 
+import tiktoken
 from azure.search.documents.indexes.models import (
     HnswParameters,
     HnswVectorSearchAlgorithmConfiguration,
@@ -25,6 +26,9 @@ from .listfilestrategy import File
 from .strategy import SearchInfo
 from .textsplitter import SplitPage
 
+# The encoding of the chat models answering from the index, used to store the number of tokens of each section
+TOKENS_ENCODING = "cl100k_base"
+
 
 class Section:
     """
@@ -50,12 +54,15 @@ class SearchManager:
         use_acls: bool = False,
         embeddings: Optional[OpenAIEmbeddings] = None,
         search_images: bool = False,
+        on_content_changed: Optional[Callable[[], None]] = None,
     ):
         self.search_info = search_info
         self.search_analyzer_name = search_analyzer_name
         self.use_acls = use_acls
         self.embeddings = embeddings
         self.search_images = search_images
+        # Called after sections were updated or removed, e.g. to invalidate the caches of an app serving the index
+        self.on_content_changed = on_content_changed
 
     async def create_index(self):
         if self.search_info.verbose:
@@ -79,6 +86,7 @@ class SearchManager:
                 SimpleField(name="category", type="Edm.String", filterable=True, facetable=True),
                 SimpleField(name="sourcepage", type="Edm.String", filterable=True, facetable=True),
                 SimpleField(name="sourcefile", type="Edm.String", filterable=True, facetable=True),
+                self.tokens_field(),
             ]
             if self.use_acls:
                 fields.append(
@@ -142,10 +150,21 @@ class SearchManager:
             else:
                 if self.search_info.verbose:
                     print(f"Search index {self.search_info.index_name} already exists")
+                existing_index = await search_index_client.get_index(self.search_info.index_name)
+                if not any(field.name == "tokens" for field in existing_index.fields):
+                    if self.search_info.verbose:
+                        print(f"Adding tokens field to {self.search_info.index_name} search index")
+                    existing_index.fields.append(self.tokens_field())
+                    await search_index_client.create_or_update_index(existing_index)
+
+    def tokens_field(self) -> SearchField:
+        # The number of tokens of the content, so the app doesn't have to count them for every answer
+        return SimpleField(name="tokens", type=SearchFieldDataType.Int32)
 
     async def update_content(self, sections: List[Section], image_embeddings: Optional[List[List[float]]] = None):
         MAX_BATCH_SIZE = 1000
         section_batches = [sections[i : i + MAX_BATCH_SIZE] for i in range(0, len(sections), MAX_BATCH_SIZE)]
+        encoding = tiktoken.get_encoding(TOKENS_ENCODING)
 
         async with self.search_info.create_search_client() as search_client:
             for batch_index, batch in enumerate(section_batches):
@@ -162,11 +181,14 @@ class SearchManager:
                             filename=section.content.filename(), page=section.split_page.page_num
                         ),
                         "sourcefile": section.content.filename(),
+                        "tokens": len(encoding.encode(section.split_page.text)),
                         **section.content.acls,
                     }
                     for section_index, section in enumerate(batch)
                 ]
                 if self.embeddings:
+                    if self.search_info.verbose:
+                        print(f"Computing embeddings for {len(batch)} sections")
                     embeddings = await self.embeddings.create_embeddings(
                         texts=[section.split_page.text for section in batch]
                     )
@@ -176,7 +198,11 @@ class SearchManager:
                     for i, (document, section) in enumerate(zip(documents, batch)):
                         document["imageEmbedding"] = image_embeddings[section.split_page.page_num]
 
+                if self.search_info.verbose:
+                    print(f"Indexing {len(documents)} sections into search index '{self.search_info.index_name}'")
                 await search_client.upload_documents(documents)
+        if self.on_content_changed:
+            self.on_content_changed()
 
     async def remove_content(self, path: Optional[str] = None):
         if self.search_info.verbose:
@@ -194,3 +220,5 @@ class SearchManager:
                     print(f"\tRemoved {len(removed_docs)} sections from index")
                 # It can take a few seconds for search results to reflect changes, so wait a bit
                 await asyncio.sleep(2)
+        if self.on_content_changed:
+            self.on_content_changed()
@@ -17,14 +17,16 @@ class MockAzureCredential(AsyncTokenCredential):
 
 
 class MockBlobClient:
-    async def download_blob(self):
+    async def download_blob(self, **kwargs):
         return MockBlob()
 
 
 class MockBlob:
     def __init__(self):
         self.properties = BlobProperties(
-            name="Financial Market Analysis Report 2023-7.png", content_settings={"content_type": "image/png"}
+            name="Financial Market Analysis Report 2023-7.png",
+            content_settings={"content_type": "image/png"},
+            ETag='"0x8DC0B6F5AB2A1B1"',
         )
 
     async def readall(self):
@@ -0,0 +1,186 @@
+import json
+
+import pytest
+from azure.search.documents.indexes.models import SearchField, SearchIndex
+
+import app
+from approaches.retrievethenread import RetrieveThenReadApproach
+from core.answercache import AnswerCache
+from core.authentication import AuthenticationHelper
+
+
+@pytest.fixture
+def answer_cache_env(monkeypatch, mock_env):
+    monkeypatch.setenv("ANSWER_CACHE_MB", "1")
+
+
+@pytest.fixture
+def semantic_cache_env(monkeypatch, mock_env):
+    monkeypatch.setenv("SEMANTIC_CACHE_MAX_ENTRIES", "10")
+    monkeypatch.setenv("SEMANTIC_CACHE_SAMPLE_RATE", "0")
+
+
+@pytest.fixture
+def chat_calls(monkeypatch):
+    calls = []
+
+    def patch(openai_client):
+        create = openai_client.chat.completions.create
+
+        async def mock_create(*args, **kwargs):
+            calls.append(kwargs)
+            return await create(*args, **kwargs)
+
+        monkeypatch.setattr(openai_client.chat.completions, "create", mock_create)
+
+    patch.calls = calls  # type: ignore[attr-defined]
+    return patch
+
+
+@pytest.mark.asyncio
+async def test_ask_answer_cache(answer_cache_env, client, chat_calls):
+    chat_calls(client.app.config[app.CONFIG_OPENAI_CLIENT])
+    request = {
+        "messages": [{"content": "What is the capital of France?", "role": "user"}],
+        "context": {"overrides": {"retrieval_mode": "text", "temperature": 0}},
+    }
+    response = await client.post("/ask", json={**request, "session_state": "a"})
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert len(chat_calls.calls) == 1
+    assert chat_calls.calls[0]["temperature"] == 0
+
+    response = await client.post("/ask", json={**request, "session_state": "b"})
+    cached_result = await response.get_json()
+    assert len(chat_calls.calls) == 1
+    assert cached_result["choices"][0]["session_state"] == "b"
+    cached_result["choices"][0]["session_state"] = "a"
+    assert cached_result == result
+
+    # Only answers of deterministic completions are cached
+    request["context"]["overrides"]["temperature"] = 0.3
+    await client.post("/ask", json=request)
+    await client.post("/ask", json=request)
+    assert len(chat_calls.calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_chat_answer_cache_replays_stream(answer_cache_env, client, chat_calls):
+    chat_calls(client.app.config[app.CONFIG_OPENAI_CLIENT])
+    request = {
+        "messages": [{"content": "What is the capital of France?", "role": "user"}],
+        "context": {"overrides": {"retrieval_mode": "text", "temperature": 0, "suggest_followup_questions": True}},
+    }
+    response = await client.post("/chat", json=request)
+    assert response.status_code == 200
+    result = await response.get_json()
+    # The query rewrite and the answer
+    assert len(chat_calls.calls) == 2
+
+    response = await client.post("/chat", json={**request, "stream": True})
+    assert response.status_code == 200
+    assert len(chat_calls.calls) == 2
+    lines = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert lines[0]["choices"][0]["delta"]["role"] == "assistant"
+    assert lines[0]["choices"][0]["context"]["data_points"] == result["choices"][0]["context"]["data_points"]
+    assert lines[1]["choices"][0]["delta"]["content"] == result["choices"][0]["message"]["content"]
+    assert lines[2]["choices"][0]["context"]["followup_questions"] == ["What is the capital of Spain?"]
+
+    # A streamed answer is cached too
+    request["messages"][0]["content"] = "What is the capital of France? "
+    response = await client.post("/chat", json={**request, "stream": True})
+    await response.get_data()
+    assert len(chat_calls.calls) == 4
+    response = await client.post("/chat", json=request)
+    cached_result = await response.get_json()
+    assert len(chat_calls.calls) == 4
+    assert (
+        cached_result["choices"][0]["message"]["content"] == "The capital of France is Paris. [Benefit_Options-2.pdf]. "
+    )
+    assert cached_result["choices"][0]["context"]["followup_questions"] == ["What is the capital of Spain?"]
+
+
+@pytest.mark.asyncio
+async def test_ask_semantic_cache(semantic_cache_env, client, chat_calls):
+    chat_calls(client.app.config[app.CONFIG_OPENAI_CLIENT])
+    # The embeddings are mocked, so any question has the same embedding
+    request = {
+        "messages": [{"content": "can we assign this agreement to a third party?", "role": "user"}],
+        "context": {"overrides": {"temperature": 0}},
+    }
+    response = await client.post("/ask", json=request)
+    result = await response.get_json()
+    assert len(chat_calls.calls) == 1
+
+    request["messages"][0]["content"] = "is assignment to third parties allowed?"
+    response = await client.post("/ask", json=request)
+    assert await response.get_json() == result
+    assert len(chat_calls.calls) == 1
+
+    # Text retrieval doesn't compute embeddings, so it doesn't use the semantic cache
+    request["context"]["overrides"]["retrieval_mode"] = "text"
+    await client.post("/ask", json=request)
+    assert len(chat_calls.calls) == 2
+    stats = client.app.config[app.CONFIG_SEMANTIC_CACHE].get_stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+
+
+def test_answer_cache_key(mock_confidential_client_success):
+    auth_helper = AuthenticationHelper(
+        search_index=SearchIndex(
+            name="test",
+            fields=[
+                SearchField(name="oids", type="Collection(Edm.String)"),
+                SearchField(name="groups", type="Collection(Edm.String)"),
+            ],
+        ),
+        use_authentication=True,
+        server_app_id="SERVER_APP",
+        server_app_secret="SERVER_SECRET",
+        client_app_id="CLIENT_APP",
+        tenant_id="TENANT_ID",
+        require_access_control=True,
+    )
+    answer_cache = AnswerCache(max_bytes=1024 * 1024, ttl=None)
+    approach = RetrieveThenReadApproach(
+        search_client=None,
+        auth_helper=auth_helper,
+        openai_client=None,
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_model="text-embedding-ada-002",
+        embedding_deployment="embeddings",
+        sourcepage_field="sourcepage",
+        content_field="content",
+        query_language="en-us",
+        query_speller="lexicon",
+        answer_cache=answer_cache,
+    )
+    messages = [{"content": "Can we assign this agreement?", "role": "user"}]
+    overrides = {"temperature": 0}
+    key = approach.get_answer_cache_key(messages, overrides, {"oid": "OID_X", "groups": ["GROUP_Y"]})
+    assert key is not None
+    assert key == approach.get_answer_cache_key(messages, {"temperature": 0}, {"oid": "OID_X", "groups": ["GROUP_Y"]})
+    # Users with other access get their own answers
+    assert key != approach.get_answer_cache_key(messages, overrides, {"oid": "OID_Z", "groups": ["GROUP_Y"]})
+    assert key != approach.get_answer_cache_key(messages, overrides, {"oid": "OID_X", "groups": []})
+    # So do other overrides and a new version of the index
+    assert key != approach.get_answer_cache_key(
+        messages, {**overrides, "top": 5}, {"oid": "OID_X", "groups": ["GROUP_Y"]}
+    )
+    answer_cache.invalidate()
+    assert key != approach.get_answer_cache_key(messages, overrides, {"oid": "OID_X", "groups": ["GROUP_Y"]})
+    assert approach.get_answer_cache_key(messages, {}, {"oid": "OID_X", "groups": ["GROUP_Y"]}) is None
+
+
+def test_answer_cache_returns_copies():
+    cache = AnswerCache(max_bytes=1024, ttl=None)
+    cache.set("key", {"choices": [{"message": {"content": "Paris"}, "session_state": None}]})
+    cached = cache.get("key")
+    assert cached is not None
+    cached["choices"][0]["session_state"] = "mine"
+    assert cache.get("key") == {"choices": [{"message": {"content": "Paris"}, "session_state": None}]}
+    cache.invalidate()
+    assert cache.get("key") is None
+    assert cache.get_stats()["index_version"] == 1
@@ -601,6 +601,11 @@ async def test_chat_vision(client, snapshot):
     )
     assert response.status_code == 200
     result = await response.get_json()
+    # The time each query vector took varies, only the fields are compared. Without GPT-4 with Vision deployed, the
+    # request is answered by the text approach, which doesn't report it.
+    props = result["choices"][0]["context"]["thoughts"][1]["props"]
+    if "vector_seconds" in props:
+        assert list(props.pop("vector_seconds")) == ["embedding", "imageEmbedding"]
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
 
 
@@ -622,6 +627,11 @@ async def test_chat_vision_vectors(client, snapshot):
     )
     assert response.status_code == 200
     result = await response.get_json()
+    # The time each query vector took varies, only the fields are compared. Without GPT-4 with Vision deployed, the
+    # request is answered by the text approach, which doesn't report it.
+    props = result["choices"][0]["context"]["thoughts"][1]["props"]
+    if "vector_seconds" in props:
+        assert list(props.pop("vector_seconds")) == ["embedding", "imageEmbedding"]
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
 
 
@@ -642,6 +652,11 @@ async def test_ask_vision(client, snapshot):
     )
     assert response.status_code == 200
     result = await response.get_json()
+    # The time each query vector took varies, only the fields are compared. Without GPT-4 with Vision deployed, the
+    # request is answered by the text approach, which doesn't report it.
+    props = result["choices"][0]["context"]["thoughts"][0]["props"]
+    if "vector_seconds" in props:
+        assert list(props.pop("vector_seconds")) == ["embedding", "imageEmbedding"]
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
 
 
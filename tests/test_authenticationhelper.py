@@ -1,8 +1,18 @@
+import asyncio
+import base64
+import json
+import threading
+import time
+
+import aiohttp
+import msal
 import pytest
 from azure.search.documents.indexes.models import SearchField, SearchIndex
 
 from core.authentication import AuthenticationHelper, AuthError
 
+from .mocks import MockResponse
+
 MockSearchIndex = SearchIndex(
     name="test",
     fields=[
@@ -32,6 +42,56 @@ async def test_get_auth_claims_success(mock_confidential_client_success):
     assert auth_claims.get("groups") == ["GROUP_Y", "GROUP_Z"]
 
 
+def make_token(exp: float) -> str:
+    payload = base64.urlsafe_b64encode(json.dumps({"oid": "OID_X", "exp": exp}).encode()).decode().rstrip("=")
+    return f"eyJhbGciOiJSUzI1NiJ9.{payload}.signature"
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_cached_per_token(monkeypatch, mock_confidential_client_success):
+    threads = []
+
+    def mock_acquire_token_on_behalf_of(self, *args, **kwargs):
+        threads.append(threading.current_thread().name)
+        time.sleep(0.05)
+        return {"access_token": "MockToken", "id_token_claims": {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}}
+
+    monkeypatch.setattr(
+        msal.ConfidentialClientApplication, "acquire_token_on_behalf_of", mock_acquire_token_on_behalf_of
+    )
+    helper = create_authentication_helper()
+    token = make_token(time.time() + 3600)
+
+    # Concurrent requests with the same token share one exchange, which doesn't run on the event loop
+    results = await asyncio.gather(
+        *[helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {token}"}) for _ in range(5)]
+    )
+    assert all(result == {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]} for result in results)
+    assert len(threads) == 1
+    assert threads[0].startswith("msal")
+    assert helper.shared_exchanges == 4
+
+    # Later requests with the token are answered from the cache, other tokens are exchanged
+    assert (await helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {token}"}))["oid"] == "OID_X"
+    assert len(threads) == 1
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {make_token(time.time() + 3600)}x"})
+    assert len(threads) == 2
+
+    # Claims of expired tokens are not cached
+    expired_token = make_token(time.time() - 60)
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {expired_token}"})
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {expired_token}"})
+    assert len(threads) == 4
+    assert helper.get_stats()["exchanges"] == 4
+    await helper.close()
+
+
+def test_get_token_expiry():
+    assert AuthenticationHelper.get_token_expiry(make_token(1700000000)) == 1700000000
+    assert AuthenticationHelper.get_token_expiry("MockToken") is None
+    assert AuthenticationHelper.get_token_expiry("a.not-base64!.c") is None
+
+
 @pytest.mark.asyncio
 async def test_get_auth_claims_unauthorized(mock_confidential_client_unauthorized):
     helper = create_authentication_helper()
@@ -47,6 +107,44 @@ async def test_get_auth_claims_overage_success(mock_confidential_client_overage,
     assert auth_claims.get("groups") == ["OVERAGE_GROUP_Y", "OVERAGE_GROUP_Z"]
 
 
+@pytest.mark.asyncio
+async def test_get_auth_claims_overage_groups_cached(monkeypatch, mock_confidential_client_overage):
+    urls = []
+
+    def mock_get(self, *args, **kwargs):
+        urls.append(kwargs.get("url"))
+        return MockResponse(text=json.dumps({"value": [{"id": f"OVERAGE_GROUP_{len(urls)}"}]}), status=200)
+
+    monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
+    helper = create_authentication_helper()
+    auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token1"})
+    assert auth_claims["groups"] == ["OVERAGE_GROUP_1"]
+    assert urls == ["https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id&$top=999"]
+
+    # Another token of the same user reuses the groups
+    auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token2"})
+    assert auth_claims["groups"] == ["OVERAGE_GROUP_1"]
+    assert len(urls) == 1
+
+    # Groups that are due for a refresh are returned while they are read again in the background
+    helper.groups_cache.set("OID_X", (["OVERAGE_GROUP_1"], 0.0))
+    auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token3"})
+    assert auth_claims["groups"] == ["OVERAGE_GROUP_1"]
+    await asyncio.gather(*helper.groups_refreshes.values())
+    auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token4"})
+    assert auth_claims["groups"] == ["OVERAGE_GROUP_2"]
+    assert len(urls) == 2
+
+    stats = helper.get_stats()["groups"]
+    assert stats["graph_requests"] == 1
+    assert stats["graph_background_refreshes"] == 1
+    assert stats["hits"] == 3
+    session = helper.graph_session
+    assert session is not None
+    await helper.close()
+    assert session.closed
+
+
 @pytest.mark.asyncio
 async def test_get_auth_claims_overage_unauthorized(mock_confidential_client_overage, mock_list_groups_unauthorized):
     helper = create_authentication_helper()
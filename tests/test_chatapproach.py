@@ -1,9 +1,20 @@
+import asyncio
 import json
+from dataclasses import replace
+from types import SimpleNamespace
 
 import pytest
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient
 from openai.types.chat import ChatCompletion
+from openai.types.chat.chat_completion import ChatCompletionMessage, Choice
 
+from approaches.approach import Document
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from core.authentication import AuthenticationHelper
+from core.modelhelper import get_encoding, num_tokens_from_text
+
+from .mocks import MockAsyncSearchResultsIterator
 
 
 @pytest.fixture
@@ -209,3 +220,335 @@ def test_get_messages_from_history_few_shots(chat_approach):
     assert messages[4]["role"] == "assistant"
     assert messages[5]["role"] == "user"
     assert messages[5]["content"] == user_query_request
+
+
+@pytest.fixture
+def speculative_approach(monkeypatch):
+    search_texts = []
+
+    async def mock_search(self, *args, **kwargs):
+        search_texts.append(kwargs.get("search_text"))
+        return MockAsyncSearchResultsIterator(kwargs.get("search_text"), kwargs.get("vector_queries"))
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    search_queries = {"Are interest rates high?": "interest rates"}
+
+    async def mock_create(*args, **kwargs):
+        # Lets the speculative search run while the search query is generated
+        await asyncio.sleep(0.01)
+        question = kwargs["messages"][-1]["content"].removeprefix("Generate search query for: ")
+        if kwargs.get("stream"):
+            return None
+        return ChatCompletion(
+            object="chat.completion",
+            choices=[
+                Choice(
+                    message=ChatCompletionMessage(role="assistant", content=search_queries.get(question, "0")),
+                    finish_reason="stop",
+                    index=0,
+                )
+            ],
+            id="test-123",
+            created=0,
+            model="test-model",
+        )
+
+    approach = ChatReadRetrieveReadApproach(
+        search_client=SearchClient(
+            endpoint="https://test.search.windows.net", index_name="test", credential=AzureKeyCredential("test")
+        ),
+        auth_helper=AuthenticationHelper(None, False, None, None, None, None),
+        openai_client=SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=mock_create))),
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model="text-embedding-ada-002",
+        sourcepage_field="sourcepage",
+        content_field="content",
+        query_language="en-us",
+        query_speller="lexicon",
+        speculative_retrieval=True,
+    )
+    approach.search_texts = search_texts
+    return approach
+
+
+@pytest.mark.asyncio
+async def test_speculative_retrieval_hit(speculative_approach):
+    # The search query can't be improved, so the results of the question are used
+    extra_info, chat_coroutine = await speculative_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the capital of France?"}], {"retrieval_mode": "text"}, {}, True
+    )
+    await chat_coroutine
+    assert speculative_approach.search_texts == ["What is the capital of France?"]
+    thought = extra_info["thoughts"][1]
+    assert thought.description == "What is the capital of France?"
+    assert thought.props["speculative_retrieval"] == "hit"
+
+
+@pytest.mark.asyncio
+async def test_speculative_retrieval_miss(speculative_approach):
+    extra_info, chat_coroutine = await speculative_approach.run_until_final_call(
+        [{"role": "user", "content": "Are interest rates high?"}], {"retrieval_mode": "text"}, {}, True
+    )
+    await chat_coroutine
+    assert speculative_approach.search_texts == ["Are interest rates high?", "interest rates"]
+    assert extra_info["thoughts"][1].props["speculative_retrieval"] == "miss"
+    assert extra_info["thoughts"][2].description[0]["sourcepage"] == "Financial Market Analysis Report 2023-6.png"
+
+    # Without speculation, only the generated search query is retrieved
+    speculative_approach.search_texts.clear()
+    extra_info, chat_coroutine = await speculative_approach.run_until_final_call(
+        [{"role": "user", "content": "Are interest rates high?"}],
+        {"retrieval_mode": "text", "speculative_retrieval": False},
+        {},
+        True,
+    )
+    await chat_coroutine
+    assert speculative_approach.search_texts == ["interest rates"]
+    assert "speculative_retrieval" not in extra_info["thoughts"][1].props
+
+
+@pytest.mark.asyncio
+async def test_speculative_retrieval_cancelled(speculative_approach, monkeypatch):
+    searches = []
+
+    async def slow_search(*args, **kwargs):
+        searches.append(asyncio.current_task())
+        await asyncio.sleep(60)
+
+    async def failed_create(*args, **kwargs):
+        await asyncio.sleep(0.01)
+        raise ValueError("rate limited")
+
+    monkeypatch.setattr(speculative_approach, "search", slow_search)
+    monkeypatch.setattr(speculative_approach.openai_client.chat.completions, "create", failed_create)
+    with pytest.raises(ValueError):
+        await speculative_approach.run_until_final_call(
+            [{"role": "user", "content": "What is the capital of France?"}], {"retrieval_mode": "text"}, {}, True
+        )
+    await asyncio.sleep(0)
+    assert len(searches) == 1
+    assert searches[0].cancelled()
+
+
+@pytest.mark.parametrize(
+    "policy, history, reason",
+    [
+        ("never", [{"role": "user", "content": "What termination rights do we have?"}], None),
+        ("first_turn", [{"role": "user", "content": "What termination rights do we have?"}], "first_turn"),
+        ("self_contained", [{"role": "user", "content": "What termination rights do we have?"}], "first_turn"),
+        # Too long to be searched as is
+        ("first_turn", [{"role": "user", "content": "termination " * 17}], None),
+        # Not in English
+        ("first_turn", [{"role": "user", "content": "Quels sont nos droits de résiliation ?"}], None),
+        ("always", [{"role": "user", "content": "Quels sont nos droits de résiliation ?"}], "always"),
+        (
+            "self_contained",
+            [
+                {"role": "user", "content": "What are the payment terms?"},
+                {"role": "assistant", "content": "Invoices are payable within 30 days."},
+                {"role": "user", "content": "Who owns the intellectual property?"},
+            ],
+            "self_contained",
+        ),
+        (
+            "first_turn",
+            [
+                {"role": "user", "content": "What are the payment terms?"},
+                {"role": "assistant", "content": "Invoices are payable within 30 days."},
+                {"role": "user", "content": "Who owns the intellectual property?"},
+            ],
+            None,
+        ),
+        (
+            "self_contained",
+            [
+                {"role": "user", "content": "What are the payment terms?"},
+                {"role": "assistant", "content": "Invoices are payable within 30 days."},
+                {"role": "user", "content": "Can they be extended?"},
+            ],
+            None,
+        ),
+        (
+            "self_contained",
+            [
+                {"role": "user", "content": "What are the payment terms?"},
+                {"role": "assistant", "content": "Invoices are payable within 30 days."},
+                {"role": "user", "content": "And late payments?"},
+            ],
+            None,
+        ),
+    ],
+)
+def test_get_query_rewrite_skip_reason(chat_approach, policy, history, reason):
+    assert chat_approach.get_query_rewrite_skip_reason(policy, history, 16) == reason
+
+
+@pytest.mark.asyncio
+async def test_skip_query_rewrite(speculative_approach):
+    history = [{"role": "user", "content": "Are interest rates high?"}]
+    overrides = {"retrieval_mode": "text", "speculative_retrieval": False, "skip_query_rewrite": "first_turn"}
+
+    # The search query is generated for the follow-up, and the time it took is reported
+    extra_info, chat_coroutine = await speculative_approach.run_until_final_call(
+        [*history, {"role": "assistant", "content": "Yes."}, *history], overrides, {}, True
+    )
+    await chat_coroutine
+    assert speculative_approach.search_texts == ["interest rates"]
+    props = extra_info["thoughts"][1].props
+    assert props["query_rewrite"] == "generated"
+    assert props["query_rewrite_seconds"] >= 0.01
+
+    # The first turn is searched as is, saving about that time
+    extra_info, chat_coroutine = await speculative_approach.run_until_final_call(history, overrides, {}, True)
+    await chat_coroutine
+    assert speculative_approach.search_texts == ["interest rates", "Are interest rates high?"]
+    props = extra_info["thoughts"][1].props
+    assert props["query_rewrite"] == "skipped (first_turn)"
+    assert props["query_rewrite_seconds_saved"] == round(speculative_approach.query_rewrite_seconds, 3)
+    assert "speculative_retrieval" not in props
+
+
+def make_source_documents(contents: list[str], tokens: list = None) -> list[Document]:
+    return [
+        Document(
+            id=str(i),
+            content=content,
+            embedding=None,
+            image_embedding=None,
+            category=None,
+            sourcepage=f"report.pdf#page={i + 1}",
+            sourcefile="report.pdf",
+            oids=None,
+            groups=None,
+            captions=[],
+            tokens=tokens[i] if tokens else None,
+        )
+        for i, content in enumerate(contents)
+    ]
+
+
+def test_pack_sources_content(chat_approach):
+    encoding = get_encoding("gpt-35-turbo")
+    results = make_source_documents(
+        [
+            "Interest rates rose in 2023. Inflation slowed down.",
+            "The dollar was strong. Oil prices fell. Stocks recovered.",
+            "Bitcoin doubled.",
+        ]
+    )
+    sources = chat_approach.get_sources_content(results, False, False)
+    sources_tokens = [num_tokens_from_text(source, encoding) for source in sources]
+
+    # All the sources fit
+    packed, props = chat_approach.pack_sources_content(results, False, False, sum(sources_tokens), "gpt-35-turbo")
+    assert packed == sources
+    assert props == {"packed_tokens": sum(sources_tokens), "dropped_tokens": 0, "overlap_tokens_saved": 0}
+
+    # The second source is cut after its last sentence that fits, and the third one is dropped
+    trimmed = "report.pdf#page=2: The dollar was strong. Oil prices fell."
+    trimmed_tokens = num_tokens_from_text(trimmed, encoding)
+    packed, props = chat_approach.pack_sources_content(
+        results, False, False, sources_tokens[0] + trimmed_tokens + 1, "gpt-35-turbo"
+    )
+    assert packed == [sources[0], trimmed]
+    assert props == {
+        "packed_tokens": sources_tokens[0] + trimmed_tokens,
+        "dropped_tokens": sources_tokens[1] - trimmed_tokens + sources_tokens[2],
+        "overlap_tokens_saved": 0,
+    }
+
+    # A source that would be cut within its first sentence is dropped
+    packed, props = chat_approach.pack_sources_content(results, False, False, sources_tokens[0] + 5, "gpt-35-turbo")
+    assert packed == [sources[0]]
+    assert props == {
+        "packed_tokens": sources_tokens[0],
+        "dropped_tokens": sum(sources_tokens[1:]),
+        "overlap_tokens_saved": 0,
+    }
+
+
+def test_pack_sources_content_stored_tokens(chat_approach):
+    encoding = get_encoding("gpt-35-turbo")
+    # The token counts stored at ingestion are trusted instead of counting the content again
+    results = make_source_documents(["Interest rates rose in 2023.", "Bitcoin doubled."], tokens=[1, 1000])
+    sources = chat_approach.get_sources_content(results, False, False)
+    citation_tokens = [num_tokens_from_text(f"report.pdf#page={page}: ", encoding) for page in (1, 2)]
+    packed, props = chat_approach.pack_sources_content(results, False, False, citation_tokens[0] + 6, "gpt-35-turbo")
+    assert packed == [sources[0]]
+    assert props == {
+        "packed_tokens": citation_tokens[0] + 1,
+        "dropped_tokens": citation_tokens[1] + 1000,
+        "overlap_tokens_saved": 0,
+    }
+
+
+def test_merge_overlapping_results(chat_approach):
+    text = (
+        "Interest rates rose in 2023. Inflation slowed down. The dollar was strong. Oil prices fell. Stocks recovered."
+    )
+    first, second, other, third = make_source_documents([text[:60], text[30:90], "Bitcoin doubled.", text[70:]])
+    first = replace(first, sourcepage="report.pdf#page=1", tokens=12)
+    second = replace(second, sourcepage="report.pdf#page=1")
+    other = replace(other, sourcefile="other.pdf", sourcepage="other.pdf#page=1")
+    third = replace(third, sourcepage="report.pdf#page=2")
+
+    # The sections of the first page, retrieved in reverse order, are stitched at the rank of the second one, and the
+    # overlap is trimmed from the section of the next page
+    merged = chat_approach.merge_overlapping_results([second, other, first, third])
+    assert [result.content for result in merged] == [text[:90], "Bitcoin doubled.", text[90:]]
+    assert [result.sourcepage for result in merged] == ["report.pdf#page=1", "other.pdf#page=1", "report.pdf#page=2"]
+    assert merged[0].id == second.id
+    assert merged[0].tokens is None
+    assert merged[1] is other
+
+    # Sections of other files and sections that don't overlap are left as they are
+    results = [first, replace(second, sourcefile="other.pdf"), replace(third, content=text[100:])]
+    assert chat_approach.merge_overlapping_results(results) == results
+
+
+def test_pack_sources_content_merged(chat_approach):
+    encoding = get_encoding("gpt-35-turbo")
+    text = (
+        "Interest rates rose in 2023. Inflation slowed down. The dollar was strong. Oil prices fell. Stocks recovered."
+    )
+    results = [
+        replace(result, sourcepage="report.pdf#page=1") for result in make_source_documents([text[:60], text[30:]])
+    ]
+    sources = chat_approach.get_sources_content(results, False, False)
+    packed, props = chat_approach.pack_sources_content(results, False, False, 1000, "gpt-35-turbo")
+    assert packed == [f"report.pdf#page=1: {text}"]
+    assert props == {
+        "packed_tokens": num_tokens_from_text(packed[0], encoding),
+        "dropped_tokens": 0,
+        "overlap_tokens_saved": sum(num_tokens_from_text(source, encoding) for source in sources)
+        - num_tokens_from_text(packed[0], encoding),
+    }
+    assert props["overlap_tokens_saved"] > 0
+
+    # Semantic captions are excerpts of the sections, they are not merged
+    packed, props = chat_approach.pack_sources_content(results, True, False, 1000, "gpt-35-turbo")
+    assert len(packed) == 2
+    assert props["overlap_tokens_saved"] == 0
+
+
+def test_pack_sources_content_compact_tables(chat_approach):
+    table = "<table><tr><th>Year</th><th>Rate</th></tr><tr><td>2023</td><td>5.5%</td></tr></table>"
+    results = make_source_documents([f"Interest rates:\n{table}"], tokens=[100])
+    packed, _ = chat_approach.pack_sources_content(results, False, False, 1000, "gpt-35-turbo")
+    assert packed == [f"report.pdf#page=1: Interest rates: {table}"]
+    packed, props = chat_approach.pack_sources_content(results, False, False, 1000, "gpt-35-turbo", "compact")
+    assert packed == ["report.pdf#page=1: Interest rates: Year | Rate || 2023 | 5.5%"]
+    # The token count stored for the HTML doesn't apply to the compact rendering
+    assert props["packed_tokens"] == num_tokens_from_text(packed[0], get_encoding("gpt-35-turbo"))
+
+
+def test_get_table_format(chat_approach):
+    assert chat_approach.get_table_format({}, "Answer in HTML tables.") == "html"
+    assert chat_approach.get_table_format({"table_format": "compact"}, "Answer in HTML tables.") == "compact"
+    # The default prompts ask for HTML tables, which "auto" keeps the sources in
+    assert chat_approach.get_table_format({"table_format": "auto"}, chat_approach.system_message_chat_conversation) == (
+        "html"
+    )
+    assert chat_approach.get_table_format({"table_format": "auto"}, "Be brief.") == "compact"
@@ -1,14 +1,19 @@
+import asyncio
 import json
 
+import aiohttp
 import pytest
 from azure.search.documents.indexes.models import SearchField, SearchIndex
 from azure.search.documents.models import (
     RawVectorQuery,
 )
+from openai.types import CreateEmbeddingResponse, Embedding
 from openai.types.chat import ChatCompletion
+from openai.types.create_embedding_response import Usage
 
 from approaches.chatreadretrievereadvision import ChatReadRetrieveReadVisionApproach
 from core.authentication import AuthenticationHelper
+from core.embeddingcache import EmbeddingCache
 
 
 class MockOpenAIClient:
@@ -66,6 +71,11 @@ def test_build_filter(chat_approach):
     assert result == "category ne 'test_category'"
 
 
+def test_build_filter_sourcefiles(chat_approach):
+    result = chat_approach.build_filter({"include_sourcefiles": ["contract.pdf", "O'Brien.pdf"]}, {})
+    assert result == "search.in(sourcefile, 'contract.pdf|O''Brien.pdf', '|')"
+
+
 def test_get_search_query(chat_approach):
     payload = '{"id":"chatcmpl-81JkxYqYppUkPtOAia40gki2vJ9QM","object":"chat.completion","created":1695324963,"model":"gpt-4v","prompt_filter_results":[{"prompt_index":0,"content_filter_results":{"hate":{"filtered":false,"severity":"safe"},"self_harm":{"filtered":false,"severity":"safe"},"sexual":{"filtered":false,"severity":"safe"},"violence":{"filtered":false,"severity":"safe"}}}],"choices":[{"index":0,"finish_reason":"function_call","message":{"content":"this is the query","role":"assistant","function_call":{"name":"search_sources","arguments":"{\\n\\"search_query\\":\\"accesstelemedicineservices\\"\\n}"}},"content_filter_results":{}}],"usage":{"completion_tokens":19,"prompt_tokens":425,"total_tokens":444}}'
     default_query = "hello"
@@ -85,3 +95,75 @@ async def test_compute_text_embedding(chat_approach, openai_client, mock_openai_
     assert result.vector == [0.0023064255, -0.009327292, -0.0028842222]
     assert result.k == 50
     assert result.fields == "embedding"
+
+
+@pytest.mark.asyncio
+async def test_compute_text_embedding_cached(chat_approach, openai_client, monkeypatch):
+    calls = []
+
+    async def mock_create(*args, **kwargs):
+        calls.append(kwargs)
+        return CreateEmbeddingResponse(
+            object="list",
+            data=[Embedding(embedding=[0.5, -0.25, 0.125], index=0, object="embedding")],
+            model="text-embedding-ada-002",
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+    monkeypatch.setattr(openai_client, "create", mock_create)
+    chat_approach.embedding_cache = EmbeddingCache(max_entries=10, ttl=None)
+
+    result = await chat_approach.compute_text_embedding("test query")
+    assert result.vector == [0.5, -0.25, 0.125]
+    result = await chat_approach.compute_text_embedding("test  query ")
+    assert result.vector == [0.5, -0.25, 0.125]
+    assert len(calls) == 1
+    assert calls[0]["model"] == "embeddings"
+    assert chat_approach.embedding_cache.get_stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_compute_image_embedding_cached(chat_approach, mock_compute_embeddings_call):
+    chat_approach.embedding_cache = EmbeddingCache(max_entries=10, ttl=None)
+
+    result = await chat_approach.compute_image_embedding("test query", "https://testvision/", "key")
+    assert result.fields == "imageEmbedding"
+    # The text embedding of the same query is a different entry
+    assert chat_approach.embedding_cache.get("embeddings", "test query") is None
+    cached = await chat_approach.compute_image_embedding("test query", "https://testvision/", "key")
+    assert cached.vector == pytest.approx(result.vector)
+    assert chat_approach.embedding_cache.get_stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_compute_image_embedding_pooled_session(chat_approach, mock_compute_embeddings_call):
+    async with aiohttp.ClientSession() as session:
+        chat_approach.vision_session = session
+        result = await chat_approach.compute_image_embedding("test query", "https://testvision/", "key")
+        assert result.fields == "imageEmbedding"
+        # The session is owned by the app, which closes it on shutdown
+        assert not session.closed
+
+
+@pytest.mark.asyncio
+async def test_compute_query_vectors_concurrently(chat_approach, monkeypatch):
+    running = []
+
+    async def compute_embedding(field: str):
+        running.append(field)
+        await asyncio.sleep(0.01)
+        # Both vectors are requested before either of them is done
+        assert len(running) == 2
+        return RawVectorQuery(vector=[0.5], k=50, fields=field)
+
+    monkeypatch.setattr(chat_approach, "compute_text_embedding", lambda q: compute_embedding("embedding"))
+    monkeypatch.setattr(
+        chat_approach, "compute_image_embedding", lambda q, endpoint, key: compute_embedding("imageEmbedding")
+    )
+
+    vectors, seconds = await chat_approach.compute_query_vectors(
+        "test query", ["imageEmbedding", "embedding"], "https://testvision/", "key"
+    )
+    assert [vector.fields for vector in vectors] == ["imageEmbedding", "embedding"]
+    assert list(seconds) == ["imageEmbedding", "embedding"]
+    assert all(field_seconds > 0 for field_seconds in seconds.values())
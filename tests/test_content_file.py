@@ -1,8 +1,8 @@
 import os
+import re
 
 import aiohttp
 import pytest
-from azure.core.exceptions import ResourceNotFoundError
 from azure.core.pipeline.transport import (
     AioHttpTransportResponse,
     AsyncHttpTransport,
@@ -11,69 +11,98 @@ from azure.core.pipeline.transport import (
 from azure.storage.blob.aio import BlobServiceClient
 
 import app
+from core.contentcache import ContentCache
 
 from .mocks import MockAzureCredential
 
+BLOB_CONTENT = b"test content"
+BLOB_ETAG = '"0x8DBF2C5A1B3C4D5"'
+BLOB_LAST_MODIFIED = "Wed, 06 Dec 2023 10:00:00 GMT"
 
-@pytest.mark.asyncio
-async def test_content_file(monkeypatch, mock_env, mock_acs_search):
-    class MockAiohttpClientResponse404(aiohttp.ClientResponse):
-        def __init__(self, url, body_bytes, headers=None):
-            self._body = body_bytes
-            self._headers = headers
-            self._cache = {}
-            self.status = 404
-            self.reason = "Not Found"
-            self._url = url
-
-    class MockAiohttpClientResponse(aiohttp.ClientResponse):
-        def __init__(self, url, body_bytes, headers=None):
-            self._body = body_bytes
-            self._headers = headers
-            self._cache = {}
-            self.status = 200
-            self.reason = "OK"
-            self._url = url
-
-    class MockTransport(AsyncHttpTransport):
-        async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
-            if request.url.endswith("notfound.pdf"):
-                raise ResourceNotFoundError(MockAiohttpClientResponse404(request.url, b""))
-            else:
-                return AioHttpTransportResponse(
-                    request,
-                    MockAiohttpClientResponse(
-                        request.url,
-                        b"test content",
-                        {
-                            "Content-Type": "application/octet-stream",
-                            "Content-Range": "bytes 0-27/28",
-                            "Content-Length": "28",
-                        },
-                    ),
-                )
-
-        async def __aenter__(self):
-            return self
-
-        async def __aexit__(self, *args):
-            pass
-
-        async def open(self):
-            pass
-
-        async def close(self):
-            pass
 
+class MockAiohttpClientResponse(aiohttp.ClientResponse):
+    def __init__(self, url, body_bytes, status, reason, headers=None):
+        self._body = body_bytes
+        self._headers = headers
+        self._cache = {}
+        self.status = status
+        self.reason = reason
+        self._url = url
+
+
+class MockTransport(AsyncHttpTransport):
+    def __init__(self):
+        self.requests = []
+        self.etag = BLOB_ETAG
+        # ETags the blob is overwritten with right after each HEAD request, to simulate concurrent uploads
+        self.overwrites: list[str] = []
+
+    async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
+        self.requests.append(request)
+        if request.url.endswith("notfound.pdf"):
+            return AioHttpTransportResponse(
+                request,
+                MockAiohttpClientResponse(request.url, b"", 404, "Not Found", {"x-ms-error-code": "BlobNotFound"}),
+            )
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "ETag": self.etag,
+            "Last-Modified": BLOB_LAST_MODIFIED,
+            "x-ms-blob-type": "BlockBlob",
+        }
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(BLOB_CONTENT))
+            if self.overwrites:
+                self.etag = self.overwrites.pop(0)
+            return AioHttpTransportResponse(request, MockAiohttpClientResponse(request.url, b"", 200, "OK", headers))
+        if request.headers.get("If-Match", self.etag) != self.etag:
+            return AioHttpTransportResponse(
+                request,
+                MockAiohttpClientResponse(
+                    request.url, b"", 412, "Precondition Failed", {"x-ms-error-code": "ConditionNotMet"}
+                ),
+            )
+        start, end = 0, len(BLOB_CONTENT) - 1
+        if match := re.match(r"bytes=(\d+)-(\d*)", request.headers.get("x-ms-range", "")):
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+        body = BLOB_CONTENT[start : end + 1]
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(BLOB_CONTENT)}"
+        headers["Content-Length"] = str(len(body))
+        return AioHttpTransportResponse(request, MockAiohttpClientResponse(request.url, body, 206, "Partial", headers))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture
+def mock_transport():
+    return MockTransport()
+
+
+@pytest.fixture
+def blob_container_client(mock_transport):
     # Then we can plug this into any SDK via kwargs:
     blob_client = BlobServiceClient(
         f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
         credential=MockAzureCredential(),
-        transport=MockTransport(),
+        transport=mock_transport,
         retry_total=0,  # Necessary to avoid unnecessary network requests during tests
     )
-    blob_container_client = blob_client.get_container_client(os.environ["AZURE_STORAGE_CONTAINER"])
+    return blob_client.get_container_client(os.environ["AZURE_STORAGE_CONTAINER"])
+
 
+@pytest.mark.asyncio
+async def test_content_file(monkeypatch, mock_env, mock_acs_search, blob_container_client):
     quart_app = app.create_app()
     async with quart_app.test_app() as test_app:
         quart_app.config.update({"blob_container_client": blob_container_client})
@@ -85,9 +114,172 @@ async def test_content_file(monkeypatch, mock_env, mock_acs_search):
         response = await client.get("/content/role_library.pdf")
         assert response.status_code == 200
         assert response.headers["Content-Type"] == "application/pdf"
+        assert response.headers["Accept-Ranges"] == "bytes"
+        assert response.headers["ETag"] == BLOB_ETAG
+        assert response.headers["Last-Modified"] == BLOB_LAST_MODIFIED
         assert await response.get_data() == b"test content"
 
         response = await client.get("/content/role_library.pdf#page=10")
         assert response.status_code == 200
         assert response.headers["Content-Type"] == "application/pdf"
         assert await response.get_data() == b"test content"
+
+
+@pytest.mark.asyncio
+async def test_content_file_range(monkeypatch, mock_env, mock_acs_search, blob_container_client, mock_transport):
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        # Without the content cache, ranges are downloaded from storage
+        quart_app.config.update({"blob_container_client": blob_container_client, "content_cache": None})
+
+        client = test_app.test_client()
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=5-11"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == "bytes 5-11/12"
+        assert response.headers["Content-Length"] == "7"
+        assert await response.get_data() == b"content"
+        assert mock_transport.requests[-1].headers["x-ms-range"] == "bytes=5-11"
+
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=-4"})
+        assert response.status_code == 206
+        assert await response.get_data() == b"tent"
+
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=100-200"})
+        assert response.status_code == 416
+        assert response.headers["Content-Range"] == "bytes */12"
+
+        # A stale If-Range validator means the whole file is sent
+        response = await client.get(
+            "/content/role_library.pdf", headers={"Range": "bytes=5-11", "If-Range": '"some-other-etag"'}
+        )
+        assert response.status_code == 200
+        assert await response.get_data() == b"test content"
+
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=5-11", "If-Range": BLOB_ETAG})
+        assert response.status_code == 206
+
+
+@pytest.mark.asyncio
+async def test_content_file_conditional(monkeypatch, mock_env, mock_acs_search, blob_container_client, mock_transport):
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        quart_app.config.update({"blob_container_client": blob_container_client})
+
+        client = test_app.test_client()
+        response = await client.get("/content/role_library.pdf", headers={"If-None-Match": BLOB_ETAG})
+        assert response.status_code == 304
+        assert await response.get_data() == b""
+        # Only the properties were fetched, the blob itself was not downloaded
+        assert mock_transport.requests[-1].method == "HEAD"
+
+        response = await client.get("/content/role_library.pdf", headers={"If-Modified-Since": BLOB_LAST_MODIFIED})
+        assert response.status_code == 304
+
+        response = await client.get("/content/role_library.pdf", headers={"If-None-Match": '"some-other-etag"'})
+        assert response.status_code == 200
+        assert await response.get_data() == b"test content"
+
+        response = await client.get(
+            "/content/role_library.pdf", headers={"If-Modified-Since": "Tue, 05 Dec 2023 10:00:00 GMT"}
+        )
+        assert response.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_content_file_cached(monkeypatch, mock_env, mock_acs_search, blob_container_client, mock_transport):
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        quart_app.config.update({"blob_container_client": blob_container_client})
+
+        client = test_app.test_client()
+        response = await client.get("/content/role_library.pdf")
+        assert await response.get_data() == b"test content"
+        assert [request.method for request in mock_transport.requests] == ["HEAD", "GET"]
+
+        # A hit only revalidates the ETag, and ranges are served from the cached bytes
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=5-11"})
+        assert response.status_code == 206
+        assert await response.get_data() == b"content"
+        assert [request.method for request in mock_transport.requests] == ["HEAD", "GET", "HEAD"]
+
+        response = await client.get("/cache_stats")
+        stats = (await response.get_json())["content"]
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["memory"]["entries"] == 1
+        assert stats["memory"]["bytes"] == len(BLOB_CONTENT)
+        assert stats["disk"] is None
+
+        # A new version of the blob is downloaded again and replaces the old entry
+        mock_transport.etag = '"0x8DBF2C5A1B3C4D6"'
+        response = await client.get("/content/role_library.pdf")
+        assert await response.get_data() == b"test content"
+        assert [request.method for request in mock_transport.requests][-2:] == ["HEAD", "GET"]
+        stats = quart_app.config["content_cache"].get_stats()
+        assert stats["misses"] == 2
+        assert stats["memory"]["entries"] == 1
+
+
+@pytest.mark.asyncio
+async def test_content_cache_disk(mock_env, blob_container_client, mock_transport, tmp_path):
+    content_cache = ContentCache(
+        max_memory_bytes=0, max_memory_entry_bytes=0, disk_dir=str(tmp_path), max_disk_bytes=1024
+    )
+    blob_client = blob_container_client.get_blob_client("role_library.pdf")
+
+    # The first request schedules the file to be written to disk and lets the caller stream from storage
+    assert await content_cache.get(blob_client, "role_library.pdf", BLOB_ETAG, len(BLOB_CONTENT)) is None
+    await next(iter(content_cache.disk_fills.values()))
+    assert content_cache.get_stats()["disk"]["bytes"] == len(BLOB_CONTENT)
+
+    cached = await content_cache.get(blob_client, "role_library.pdf", BLOB_ETAG, len(BLOB_CONTENT))
+    assert cached is not None
+    assert b"".join([chunk async for chunk in cached.iter_bytes(5, 12)]) == b"content"
+    cached = await content_cache.get(blob_client, "role_library.pdf", BLOB_ETAG, len(BLOB_CONTENT))
+    assert cached is not None
+    assert b"".join([chunk async for chunk in cached.iter_bytes(0, 12)]) == BLOB_CONTENT
+
+    # A file evicted after the lookup is still readable by the response that looked it up
+    cached = await content_cache.get(blob_client, "role_library.pdf", BLOB_ETAG, len(BLOB_CONTENT))
+    assert cached is not None
+    for file_name in os.listdir(content_cache.disk_dir):
+        os.remove(os.path.join(content_cache.disk_dir, file_name))
+    assert b"".join([chunk async for chunk in cached.iter_bytes(0, 12)]) == BLOB_CONTENT
+
+    await content_cache.close()
+    assert not os.path.exists(os.path.join(tmp_path, f"worker-{os.getpid()}"))
+
+
+@pytest.mark.asyncio
+async def test_content_file_overwritten(monkeypatch, mock_env, mock_acs_search, blob_container_client, mock_transport):
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        quart_app.config.update({"blob_container_client": blob_container_client, "content_cache": None})
+
+        client = test_app.test_client()
+        # The blob changes between the HEAD and the GET, so the new version is served on the second attempt
+        mock_transport.overwrites = ['"0x8DBF2C5A1B3C4D6"']
+        response = await client.get("/content/role_library.pdf")
+        assert response.status_code == 200
+        assert response.headers["ETag"] == '"0x8DBF2C5A1B3C4D6"'
+        assert await response.get_data() == b"test content"
+        assert [request.method for request in mock_transport.requests] == ["HEAD", "GET", "HEAD", "GET"]
+
+        mock_transport.overwrites = ['"0x8DBF2C5A1B3C4D7"', '"0x8DBF2C5A1B3C4D8"']
+        response = await client.get("/content/role_library.pdf")
+        assert response.status_code == 503
+
+
+@pytest.mark.asyncio
+async def test_content_cache_download_error(mock_env, blob_container_client):
+    content_cache = ContentCache(max_memory_bytes=1024, max_memory_entry_bytes=1024)
+    # Errors are left to the caller, which streams the blob from storage instead
+    blob_client = blob_container_client.get_blob_client("notfound.pdf")
+    assert await content_cache.get(blob_client, "notfound.pdf", BLOB_ETAG, len(BLOB_CONTENT)) is None
+    assert content_cache.get_stats()["memory"]["entries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_cache_stats_auth(auth_client):
+    response = await auth_client.get("/cache_stats")
+    assert response.status_code == 404
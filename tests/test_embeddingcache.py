@@ -0,0 +1,34 @@
+from array import array
+
+import pytest
+
+from core.embeddingcache import EmbeddingCache
+
+
+def test_embeddingcache_normalizes_text():
+    cache = EmbeddingCache(max_entries=10, ttl=None)
+    cache.set("text-embedding-ada-002", "What is  included in\nmy plan?", [0.5, -0.25])
+    assert cache.get("text-embedding-ada-002", " What is included in my plan? ") == [0.5, -0.25]
+    # Entries are scoped to the model that computed them
+    assert cache.get("other-deployment", "What is included in my plan?") is None
+    assert cache.get_stats()["hits"] == 1
+    assert cache.get_stats()["misses"] == 1
+
+
+def test_embeddingcache_stores_float32():
+    cache = EmbeddingCache(max_entries=10, ttl=None)
+    cache.set("ada", "query", [0.0023064255, -0.009327292])
+    key = ("ada", "query")
+    assert isinstance(cache.cache.get(key), array)
+    assert cache.get_stats()["bytes"] == 8
+    assert cache.get("ada", "query") == pytest.approx([0.0023064255, -0.009327292])
+
+
+def test_embeddingcache_ttl(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("core.lrucache.time.monotonic", lambda: now)
+    cache = EmbeddingCache(max_entries=10, ttl=60)
+    cache.set("ada", "query", [1.0])
+    now += 61
+    assert cache.get("ada", "query") is None
+    assert cache.get_stats()["expirations"] == 1
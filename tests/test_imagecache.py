@@ -0,0 +1,108 @@
+import asyncio
+import base64
+
+import pytest
+from azure.core.exceptions import ResourceNotModifiedError
+from azure.storage.blob import BlobProperties
+
+from approaches.approach import Document
+from core.imagecache import ImageCache
+from core.imageshelper import fetch_images
+
+
+class FakeBlob:
+    def __init__(self, name: str, data: bytes, etag: str):
+        self.properties = BlobProperties(name=name, ETag=etag)
+        self.data = data
+
+    async def readall(self):
+        return self.data
+
+
+class FakeContainerClient:
+    """Serves page images whose content is their name, counting the downloads that returned bytes"""
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.etags: dict[str, str] = {}
+        self.downloads: list[str] = []
+        self.running = 0
+        self.max_running = 0
+
+    def get_blob_client(self, name: str):
+        container = self
+
+        class FakeBlobClient:
+            async def download_blob(self, etag=None, match_condition=None):
+                container.running += 1
+                container.max_running = max(container.max_running, container.running)
+                await asyncio.sleep(container.latency)
+                container.running -= 1
+                current_etag = container.etags.get(name, '"1"')
+                if etag is not None and etag == current_etag:
+                    raise ResourceNotModifiedError()
+                container.downloads.append(name)
+                return FakeBlob(name, name.encode(), current_etag)
+
+        return FakeBlobClient()
+
+
+def make_documents(count: int) -> list[Document]:
+    return [
+        Document(
+            id=str(i),
+            content="",
+            embedding=None,
+            image_embedding=None,
+            category=None,
+            sourcepage=f"report-{i}.pdf" if i else None,
+            sourcefile="report.pdf",
+            oids=None,
+            groups=None,
+            captions=[],
+        )
+        for i in range(count)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_fetch_images_concurrently():
+    container = FakeContainerClient(latency=0.01)
+    images = await fetch_images(container, make_documents(7), max_concurrency=3)  # type: ignore[arg-type]
+    # The document without a source page has no image, the others keep their order
+    assert [image["url"] for image in images] == [
+        "data:image/png;base64," + base64.b64encode(f"report-{i}.png".encode()).decode() for i in range(1, 7)
+    ]
+    assert container.max_running == 3
+
+
+@pytest.mark.asyncio
+async def test_fetch_images_cached():
+    container = FakeContainerClient()
+    cache = ImageCache(max_bytes=1024 * 1024)
+    documents = make_documents(3)
+    images = await fetch_images(container, documents, cache)  # type: ignore[arg-type]
+    assert len(container.downloads) == 2
+
+    # Unchanged blobs are revalidated without being downloaded again
+    assert await fetch_images(container, documents, cache) == images  # type: ignore[arg-type]
+    assert len(container.downloads) == 2
+
+    # A blob that was overwritten is downloaded again
+    container.etags["report-1.png"] = '"2"'
+    await fetch_images(container, documents, cache)  # type: ignore[arg-type]
+    assert container.downloads[2:] == ["report-1.png"]
+    stats = cache.get_stats()
+    assert stats["hits"] == 4
+    assert stats["misses"] == 2
+    assert stats["stale"] == 1
+    assert cache.get("report-1.png")[0] == '"2"'
+
+
+def test_image_cache_budget():
+    cache = ImageCache(max_bytes=100)
+    cache.set("a.png", '"1"', "data:image/png;base64," + "A" * 50)
+    cache.set("b.png", '"1"', "data:image/png;base64," + "B" * 50)
+    assert cache.get("a.png") is None
+    assert cache.get("b.png") is not None
+    assert cache.get_stats()["evictions"] == 1
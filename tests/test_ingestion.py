@@ -0,0 +1,117 @@
+import asyncio
+import io
+import os
+import sys
+
+import pytest
+from quart.datastructures import FileStorage
+
+import app
+from core.ingestion import IngestionQueue
+
+PREPDOCS_SCRIPT = """
+import sys
+with open(sys.argv[-1], "rb") as f:
+    assert f.read() == b"%PDF-1.4"
+print("Extracting text from 'Benefit Options.pdf' using Azure Document Intelligence")
+print("Splitting 'Benefit Options.pdf' into sections")
+print("\\tUploading blob for whole file -> Benefit_Options.pdf")
+print("Computing embeddings for 3 sections")
+print("Indexing 3 sections into search index 'test-search-index'")
+"""
+
+
+@pytest.fixture
+def ingestion_env(monkeypatch, mock_env, tmp_path):
+    monkeypatch.setenv("INGESTION_JOBS_DIR", str(tmp_path))
+    monkeypatch.setenv("RUBRIC_CACHE_PATH", str(tmp_path / "rubric.db"))
+
+
+@pytest.fixture
+def mock_prepdocs(monkeypatch):
+    def patch(script):
+        monkeypatch.setattr(app, "get_prepdocs_args", lambda: [sys.executable, "-c", script])
+
+    return patch
+
+
+async def wait_for_job(client, job_id):
+    for _ in range(200):
+        response = await client.get(f"/ingest_jobs/{job_id}")
+        assert response.status_code == 200
+        job = await response.get_json()
+        if job["status"] in ("succeeded", "failed"):
+            return job
+        await asyncio.sleep(0.05)
+    raise AssertionError("The ingestion job did not finish")
+
+
+@pytest.mark.asyncio
+async def test_upload_pdf_ingests_in_background(ingestion_env, mock_prepdocs, client, tmp_path):
+    mock_prepdocs(PREPDOCS_SCRIPT)
+    response = await client.post(
+        "/upload_pdf", files={"file": FileStorage(io.BytesIO(b"%PDF-1.4"), filename="Benefit Options.pdf")}
+    )
+    assert response.status_code == 202
+    result = await response.get_json()
+    assert result["status"] == "queued"
+
+    job = await wait_for_job(client, result["job_id"])
+    assert job["status"] == "succeeded", job["error"]
+    assert job["filename"] == "Benefit_Options.pdf"
+    assert [stage["stage"] for stage in job["stages"]] == [
+        "queued",
+        "starting",
+        "parsing",
+        "splitting",
+        "uploading",
+        "embedding",
+        "indexing",
+    ]
+    assert all(stage["seconds"] is not None for stage in job["stages"])
+    # The uploaded file is removed and the answers of the worker reflect the new document
+    assert not os.path.exists(tmp_path / result["job_id"])
+    assert client.app.config[app.CONFIG_SEARCH_CACHE].get_stats()["invalidations"] == 1
+    assert client.app.config[app.CONFIG_RUBRIC_CACHE].get_stats()["new_files"] == 1
+
+
+@pytest.mark.asyncio
+async def test_upload_pdf_failed_job(ingestion_env, mock_prepdocs, client):
+    mock_prepdocs("import sys; print('Error: Azure Document Intelligence service is not provided.'); sys.exit(1)")
+    response = await client.post("/upload_pdf", files={"file": FileStorage(io.BytesIO(b"%PDF-1.4"), filename="a.pdf")})
+    job = await wait_for_job(client, (await response.get_json())["job_id"])
+    assert job["status"] == "failed"
+    assert job["stage"] == "failed"
+    assert "Azure Document Intelligence service is not provided" in job["error"]
+    assert client.app.config[app.CONFIG_SEARCH_CACHE].get_stats()["invalidations"] == 0
+
+
+@pytest.mark.asyncio
+async def test_upload_pdf_errors(ingestion_env, client):
+    response = await client.post("/upload_pdf", files={})
+    assert response.status_code == 400
+    response = await client.get("/ingest_jobs/0123456789abcdef0123456789abcdef")
+    assert response.status_code == 404
+    response = await client.get("/ingest_jobs/not-a-job")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_ingestion_queue_limits(tmp_path):
+    queue = IngestionQueue(jobs_dir=str(tmp_path), max_concurrent_jobs=1, max_queued_jobs=1, timeout=60)
+    job = queue.create_job("a.pdf")
+    queue.submit(job, [sys.executable, "-c", "pass"])
+    other_job = queue.create_job("b.pdf")
+    with pytest.raises(asyncio.QueueFull):
+        queue.submit(other_job, [sys.executable, "-c", "pass"])
+    assert not os.path.exists(other_job.directory)
+
+    # Another worker of the host reads the status from the jobs directory
+    other_worker_queue = IngestionQueue(jobs_dir=str(tmp_path), max_concurrent_jobs=1, max_queued_jobs=1, timeout=60)
+    assert other_worker_queue.get(job.id) == queue.get(job.id)
+    assert queue.get_stats() == {"queued": 1, "running": 0, "succeeded": 0, "failed": 0}
+
+    queue.start()
+    await asyncio.wait_for(queue.queue.join(), 10)
+    await queue.close()
+    assert other_worker_queue.get(job.id)["status"] == "succeeded"
@@ -0,0 +1,57 @@
+from core.lrucache import LRUCache
+
+
+def test_lrucache_max_entries():
+    cache: LRUCache[str, int] = LRUCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    # "b" is now the least recently used entry
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats.evictions == 1
+    assert cache.stats.entries == 2
+
+
+def test_lrucache_max_bytes():
+    evicted = []
+    cache: LRUCache[str, bytes] = LRUCache(max_bytes=10, sizeof=len, on_evict=lambda key, value: evicted.append(key))
+    cache.set("a", b"12345")
+    cache.set("b", b"12345")
+    assert cache.stats.bytes == 10
+    cache.set("c", b"123")
+    assert evicted == ["a"]
+    assert cache.stats.bytes == 8
+    # Values bigger than the whole budget are not stored
+    cache.set("d", b"12345678901")
+    assert "d" not in cache
+    assert cache.stats.bytes == 8
+    # Replacing a value updates the size instead of adding to it
+    cache.set("b", b"1")
+    assert cache.stats.bytes == 4
+    assert cache.pop("b") == b"1"
+    assert cache.stats.bytes == 3
+    assert evicted == ["a"]
+
+
+def test_lrucache_ttl(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("core.lrucache.time.monotonic", lambda: now)
+    cache: LRUCache[str, int] = LRUCache(ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=60)
+    now += 30
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert cache.stats.expirations == 1
+    assert cache.stats.to_dict() == {
+        "hits": 1,
+        "misses": 1,
+        "evictions": 0,
+        "expirations": 1,
+        "entries": 1,
+        "bytes": 0,
+        "hit_rate": 0.5,
+    }
@@ -25,6 +25,23 @@ def test_messagebuilder_append():
     assert builder.count_tokens_for_message(builder.messages[1]) == 9
 
 
+def test_messagebuilder_insert_messages():
+    builder = MessageBuilder("You are a bot.", "gpt-35-turbo")
+    builder.insert_message("user", "What is the capital of Spain?")
+    builder.insert_messages(
+        [
+            {"role": "user", "content": "What is the capital of France?"},
+            {"role": "assistant", "content": "Paris"},
+        ]
+    )
+    assert builder.messages == [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "user", "content": "What is the capital of France?"},
+        {"role": "assistant", "content": "Paris"},
+        {"role": "user", "content": "What is the capital of Spain?"},
+    ]
+
+
 def test_messagebuilder_unicode():
     builder = MessageBuilder("a\u0301", "gpt-35-turbo")
     assert builder.messages == [
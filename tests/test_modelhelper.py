@@ -1,12 +1,27 @@
+import base64
+import struct
+
 import pytest
 
 from core.modelhelper import (
+    fit_images_to_token_limit,
+    get_encoding,
+    get_image_dimensions,
     get_oai_chatmodel_tiktok,
     get_token_limit,
+    num_tokens_from_image,
     num_tokens_from_messages,
+    token_count_cache,
+    trim_text_to_sentence,
 )
 
 
+def png_data_url(width: int, height: int) -> str:
+    # The signature and IHDR chunk of a PNG, which is all that is read of it
+    header = b"\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + b"IHDR" + struct.pack(">II", width, height) + b"\x08\x06"
+    return "data:image/png;base64," + base64.b64encode(header + b"\x00" * 64).decode()
+
+
 def test_get_token_limit():
     assert get_token_limit("gpt-35-turbo") == 4000
     assert get_token_limit("gpt-3.5-turbo") == 4000
@@ -43,6 +58,94 @@ def test_num_tokens_from_messages_gpt4():
     assert num_tokens_from_messages(message, model) == 9
 
 
+def test_num_tokens_from_messages_cached(monkeypatch):
+    encoding = get_encoding("gpt-35-turbo")
+    assert get_encoding("gpt-35-turbo") is encoding
+    encoded = []
+    monkeypatch.setattr(encoding, "encode", lambda text: encoded.append(text) or text.split())
+    token_count_cache.clear()
+    hits = token_count_cache.stats.hits
+
+    message = {"role": "user", "content": "Is the history counted again?"}
+    assert num_tokens_from_messages(message, "gpt-35-turbo") == 8
+    assert num_tokens_from_messages(dict(message), "gpt-35-turbo") == 8
+    assert encoded == ["user", "Is the history counted again?"]
+    assert token_count_cache.stats.hits == hits + 2
+    token_count_cache.clear()
+
+
+@pytest.mark.parametrize(
+    "width, height, detail, expected",
+    [
+        # Scaled to 768x768, 4 tiles
+        (1024, 1024, "high", 765),
+        # Scaled to 1024x2048 then 768x1536, 6 tiles
+        (2048, 4096, "high", 1105),
+        # Already small enough, 1 tile
+        (512, 512, "high", 255),
+        (100, 100, "auto", 255),
+        # Shortest side of 768, 2x2 tiles
+        (768, 1024, "auto", 765),
+        (4096, 8192, "low", 85),
+    ],
+)
+def test_num_tokens_from_image(width, height, detail, expected):
+    assert num_tokens_from_image(width, height, detail) == expected
+
+
+def test_get_image_dimensions():
+    assert get_image_dimensions(png_data_url(1700, 2200)) == (1700, 2200)
+    assert get_image_dimensions("https://example.com/page.png") is None
+    assert get_image_dimensions("data:image/png;base64," + base64.b64encode(b"GIF89a" + b"\x00" * 32).decode()) is None
+
+
+def test_num_tokens_from_messages_images():
+    image = {"type": "image_url", "image_url": {"url": png_data_url(1024, 1024), "detail": "auto"}}
+    low_image = {"type": "image_url", "image_url": {"url": png_data_url(1024, 1024), "detail": "low"}}
+    text = {"type": "text", "text": "Hello, how are you?"}
+    text_tokens = num_tokens_from_messages({"role": "user", "content": [text]}, "gpt-4v")
+    assert text_tokens == num_tokens_from_messages({"role": "user", "content": "Hello, how are you?"}, "gpt-4v")
+    assert num_tokens_from_messages({"role": "user", "content": [text, image, low_image]}, "gpt-4v") == (
+        text_tokens + 765 + 85
+    )
+    # An image that isn't a PNG data URL is costed as the largest high detail image, 2x4 tiles
+    url_image = {"type": "image_url", "image_url": {"url": "https://example.com/page.png"}}
+    empty_tokens = num_tokens_from_messages({"role": "user", "content": []}, "gpt-4v")
+    assert num_tokens_from_messages({"role": "user", "content": [url_image]}, "gpt-4v") == empty_tokens + 1445
+
+
+def test_fit_images_to_token_limit():
+    text = {"type": "text", "text": "Hello, how are you?"}
+    images = [{"type": "image_url", "image_url": {"url": png_data_url(1024, 1024), "detail": "auto"}} for _ in range(3)]
+    content = [text, *images]
+    # 765 tokens for each image
+    text_tokens = num_tokens_from_messages({"role": "user", "content": [text]}, "gpt-4v")
+    assert fit_images_to_token_limit(content, text_tokens + 3 * 765, "gpt-4v") == content
+
+    # The last image is downgraded to low detail first
+    fitted = fit_images_to_token_limit(content, text_tokens + 2 * 765 + 85, "gpt-4v")
+    assert [part["image_url"]["detail"] for part in fitted[1:]] == ["auto", "auto", "low"]
+    assert images[2]["image_url"]["detail"] == "auto"
+
+    # Then the images are dropped, once they are all low detail
+    fitted = fit_images_to_token_limit(content, text_tokens + 85, "gpt-4v")
+    assert fitted == [text, {"type": "image_url", "image_url": {"url": images[0]["image_url"]["url"], "detail": "low"}}]
+    assert fit_images_to_token_limit(content, 5, "gpt-4v") == [text]
+
+
+def test_trim_text_to_sentence():
+    encoding = get_encoding("gpt-35-turbo")
+    text = "Rates rose in 2023. Inflation slowed to 3.5% by December! Was it enough? Nobody knows"
+    assert (
+        trim_text_to_sentence(text, len(encoding.encode(text)), encoding)
+        == "Rates rose in 2023. Inflation slowed to 3.5% by December! Was it enough?"
+    )
+    second_sentence = "Rates rose in 2023. Inflation slowed to 3.5% by December!"
+    assert trim_text_to_sentence(text, len(encoding.encode(second_sentence)) + 1, encoding) == second_sentence
+    assert trim_text_to_sentence(text, 3, encoding) == ""
+    assert trim_text_to_sentence(text, 0, encoding) == ""
+
+
 def test_get_oai_chatmodel_tiktok_mapped():
     assert get_oai_chatmodel_tiktok("gpt-35-turbo") == "gpt-3.5-turbo"
     assert get_oai_chatmodel_tiktok("gpt-35-turbo-16k") == "gpt-3.5-turbo-16k"
@@ -0,0 +1,390 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from azure.search.documents.models import RawVectorQuery
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+
+from approaches.RubricEvaluationApproach import RubricEvaluationApproach
+from core.authentication import AuthenticationHelper
+from core.rubriccache import RubricCache, SQLiteRubricCacheStore
+
+
+@pytest.fixture
+def rubric_approach(monkeypatch):
+    approach = RubricEvaluationApproach(
+        search_client=None,
+        auth_helper=None,
+        openai_client=None,
+        chatgpt_deployment="chat",
+        chatgpt_model="gpt-35-turbo",
+        embedding_deployment="embeddings",
+        embedding_model="text-embedding-ada-002",
+        sourcepage_field="sourcepage",
+        content_field="content",
+        query_language="en-us",
+        query_speller="lexicon",
+        max_concurrent_criteria=3,
+    )
+    running = {"now": 0, "max": 0}
+    embeddings: list[list[str]] = []
+    searches: list[tuple] = []
+
+    async def mock_generate_search_query(criterion, messages, context):
+        running["now"] += 1
+        running["max"] = max(running["max"], running["now"])
+        # Later criteria finish first
+        await asyncio.sleep(0.01 * (5 - int(criterion[-1])))
+        running["now"] -= 1
+        if criterion == "criterion 2":
+            raise ValueError("The search query could not be generated")
+        return QUERIES.get(criterion, f"query for {criterion}")
+
+    async def mock_compute_text_embeddings(qs):
+        embeddings.append(qs)
+        # Unrelated queries get orthogonal embeddings
+        return [
+            RawVectorQuery(
+                vector=QUERY_EMBEDDINGS.get(q, [0.0] * 3 + [float(i == j) for j in range(5)]), k=50, fields="embedding"
+            )
+            for i, q in enumerate(qs)
+        ]
+
+    async def mock_retrieve_documents(search_query, context, vector=None):
+        searches.append((search_query, vector))
+        return [f"doc.pdf: {search_query}"]
+
+    async def mock_generate_answer(criterion, search_results, messages, context, usage=None):
+        return f"answer to {criterion}"
+
+    monkeypatch.setattr(approach, "generate_search_query", mock_generate_search_query)
+    monkeypatch.setattr(approach, "compute_text_embeddings", mock_compute_text_embeddings)
+    monkeypatch.setattr(approach, "retrieve_documents", mock_retrieve_documents)
+    monkeypatch.setattr(approach, "generate_answer", mock_generate_answer)
+    approach.running = running  # type: ignore[attr-defined]
+    approach.embeddings = embeddings  # type: ignore[attr-defined]
+    approach.searches = searches  # type: ignore[attr-defined]
+    return approach
+
+
+CRITERIA = ["criterion 0", "criterion 1", "criterion 2", "criterion 3", "criterion 4"]
+
+# Overlapping criteria of a contract rubric
+QUERIES = {
+    "liability 1": "Liability cap",
+    "liability 2": "liability cap?",
+    "liability 3": "limit of liability",
+    "termination 4": "termination notice",
+}
+QUERY_EMBEDDINGS = {
+    "Liability cap": [1.0, 0.0, 0.0] + [0.0] * 5,
+    "limit of liability": [0.99, 0.1, 0.0] + [0.0] * 5,
+    "termination notice": [0.0, 0.0, 1.0] + [0.0] * 5,
+}
+
+
+@pytest.mark.asyncio
+async def test_rubric_run_concurrent(rubric_approach):
+    result = await rubric_approach.run(CRITERIA, [])
+    assert result["rubric_answers"] == [
+        "answer to criterion 0",
+        "answer to criterion 1",
+        None,
+        "answer to criterion 3",
+        "answer to criterion 4",
+    ]
+    assert result["errors"] == [{"index": 2, "criterion": "criterion 2", "error": "ValueError"}]
+    assert result["retrieval"] == {
+        "queries": 4,
+        "unique_queries": 4,
+        "embedding_calls": 1,
+        "embedding_calls_saved": 3,
+        "search_calls": 4,
+        "search_calls_saved": 0,
+    }
+    assert rubric_approach.running["max"] == 3
+
+
+@pytest.mark.asyncio
+async def test_rubric_run_streams_events(rubric_approach):
+    events = await rubric_approach.run(CRITERIA, [], stream=True, context={"overrides": {"max_concurrent_criteria": 1}})
+    events = [event async for event in events]
+    # The failed criterion comes first, then the retrieval statistics and, one criterion at a time, the answers in order
+    assert events[0]["index"] == 2
+    assert events[1]["retrieval"]["search_calls"] == 4
+    assert [event["index"] for event in events[2:-1]] == [0, 1, 3, 4]
+    assert events[-1]["usage"]["completions"] == 0
+    assert rubric_approach.running["max"] == 1
+
+    # A request can't go beyond the limit of the app
+    rubric_approach.running["max"] = 0
+    events = await rubric_approach.run(
+        CRITERIA, [], stream=True, context={"overrides": {"max_concurrent_criteria": 10}}
+    )
+    indexes = [event["index"] async for event in events if "index" in event]
+    # The failed criterion had the shortest delay among the first three
+    assert indexes[0] == 2
+    assert sorted(indexes) == [0, 1, 2, 3, 4]
+    assert rubric_approach.running["max"] == 3
+
+
+@pytest.mark.asyncio
+async def test_rubric_retrieval_shared_across_criteria(rubric_approach):
+    criteria = ["liability 1", "liability 2", "liability 3", "termination 4", "liability 1"]
+    result = await rubric_approach.run(criteria, [])
+    assert result["errors"] == []
+    # Same query after normalization, or close enough embeddings, so the liability criteria share a single search
+    assert result["rubric_answers"] == [f"answer to {criterion}" for criterion in criteria]
+    assert rubric_approach.embeddings == [["Liability cap", "limit of liability", "termination notice"]]
+    assert [search_query for search_query, _ in rubric_approach.searches] == ["Liability cap", "termination notice"]
+    assert rubric_approach.searches[0][1].vector == QUERY_EMBEDDINGS["Liability cap"]
+    assert result["retrieval"] == {
+        "queries": 5,
+        "unique_queries": 2,
+        "embedding_calls": 1,
+        "embedding_calls_saved": 4,
+        "search_calls": 2,
+        "search_calls_saved": 3,
+    }
+
+    # Without vectors only the same queries are merged
+    rubric_approach.embeddings.clear()
+    rubric_approach.searches.clear()
+    result = await rubric_approach.run(criteria, [], context={"overrides": {"retrieval_mode": "text"}})
+    assert rubric_approach.embeddings == []
+    assert [search_query for search_query, _ in rubric_approach.searches] == [
+        "Liability cap",
+        "limit of liability",
+        "termination notice",
+    ]
+    assert result["retrieval"]["embedding_calls"] == 0
+    assert result["retrieval"]["search_calls_saved"] == 2
+
+
+def packed_completion(content):
+    return ChatCompletion(
+        object="chat.completion",
+        choices=[
+            Choice(message=ChatCompletionMessage(role="assistant", content=content), finish_reason="stop", index=0)
+        ],
+        id="test-123",
+        created=0,
+        model="test-model",
+        usage=CompletionUsage(prompt_tokens=100, completion_tokens=20, total_tokens=120),
+    )
+
+
+@pytest.fixture
+def mock_token_count(monkeypatch):
+    # One token per word
+    monkeypatch.setattr(
+        "approaches.RubricEvaluationApproach.num_tokens_from_messages",
+        lambda message, model: len(message["content"].split()),
+    )
+
+
+@pytest.mark.asyncio
+async def test_rubric_run_packs_criteria(rubric_approach, mock_token_count, monkeypatch):
+    sources = {
+        "Liability cap": ["contract.pdf#page=1: cap", "contract.pdf#page=2: indemnity"],
+        "limit of liability": ["contract.pdf#page=2: indemnity", "contract.pdf#page=3: limit"],
+        "termination notice": ["contract.pdf#page=4: notice"],
+        "query for criterion 0": ["contract.pdf#page=5: other"],
+    }
+
+    async def mock_retrieve_documents(search_query, context, vector=None):
+        return sources[search_query]
+
+    prompts = []
+
+    async def mock_create(*args, **kwargs):
+        prompts.append(kwargs["messages"][-1]["content"])
+        # The answer to the second criterion is missing
+        return packed_completion(
+            '```json\n{"answers": [{"criterion": 1, "answer": "Capped [contract.pdf#page=1]"}]}\n```'
+        )
+
+    monkeypatch.setattr(rubric_approach, "retrieve_documents", mock_retrieve_documents)
+    rubric_approach.openai_client = SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(create=mock_create))
+    )
+
+    criteria = ["liability 1", "liability 3", "termination 4", "criterion 0"]
+    result = await rubric_approach.run(
+        criteria, [], context={"overrides": {"retrieval_mode": "text", "pack_criteria": True}}
+    )
+    assert result["errors"] == []
+    # The liability criteria share a source so they are packed, the missing answer is generated on its own
+    assert result["rubric_answers"] == [
+        "Capped [contract.pdf#page=1]",
+        "answer to liability 3",
+        "answer to termination 4",
+        "answer to criterion 0",
+    ]
+    assert prompts == [
+        "Criteria:\n1. liability 1\n2. liability 3\nSources:\n contract.pdf#page=1: cap\n"
+        "contract.pdf#page=2: indemnity\ncontract.pdf#page=3: limit"
+    ]
+    usage = result["usage"]
+    assert usage.pop("seconds") >= 0
+    assert usage == {
+        "completions": 1,
+        "cached_answers": 0,
+        "packed_completions": 1,
+        "packed_criteria": 2,
+        "fallbacks": 1,
+        "prompt_tokens": 100,
+        "completion_tokens": 20,
+    }
+
+
+def test_rubric_packs_fit_token_limit(rubric_approach, mock_token_count):
+    sources = {0: ["a.pdf: one two"], 1: ["a.pdf: one two", "b.pdf: three"], 2: ["a.pdf: one two"], 3: ["c.pdf: four"]}
+    criteria = ["first", "second", "third", "fourth"]
+    packs = rubric_approach.pack_criteria_by_sources(criteria, sources, {})
+    assert [pack.indexes for pack in packs] == [[0, 1, 2], [3]]
+    assert packs[0].sources == ["a.pdf: one two", "b.pdf: three"]
+
+    # Room for the prompt and the answers of two criteria only
+    rubric_approach.chatgpt_token_limit = (
+        packs[0].tokens
+        - 1
+        + len((rubric_approach.system_chat_template + rubric_approach.packed_answer_instructions).split())
+    )
+    packs = rubric_approach.pack_criteria_by_sources(criteria, sources, {})
+    assert [pack.indexes for pack in packs] == [[0, 1], [2], [3]]
+
+    rubric_approach.max_criteria_per_pack = 1
+    packs = rubric_approach.pack_criteria_by_sources(criteria, sources, {})
+    assert [pack.indexes for pack in packs] == [[0], [1], [2], [3]]
+
+
+def test_rubric_parse_packed_answers(rubric_approach):
+    content = '{"answers": [{"criterion": 2, "answer": " Yes [a.pdf] "}, {"criterion": 7, "answer": "No"}, "Maybe"]}'
+    assert rubric_approach.parse_packed_answers(content, 3) == [None, "Yes [a.pdf]", None]
+    assert rubric_approach.parse_packed_answers("Sorry, I can't answer in JSON", 2) == [None, None]
+    assert rubric_approach.parse_packed_answers('{"answers": [{"criterion": 1, "answer": "Yes"}', 1) == [None]
+
+
+@pytest.mark.asyncio
+async def test_rubric_run_cached(rubric_approach, monkeypatch, tmp_path):
+    calls = {"queries": 0, "answers": 0}
+    generate_search_query = rubric_approach.generate_search_query
+
+    async def mock_generate_search_query(criterion, messages, context):
+        calls["queries"] += 1
+        return await generate_search_query(criterion, messages, context)
+
+    async def mock_retrieve_documents(search_query, context, vector=None):
+        rubric_approach.searches.append((search_query, vector))
+        return [f"{search_query}.pdf#page=1: text"]
+
+    async def mock_generate_answer(criterion, search_results, messages, context, usage=None):
+        calls["answers"] += 1
+        return f"answer to {criterion}"
+
+    monkeypatch.setattr(rubric_approach, "generate_search_query", mock_generate_search_query)
+    monkeypatch.setattr(rubric_approach, "retrieve_documents", mock_retrieve_documents)
+    monkeypatch.setattr(rubric_approach, "generate_answer", mock_generate_answer)
+    rubric_approach.auth_helper = AuthenticationHelper(None, False, None, None, None, None)
+    rubric_approach.rubric_cache = RubricCache(SQLiteRubricCacheStore(str(tmp_path / "rubric.db")))
+
+    async def run():
+        calls.update(queries=0, answers=0)
+        rubric_approach.embeddings.clear()
+        rubric_approach.searches.clear()
+        events = await rubric_approach.run(["liability 1", "termination 4"], [], stream=True)
+        return [event async for event in events if "index" in event]
+
+    events = await run()
+    assert not any(event.get("cached") for event in events)
+    assert calls == {"queries": 2, "answers": 2}
+    assert rubric_approach.embeddings == [["Liability cap", "termination notice"]]
+
+    # Nothing changed, so the answers come from the cache
+    events = await run()
+    assert events == [
+        {"index": 0, "criterion": "liability 1", "answer": "answer to liability 1", "cached": True},
+        {"index": 1, "criterion": "termination 4", "answer": "answer to termination 4", "cached": True},
+    ]
+    assert calls == {"queries": 0, "answers": 0}
+    assert rubric_approach.searches == []
+
+    # A document cited by one answer was indexed again, only that criterion is answered again
+    await rubric_approach.rubric_cache.invalidate_files(["Liability cap.pdf"])
+    events = await run()
+    assert [(event["index"], event.get("cached", False)) for event in events] == [(1, True), (0, False)]
+    # Its search query and embedding didn't change
+    assert calls == {"queries": 0, "answers": 1}
+    assert rubric_approach.embeddings == []
+    assert [search_query for search_query, _ in rubric_approach.searches] == ["Liability cap"]
+
+    # A new document might answer any criterion
+    await rubric_approach.rubric_cache.invalidate_files(["new.pdf"])
+    events = await run()
+    assert not any(event.get("cached") for event in events)
+    assert calls == {"queries": 0, "answers": 2}
+    assert rubric_approach.rubric_cache.get_stats()["new_files"] == 1
+
+    # Answers depend on the overrides
+    result = await rubric_approach.run(["liability 1"], [], context={"overrides": {"top": 5}})
+    assert result["usage"]["cached_answers"] == 0
+    result = await rubric_approach.run(
+        ["liability 1"], [], context={"overrides": {"top": 5, "max_concurrent_criteria": 1}}
+    )
+    assert result["usage"]["cached_answers"] == 1
+    await rubric_approach.rubric_cache.close()
+
+
+@pytest.mark.asyncio
+async def test_rubric_evaluation(client):
+    response = await client.post(
+        "/api/rubric-evaluation",
+        json={
+            "rubric_criteria": ["What is the capital of France?", "Are interest rates high?"],
+            "messages": [],
+            "context": {"overrides": {"retrieval_mode": "text"}},
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert result == {
+        "rubric_answers": [
+            "The capital of France is Paris. [Benefit_Options-2.pdf].",
+            "The capital of France is Paris. [Benefit_Options-2.pdf].",
+        ],
+        "errors": [],
+        "retrieval": {
+            "queries": 2,
+            "unique_queries": 2,
+            "embedding_calls": 0,
+            "embedding_calls_saved": 0,
+            "search_calls": 2,
+            "search_calls_saved": 0,
+        },
+        "usage": result["usage"],
+    }
+    assert result["usage"]["completions"] == 2
+
+
+@pytest.mark.asyncio
+async def test_rubric_evaluation_stream(client):
+    response = await client.post(
+        "/api/rubric-evaluation",
+        json={"rubric_criteria": ["What is the capital of France?"], "messages": [], "stream": True},
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "application/json-lines"
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert events[0]["retrieval"]["search_calls"] == 1
+    assert "usage" in events.pop()
+    assert events[1:] == [
+        {
+            "index": 0,
+            "criterion": "What is the capital of France?",
+            "answer": "The capital of France is Paris. [Benefit_Options-2.pdf].",
+        }
+    ]
@@ -0,0 +1,48 @@
+import pytest
+
+from core.rubriccache import RubricCache, SQLiteRubricCacheStore
+
+
+@pytest.mark.asyncio
+async def test_rubriccache_shared_by_workers(tmp_path):
+    path = str(tmp_path / "cache" / "rubric.db")
+    cache = RubricCache(SQLiteRubricCacheStore(path))
+    keys = await cache.make_answer_keys(["Can the supplier terminate?"], [], {"top": 3}, None)
+    await cache.set_answer(keys[0], "Yes [terms.pdf#page=2]", ["terms.pdf#page=2: The supplier may terminate"])
+    await cache.set_embedding("text-embedding-ada-002", "supplier termination", [0.1, 0.2, 0.3])
+
+    # Another worker of the host, or the same worker after a restart
+    other_cache = RubricCache(SQLiteRubricCacheStore(path))
+    assert await other_cache.get_answers(keys) == {keys[0]: "Yes [terms.pdf#page=2]"}
+    embeddings = await other_cache.get_embeddings("text-embedding-ada-002", ["supplier termination", "other"])
+    assert embeddings["supplier termination"] == pytest.approx([0.1, 0.2, 0.3])
+    assert "other" not in embeddings
+    assert other_cache.get_stats()["embedding_misses"] == 1
+
+    # A new document bumps the index version for all workers
+    await other_cache.invalidate_files(["contract.pdf"])
+    assert await cache.make_answer_keys(["Can the supplier terminate?"], [], {"top": 3}, None) != keys
+    assert await cache.get_answers(keys) == {}
+    assert await cache.get_embeddings("text-embedding-ada-002", ["supplier termination"]) != {}
+    await cache.close()
+    await other_cache.close()
+
+
+@pytest.mark.asyncio
+async def test_rubriccache_keys():
+    cache = RubricCache(SQLiteRubricCacheStore(":memory:"))
+    [key] = await cache.make_answer_keys(["Criterion"], [], {"top": 3}, None)
+    # The security filter of the user is part of the key
+    assert await cache.make_answer_keys(["Criterion"], [], {"top": 3}, "oids/any(g:search.in(g, 'a'))") != [key]
+    assert await cache.make_answer_keys(["Criterion"], [], {"top": 3, "max_concurrent_criteria": 2}, None) == [key]
+    await cache.close()
+
+
+@pytest.mark.asyncio
+async def test_rubriccache_ttl(monkeypatch):
+    cache = RubricCache(SQLiteRubricCacheStore(":memory:", ttl=60))
+    await cache.set_answer("key", "Yes", [])
+    assert await cache.get_answers(["key"]) == {"key": "Yes"}
+    monkeypatch.setattr("core.rubriccache.time.time", lambda: 1e12)
+    assert await cache.get_answers(["key"]) == {}
+    await cache.close()
@@ -0,0 +1,138 @@
+import asyncio
+import csv
+import io
+import json
+import os
+
+import azure.storage.blob.aio
+import pytest
+from azure.core.exceptions import ResourceNotFoundError
+
+from core.rubricjobs import RubricJobRunner
+
+from .test_rubricstore import CONNECTION_STRING
+
+RUBRIC_CSV = b"\xef\xbb\xbfCriteria\nWhat is the capital of France?\n\nAre interest rates high?\n"
+
+
+@pytest.fixture
+def rubric_jobs_env(monkeypatch, mock_env, tmp_path):
+    monkeypatch.setenv("RUBRIC_JOBS_DIR", str(tmp_path))
+    monkeypatch.setenv("AZURE_STORAGE_CONNECTION_STRING", CONNECTION_STRING)
+
+    class MockDownloader:
+        async def readall(self):
+            return RUBRIC_CSV
+
+    async def mock_download_blob(self, name, *args, **kwargs):
+        if name != "rubric.csv":
+            raise ResourceNotFoundError()
+        return MockDownloader()
+
+    monkeypatch.setattr(azure.storage.blob.aio.ContainerClient, "download_blob", mock_download_blob)
+
+
+async def wait_for(condition, timeout=10):
+    for _ in range(int(timeout / 0.02)):
+        if condition():
+            return
+        await asyncio.sleep(0.02)
+    raise AssertionError("The condition was not met in time")
+
+
+@pytest.mark.asyncio
+async def test_rubric_job(rubric_jobs_env, client):
+    response = await client.post("/rubric_jobs", json={"rubric": "rubric.csv", "overrides": {"retrieval_mode": "text"}})
+    assert response.status_code == 202
+    job = await response.get_json()
+    assert job["status"] == "queued"
+    assert job["total"] == 2
+
+    async def get_status():
+        response = await client.get(f"/rubric_jobs/{job['id']}")
+        return await response.get_json()
+
+    for _ in range(200):
+        status = await get_status()
+        if status["status"] == "succeeded":
+            break
+        await asyncio.sleep(0.05)
+    assert status["completed"] == 2
+    assert status["errors"] == 0
+
+    response = await client.get(f"/rubric_jobs/{job['id']}/results.csv")
+    assert response.status_code == 200
+    assert response.mimetype == "text/csv"
+    assert 'filename="rubric_results.csv"' in response.headers["Content-Disposition"]
+    rows = list(csv.reader(io.StringIO(await response.get_data(as_text=True))))
+    assert rows == [
+        ["Criteria", "Answer", "Error"],
+        ["What is the capital of France?", "The capital of France is Paris. [Benefit_Options-2.pdf].", ""],
+        ["Are interest rates high?", "The capital of France is Paris. [Benefit_Options-2.pdf].", ""],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_rubric_job_errors(rubric_jobs_env, client):
+    response = await client.post("/rubric_jobs", json={"rubric": "missing.csv"})
+    assert response.status_code == 404
+    response = await client.get("/rubric_jobs/0123456789abcdef0123456789abcdef")
+    assert response.status_code == 404
+    response = await client.get("/rubric_jobs/not-a-job/results.csv")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_rubric_job_resumes(tmp_path):
+    criteria = [f"criterion {index}" for index in range(4)]
+    evaluated: list[list[str]] = []
+    stopped = asyncio.Event()
+
+    async def evaluate_until_crash(job_criteria, context):
+        async def events():
+            # The worker goes away after two criteria
+            for index in (1, 0):
+                yield {"index": index, "criterion": job_criteria[index], "answer": f"answer to {job_criteria[index]}"}
+            await stopped.wait()
+
+        evaluated.append(job_criteria)
+        return events()
+
+    async def evaluate(job_criteria, context):
+        async def events():
+            yield {"retrieval": {}}
+            for index, criterion in enumerate(job_criteria):
+                yield {"index": index, "criterion": criterion, "answer": f"answer to {criterion}"}
+
+        evaluated.append(job_criteria)
+        assert context["overrides"] == {"include_sourcefiles": ["contract.pdf"]}
+        return events()
+
+    runner = RubricJobRunner(jobs_dir=str(tmp_path), evaluate=evaluate_until_crash)
+    runner.start()
+    job = runner.create_job("rubric.csv", criteria, {"include_sourcefiles": ["contract.pdf"]}, {})
+    await wait_for(lambda: runner.get(job.id).completed == 2)
+
+    # Another worker of the host doesn't run a job that is running already
+    other_runner = RubricJobRunner(jobs_dir=str(tmp_path), evaluate=evaluate)
+    await other_runner.run(job.id)
+    assert len(evaluated) == 1
+
+    await runner.close()
+    assert runner.get(job.id).status == "running"
+    # The worker stopped while it was writing a row
+    with open(os.path.join(str(tmp_path), job.id, "rows.jsonl"), "a") as rows_file:
+        rows_file.write('{"index": 3, "ans')
+
+    # The next worker resumes the job from its checkpoint
+    other_runner.start()
+    await wait_for(lambda: other_runner.get(job.id).status == "succeeded")
+    await other_runner.close()
+    assert evaluated == [criteria, ["criterion 2", "criterion 3"]]
+    status = other_runner.get(job.id).to_dict()
+    assert status["completed"] == 4
+    assert status["attempts"] == 2
+    rows = list(csv.reader(io.StringIO(other_runner.to_csv(other_runner.get(job.id)))))
+    assert [row[1] for row in rows[1:]] == [f"answer to {criterion}" for criterion in criteria]
+    with open(os.path.join(str(tmp_path), job.id, "job.json")) as job_file:
+        assert json.load(job_file)["overrides"] == {"include_sourcefiles": ["contract.pdf"]}
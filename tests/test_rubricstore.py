@@ -0,0 +1,97 @@
+import io
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+import azure.storage.blob.aio
+import pytest
+from quart.datastructures import FileStorage
+
+from core.rubricstore import RubricStore
+
+CONNECTION_STRING = (
+    "DefaultEndpointsProtocol=https;AccountName=teststorage;AccountKey=dGVzdGtleQ==;EndpointSuffix=core.windows.net"
+)
+
+
+@pytest.fixture
+def mock_rubric_container(monkeypatch):
+    blobs = ["rubric.csv", "contracts.csv"]
+    calls = {"list_blobs": 0, "create_container": 0}
+
+    def mock_list_blobs(self, *args, **kwargs):
+        calls["list_blobs"] += 1
+
+        async def iterate():
+            for name in blobs:
+                yield SimpleNamespace(name=name)
+
+        return iterate()
+
+    async def mock_create_container(self, *args, **kwargs):
+        calls["create_container"] += 1
+
+    async def mock_upload_blob(self, name, data, *args, **kwargs):
+        blobs.append(name)
+
+    monkeypatch.setattr(azure.storage.blob.aio.ContainerClient, "list_blobs", mock_list_blobs)
+    monkeypatch.setattr(azure.storage.blob.aio.ContainerClient, "create_container", mock_create_container)
+    monkeypatch.setattr(azure.storage.blob.aio.ContainerClient, "upload_blob", mock_upload_blob)
+    return calls
+
+
+@pytest.fixture
+def rubric_env(monkeypatch, mock_env):
+    monkeypatch.setenv("AZURE_STORAGE_CONNECTION_STRING", CONNECTION_STRING)
+    monkeypatch.setenv("AZURE_STORAGE_CONTAINER_RUBRIC", "rubric")
+
+
+@pytest.mark.asyncio
+async def test_get_rubric_files_cached(rubric_env, mock_rubric_container, client):
+    response = await client.get("/get_rubric_files")
+    assert response.status_code == 200
+    assert await response.get_json() == {"rubric_files": ["rubric.csv", "contracts.csv"]}
+    etag = response.headers["ETag"]
+
+    response = await client.get("/get_rubric_files", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert mock_rubric_container["list_blobs"] == 1
+
+    # An upload refreshes the list
+    response = await client.post(
+        "/upload_rubric", files={"file": FileStorage(io.BytesIO(b"Criteria\n"), filename="new rubric.csv")}
+    )
+    assert response.status_code == 200
+    assert "/rubric/new_rubric.csv?" in await response.get_data(as_text=True)
+    response = await client.get("/get_rubric_files", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert (await response.get_json())["rubric_files"][-1] == "new_rubric.csv"
+    assert response.headers["ETag"] != etag
+    assert mock_rubric_container == {"list_blobs": 2, "create_container": 1}
+
+
+@pytest.mark.asyncio
+async def test_get_csv_sas_url_reused(rubric_env, client):
+    response = await client.get("/get_csv_sas_url")
+    sas_url = await response.get_data(as_text=True)
+    assert sas_url.startswith("https://teststorage.blob.core.windows.net/rubric/rubric.csv?")
+    assert parse_qs(urlparse(sas_url).query)["sp"] == ["r"]
+    response = await client.get("/get_csv_sas_url")
+    assert await response.get_data(as_text=True) == sas_url
+    response = await client.get("/get_csv_sas_url?file=contracts.csv")
+    assert "/rubric/contracts.csv?" in await response.get_data(as_text=True)
+
+
+@pytest.mark.asyncio
+async def test_rubric_routes_need_connection_string(client):
+    response = await client.get("/get_rubric_files")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_sas_url_renewed_before_expiry():
+    store = RubricStore(CONNECTION_STRING, "rubric", sas_ttl=3600, sas_refresh_margin=3600)
+    # With a margin as long as the lifetime, every URL is renewed
+    assert store.get_sas_url("rubric.csv") is not None
+    store.get_sas_url("rubric.csv")
+    assert store.get_stats()["sas_urls"]["hits"] == 0
+    await store.close()
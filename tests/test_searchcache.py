@@ -0,0 +1,104 @@
+import pytest
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import RawVectorQuery
+
+from approaches.approach import Document
+from approaches.retrievethenread import RetrieveThenReadApproach
+from core.searchcache import SearchCache
+
+from .mocks import MockAsyncSearchResultsIterator
+
+
+@pytest.fixture
+def search_calls(monkeypatch):
+    calls = []
+
+    async def mock_search(self, *args, **kwargs):
+        calls.append(kwargs)
+        return MockAsyncSearchResultsIterator(kwargs.get("search_text"), kwargs.get("vector_queries"))
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    return calls
+
+
+@pytest.fixture
+def approach():
+    return RetrieveThenReadApproach(
+        search_client=SearchClient(
+            endpoint="https://test.search.windows.net", index_name="test", credential=AzureKeyCredential("test")
+        ),
+        auth_helper=None,
+        openai_client=None,
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_model="text-embedding-ada-002",
+        embedding_deployment="embeddings",
+        sourcepage_field="sourcepage",
+        content_field="content",
+        query_language="en-us",
+        query_speller="lexicon",
+        search_cache=SearchCache(max_bytes=1024 * 1024, ttl=None),
+    )
+
+
+@pytest.mark.asyncio
+async def test_search_cached(approach, search_calls):
+    vectors = [RawVectorQuery(vector=[0.5, -0.25], k=50, fields="embedding")]
+    documents = await approach.search(3, "benefits", None, vectors, True, True)
+    assert len(search_calls) == 1
+
+    cached_documents = await approach.search(
+        3, "benefits", None, [RawVectorQuery(vector=[0.5, -0.25], k=50, fields="embedding")], True, True
+    )
+    assert len(search_calls) == 1
+    assert cached_documents == documents
+    assert cached_documents is not documents
+
+    # Any change to the filter, vectors or retrieval options is a different entry
+    await approach.search(3, "benefits", "oids/any(g:search.in(g, 'OID_X'))", vectors, True, True)
+    await approach.search(
+        3, "benefits", None, [RawVectorQuery(vector=[0.5, 0.25], k=50, fields="embedding")], True, True
+    )
+    await approach.search(3, "benefits", None, vectors, False, False)
+    await approach.search(5, "benefits", None, vectors, True, True)
+    assert len(search_calls) == 5
+
+    stats = approach.search_cache.get_stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 5
+
+
+@pytest.mark.asyncio
+async def test_search_cache_invalidate(approach, search_calls):
+    await approach.search(3, "benefits", None, [], False, False)
+    approach.search_cache.invalidate()
+    await approach.search(3, "benefits", None, [], False, False)
+    assert len(search_calls) == 2
+    assert approach.search_cache.get_stats()["invalidations"] == 1
+
+
+def test_search_cache_budget():
+    def make_document(content: str) -> Document:
+        return Document(
+            id="1",
+            content=content,
+            embedding=[0.5] * 10,
+            image_embedding=None,
+            category=None,
+            sourcepage="benefits.pdf#page=1",
+            sourcefile="benefits.pdf",
+            oids=None,
+            groups=None,
+            captions=[],
+        )
+
+    cache = SearchCache(max_bytes=2048, ttl=None)
+    small_key = SearchCache.make_key(3, "benefits", None, [], False, False, "en-us", "lexicon")
+    cache.set(small_key, [make_document("Benefits are great")])
+    assert SearchCache.sizeof([make_document("Benefits are great")]) == 512 + 18 + 320
+    # Results bigger than the whole budget are not stored
+    big_key = SearchCache.make_key(3, "handbook", None, [], False, False, "en-us", "lexicon")
+    cache.set(big_key, [make_document("x" * 4096)])
+    assert cache.get(big_key) is None
+    assert cache.get(small_key) == [make_document("Benefits are great")]
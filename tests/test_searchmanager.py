@@ -3,9 +3,11 @@ import io
 import openai
 import openai.types
 import pytest
+import tiktoken
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.aio import SearchIndexClient
+from azure.search.documents.indexes.models import SearchIndex, SimpleField
 from openai.types.create_embedding_response import Usage
 
 from scripts.prepdocslib.embeddings import AzureOpenAIEmbeddingService
@@ -58,7 +60,8 @@ async def test_create_index_doesnt_exist_yet(monkeypatch, search_info):
     await manager.create_index()
     assert len(indexes) == 1, "It should have created one index"
     assert indexes[0].name == "test"
-    assert len(indexes[0].fields) == 6
+    assert len(indexes[0].fields) == 7
+    assert indexes[0].fields[6].name == "tokens"
 
 
 @pytest.mark.asyncio
@@ -71,14 +74,28 @@ async def test_create_index_does_exist(monkeypatch, search_info):
     async def mock_list_index_names(self):
         yield "test"
 
+    async def mock_get_index(self, name):
+        return SearchIndex(name=name, fields=[SimpleField(name="id", type="Edm.String", key=True)])
+
     monkeypatch.setattr(SearchIndexClient, "create_index", mock_create_index)
     monkeypatch.setattr(SearchIndexClient, "list_index_names", mock_list_index_names)
+    monkeypatch.setattr(SearchIndexClient, "get_index", mock_get_index)
+    monkeypatch.setattr(SearchIndexClient, "create_or_update_index", mock_create_index)
 
     manager = SearchManager(
         search_info,
     )
     await manager.create_index()
-    assert len(indexes) == 0, "It should not have created a new index"
+    assert len(indexes) == 1, "It should not have created a new index, only added the tokens field"
+    assert [field.name for field in indexes[0].fields] == ["id", "tokens"]
+
+    # An index that already has the tokens field is left as it is
+    async def mock_get_updated_index(self, name):
+        return indexes[0]
+
+    monkeypatch.setattr(SearchIndexClient, "get_index", mock_get_updated_index)
+    await manager.create_index()
+    assert len(indexes) == 1
 
 
 @pytest.mark.asyncio
@@ -102,7 +119,7 @@ async def test_create_index_acls(monkeypatch, search_info):
     await manager.create_index()
     assert len(indexes) == 1, "It should have created one index"
     assert indexes[0].name == "test"
-    assert len(indexes[0].fields) == 8
+    assert len(indexes[0].fields) == 9
 
 
 @pytest.mark.asyncio
@@ -114,11 +131,14 @@ async def test_update_content(monkeypatch, search_info):
         assert documents[0]["category"] == "test"
         assert documents[0]["sourcepage"] == "foo.pdf#page=1"
         assert documents[0]["sourcefile"] == "foo.pdf"
+        assert documents[0]["tokens"] == len(tiktoken.get_encoding("cl100k_base").encode("test content"))
 
     monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
 
+    content_changes = []
     manager = SearchManager(
         search_info,
+        on_content_changed=lambda: content_changes.append(True),
     )
 
     test_io = io.BytesIO(b"test content")
@@ -137,6 +157,7 @@ async def test_update_content(monkeypatch, search_info):
             )
         ]
     )
+    assert content_changes == [True]
 
 
 @pytest.mark.asyncio
@@ -0,0 +1,102 @@
+import logging
+
+import numpy as np
+import pytest
+
+from core.semanticcache import SemanticAnswerCache
+
+
+def make_response(*sources: str) -> dict:
+    return {
+        "choices": [
+            {
+                "message": {"role": "assistant", "content": "Assignment needs consent [contract.pdf#page=4]."},
+                "context": {"data_points": {"text": [f"{source}: Some text" for source in sources]}},
+                "finish_reason": "stop",
+                "index": 0,
+            }
+        ]
+    }
+
+
+def test_semanticcache_hit_above_threshold():
+    cache = SemanticAnswerCache(max_entries=10, ttl=None, threshold=0.95)
+    scope = cache.make_scope("RetrieveThenReadApproach", [], {"temperature": 0}, None)
+    cache.set(
+        scope, [1.0, 0.0, 0.0], "can we assign this agreement to a third party?", make_response("contract.pdf#page=4")
+    )
+
+    match = cache.get(scope, [0.99, 0.1, 0.0])
+    assert match is not None
+    assert match.question == "can we assign this agreement to a third party?"
+    assert match.score == pytest.approx(0.995, abs=1e-3)
+    assert match.response == make_response("contract.pdf#page=4")
+    # Not similar enough
+    assert cache.get(scope, [0.7, 0.7, 0.0]) is None
+    # Within 0.05 of the threshold
+    assert cache.get(scope, [0.95, 0.35, 0.0]) is None
+    stats = cache.get_stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["near_misses"] == 1
+    assert stats["entries"] == 1
+
+
+def test_semanticcache_scopes():
+    cache = SemanticAnswerCache(max_entries=10, ttl=None, threshold=0.95)
+    scope = cache.make_scope("RetrieveThenReadApproach", [], {}, "oids/any(g:search.in(g, 'OID_X'))")
+    other_scope = cache.make_scope("RetrieveThenReadApproach", [], {}, "oids/any(g:search.in(g, 'OID_Y'))")
+    assert scope != other_scope
+    cache.set(scope, [1.0, 0.0], "Is assignment allowed?", make_response("contract.pdf#page=4"))
+    assert cache.get(other_scope, [1.0, 0.0]) is None
+    assert cache.get(scope, [1.0, 0.0]) is not None
+
+    # A new index version makes new scopes, and drops the previous entries
+    cache.invalidate()
+    assert cache.make_scope("RetrieveThenReadApproach", [], {}, "oids/any(g:search.in(g, 'OID_X'))") != scope
+    assert cache.get(scope, [1.0, 0.0]) is None
+    assert cache.get_stats()["entries"] == 0
+
+
+def test_semanticcache_evicts_least_recently_used(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("core.semanticcache.time.monotonic", lambda: now)
+    cache = SemanticAnswerCache(max_entries=2, ttl=60, threshold=0.95)
+    cache.set(1, [1.0, 0.0], "first", make_response("a.pdf"))
+    now += 1
+    cache.set(1, [0.0, 1.0], "second", make_response("b.pdf"))
+    now += 1
+    assert cache.get(1, [1.0, 0.0]) is not None
+    now += 1
+    cache.set(1, [-1.0, 0.0], "third", make_response("c.pdf"))
+    assert cache.get(1, [0.0, 1.0]) is None
+    assert cache.get(1, [1.0, 0.0]) is not None
+    assert cache.get_stats()["evictions"] == 1
+
+    # Expired entries are never returned, and their slots are reused first
+    now += 61
+    assert cache.get(1, [-1.0, 0.0]) is None
+    cache.set(1, [0.0, 1.0], "fourth", make_response("d.pdf"))
+    assert cache.get_stats()["evictions"] == 1
+    assert cache.get_stats()["entries"] == 1
+    assert isinstance(cache.embeddings, np.ndarray)
+    assert cache.embeddings.dtype == np.float32
+
+
+def test_semanticcache_check_sample(caplog):
+    cache = SemanticAnswerCache(max_entries=10, ttl=None, threshold=0.9, sample_rate=1.0)
+    cache.set(
+        1, [1.0, 0.0], "can we assign this agreement?", make_response("contract.pdf#page=4", "contract.pdf#page=5")
+    )
+    match = cache.get(1, [1.0, 0.1])
+    assert match is not None
+    assert cache.sample()
+
+    cache.check_sample(match, "is assignment allowed?", make_response("contract.pdf#page=5", "contract.pdf#page=4"))
+    with caplog.at_level(logging.WARNING):
+        cache.check_sample(match, "can we terminate this agreement?", make_response("contract.pdf#page=9"))
+    assert "can we terminate this agreement?" in caplog.text
+    stats = cache.get_stats()
+    assert stats["sampled_hits"] == 2
+    assert stats["false_hits"] == 1
+    assert stats["false_hit_rate"] == 0.5
@@ -0,0 +1,54 @@
+from azure.ai.formrecognizer import DocumentTable, DocumentTableCell
+
+from core.modelhelper import get_encoding
+from core.tablerenderer import render_table, render_tables_compact, table_render_cache
+
+from scripts.prepdocslib.pdfparser import DocumentAnalysisPdfParser
+
+
+def make_table_html() -> str:
+    cells = [
+        DocumentTableCell(row_index=0, column_index=0, content="Year", kind="columnHeader"),
+        DocumentTableCell(row_index=0, column_index=1, content="Revenue & costs", kind="columnHeader", column_span=2),
+        DocumentTableCell(row_index=1, column_index=0, content="2023"),
+        DocumentTableCell(row_index=1, column_index=1, content="5.2"),
+        DocumentTableCell(row_index=1, column_index=2, content="3.1"),
+        DocumentTableCell(row_index=2, column_index=0, content="2022"),
+        DocumentTableCell(row_index=2, column_index=1, content="4.8"),
+        DocumentTableCell(row_index=2, column_index=2, content=""),
+    ]
+    return DocumentAnalysisPdfParser.table_to_html(DocumentTable(row_count=3, column_count=3, cells=cells))
+
+
+def test_render_table():
+    table = make_table_html()
+    assert render_table(table) == "Year | Revenue & costs |  || 2023 | 5.2 | 3.1 || 2022 | 4.8 | "
+
+    # The start and the end of a table split across sections
+    end = table.index("<tr><td>2022")
+    assert render_table(table[:end]) == "Year | Revenue & costs |  || 2023 | 5.2 | 3.1"
+    assert render_table(table[end - len("3.1</td></tr>") :]) == "3.1 || 2022 | 4.8 | "
+
+
+def test_render_tables_compact():
+    table_render_cache.clear()
+    hits, misses = table_render_cache.stats.hits, table_render_cache.stats.misses
+    table = make_table_html()
+    content = f"Revenue by year:\n{table}\nRevenue grew in 2023."
+    rendered = render_tables_compact("section-1", content)
+    assert (
+        rendered
+        == "Revenue by year:\nYear | Revenue & costs |  || 2023 | 5.2 | 3.1 || 2022 | 4.8 | \nRevenue grew in 2023."
+    )
+    encoding = get_encoding("gpt-35-turbo")
+    assert len(encoding.encode(rendered)) < len(encoding.encode(content)) / 2
+
+    # Sections are rendered once, and again when their content changed
+    assert render_tables_compact("section-1", content) == rendered
+    render_tables_compact("section-1", content.replace("2023", "2024"))
+    assert table_render_cache.stats.hits == hits + 1
+    assert table_render_cache.stats.misses == misses + 2
+
+    # Sections without tables are left as they are
+    assert render_tables_compact("section-2", "Revenue grew in 2023.") == "Revenue grew in 2023."
+    assert table_render_cache.stats.misses == misses + 2